@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+import numpy as np
+import routing
+
+# Directory of the archive of the congestions (see CongestionArchive), and maximum number of snapshots of every file
+# (a day of updates every 5 minutes)
+ARCHIVE_DIRECTORY = 'archive'
+SNAPSHOTS_PER_FILE = 288
+
+# Columns of the congestions feed (the same as igo.CONGESTIONS_COLUMNS)
+COLUMNS = ['Tram', 'Data', 'Congestio_actual', 'Congestio_prevista']
+
+# A tram can appear several times in a feed: the rows are identified by tram * OCCURRENCES + occurrence
+OCCURRENCES = 2**16
+
+# Congestion of the rows of a snapshot that are not in the next one
+REMOVED = -1
+
+
+class CongestionArchive:
+    '''
+    Archive of the congestions feeds fetched by iGo, so the exact traffic of a day can be replayed
+    (see replay module). It can be used from several threads at once.
+    The snapshots are saved in files of arrays (see routing.save_arrays), in columns, with up to SNAPSHOTS_PER_FILE
+    snapshots each. A file starts with all the rows of its first snapshot, and every other snapshot only has the
+    rows of the trams whose congestions changed since the previous one (and the removed ones, see REMOVED),
+    which are usually a few dozens out of the ~500 trams of Barcelona.
+    Every snapshot has a date (the most common Data of its rows), so only the rows with another one keep their own
+    (in the columns date_rows and dates). The other rows take 8 bytes: tram, occurrence and both congestions.
+    '''
+
+    def __init__(self, directory=ARCHIVE_DIRECTORY, snapshots_per_file=SNAPSHOTS_PER_FILE):
+        self.directory = directory
+        self.snapshots_per_file = snapshots_per_file
+        self.lock = threading.Lock()
+        self.filename = None  # file of the last snapshots, rewritten with every new one
+        self.snapshots = []  # (fetched, date, keys, values) of the snapshots of the file, delta encoded
+        self.state = None  # rows of the last snapshot (see _rows)
+
+    def append(self, congestions, fetched=None):
+        '''
+        Adds a snapshot to the archive.
+        Input: - congestions: DataFrame with the columns of the congestions feed (see igo.download_congestions).
+               - fetched: time when it was fetched (seconds since the epoch), now by default.
+        Output: name of the file where it is saved.
+        '''
+        fetched = time.time() if fetched is None else fetched
+        date, keys, values = _rows(congestions)
+
+        with self.lock:
+            if self.filename is None or len(self.snapshots) >= self.snapshots_per_file:
+                self.filename = os.path.join(self.directory, f"congestions-{int(fetched * 1000):015d}.arrays")
+                self.snapshots = []
+                self.state = (np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.int64))
+
+            delta_keys, delta_values = _delta(self.state, (keys, values))
+            self.snapshots.append((fetched, date, delta_keys, delta_values))
+            self.state = (keys, values)
+
+            os.makedirs(self.directory, exist_ok=True)
+            _save(self.filename, self.snapshots)
+            return self.filename
+
+    def filenames(self):
+        '''Returns the names of the files of the archive, from the oldest to the newest.'''
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if name.startswith('congestions-') and name.endswith('.arrays')]
+
+    def read(self, start=None, end=None):
+        '''
+        Yields the snapshots of the archive fetched between start and end (seconds since the epoch, all of them by
+        default), from the oldest to the newest.
+        Output: tuples (fetched, congestions), where congestions is a DataFrame like the ones given to append,
+                with its rows sorted by tram.
+        '''
+        import pandas as pd
+
+        for filename in self.filenames():
+            arrays, metadata = routing.load_arrays(filename)
+            offsets = arrays['offsets']
+            keys = np.asarray(arrays['trams'], dtype=np.int64) * OCCURRENCES + arrays['occurrences']
+            values = np.c_[arrays['current'], arrays['predicted'], np.zeros(len(keys))].astype(np.int64)
+            values[arrays['date_rows'], 2] = arrays['dates']
+
+            state = (np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.int64))
+            for i, (fetched, date) in enumerate(zip(arrays['fetched'].tolist(), arrays['snapshot_dates'].tolist())):
+                state = _apply(state, keys[offsets[i]:offsets[i+1]], values[offsets[i]:offsets[i+1]])
+                if (start is not None and fetched < start) or (end is not None and fetched > end):
+                    continue
+                state_keys, state_values = state
+                dates = np.where(state_values[:, 2] == 0, date, state_values[:, 2])
+                yield fetched, pd.DataFrame({'Tram': state_keys // OCCURRENCES, 'Data': dates,
+                                             'Congestio_actual': state_values[:, 0],
+                                             'Congestio_prevista': state_values[:, 1]}, columns=COLUMNS)
+
+
+def _rows(congestions):
+    '''
+    Returns the date of the given congestions (the most common one), and their rows: their keys (sorted, see
+    OCCURRENCES) and their values (array with the columns current, predicted and date, 0 if it is the common one).
+    '''
+    trams = congestions['Tram'].to_numpy().astype(np.int64)
+    dates = congestions['Data'].to_numpy().astype(np.int64)
+    values = np.c_[congestions['Congestio_actual'].to_numpy(), congestions['Congestio_prevista'].to_numpy(),
+                   dates].astype(np.int64)
+
+    date = 0
+    if len(dates) > 0:
+        unique_dates, counts = np.unique(dates, return_counts=True)
+        date = int(unique_dates[np.argmax(counts)])
+        values[dates == date, 2] = 0
+
+    # the occurrence of every row is its position among the rows of the same tram
+    order = np.argsort(trams, kind='stable')
+    sorted_trams = trams[order]
+    starts = np.flatnonzero(np.r_[True, sorted_trams[1:] != sorted_trams[:-1]]) if len(trams) > 0 else np.empty(0)
+    occurrences = np.arange(len(trams)) - np.repeat(starts.astype(np.int64), np.diff(np.r_[starts, len(trams)]))
+    return date, sorted_trams * OCCURRENCES + occurrences, values[order]
+
+
+def _delta(previous, current):
+    '''Returns the rows of current (keys and values, see _rows) that are not in previous, and the removed ones.'''
+    previous_keys, previous_values = previous
+    keys, values = current
+
+    positions = np.minimum(np.searchsorted(previous_keys, keys), max(len(previous_keys) - 1, 0))
+    if len(previous_keys) > 0:
+        changed = (previous_keys[positions] != keys) | np.any(previous_values[positions] != values, axis=1)
+    else:
+        changed = np.ones(len(keys), dtype=bool)
+    removed = previous_keys[~np.isin(previous_keys, keys)]
+
+    delta_keys = np.r_[keys[changed], removed]
+    delta_values = np.r_[values[changed], np.tile([REMOVED, REMOVED, 0], (len(removed), 1))].astype(np.int64)
+    order = np.argsort(delta_keys, kind='stable')
+    return delta_keys[order], delta_values[order]
+
+
+def _apply(previous, delta_keys, delta_values):
+    '''Returns the rows (keys and values, see _rows) of previous updated with the given delta (see _delta).'''
+    previous_keys, previous_values = previous
+    kept = ~np.isin(previous_keys, delta_keys)
+    added = delta_values[:, 0] != REMOVED
+
+    keys = np.r_[previous_keys[kept], delta_keys[added]]
+    values = np.r_[previous_values[kept], delta_values[added]]
+    order = np.argsort(keys, kind='stable')
+    return keys[order], values[order]
+
+
+def _save(filename, snapshots):
+    '''Saves the given snapshots (fetched, date, keys, values) into the file, atomically (see routing.save_arrays).'''
+    keys = np.concatenate([np.empty(0, dtype=np.int64)] + [keys for _, _, keys, _ in snapshots])
+    values = np.concatenate([np.empty((0, 3), dtype=np.int64)] + [values for _, _, _, values in snapshots])
+    offsets = np.r_[0, np.cumsum([len(keys) for _, _, keys, _ in snapshots])].astype(np.int64)
+
+    arrays = {'fetched': np.array([fetched for fetched, _, _, _ in snapshots], dtype=np.float64),
+              'snapshot_dates': np.array([date for _, date, _, _ in snapshots], dtype=np.int64),
+              'offsets': offsets,
+              'trams': (keys // OCCURRENCES).astype(np.int32),
+              'occurrences': (keys % OCCURRENCES).astype(np.uint16),
+              'current': values[:, 0].astype(np.int8),
+              'predicted': values[:, 1].astype(np.int8),
+              'date_rows': np.flatnonzero(values[:, 2]).astype(np.int64),
+              'dates': values[values[:, 2] != 0, 2]}
+
+    routing.save_arrays(filename, arrays, {'columns': COLUMNS})
@@ -0,0 +1,515 @@
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import threading
+import tracemalloc
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import networkx as nx
+import requests
+from PIL import Image
+from scipy.spatial import Delaunay
+import igo
+import feeds
+import cch
+import tiles
+import routing
+
+# Synthetic cities are built around this point (Barcelona), with streets of about STREET_LENGTH meters
+CENTER = (41.39, 2.16)
+STREET_LENGTH = 100
+METERS_PER_DEGREE = 111320
+
+# Speeds of the streets (km/h, as strings like the ones of osmnx) and proportion of streets without it
+MAXSPEEDS = ['30', '30', '50', '50', '50', '80']
+MISSING_MAXSPEED = 0.2
+
+# Stages that can be measured (see main), in the order they are run
+STAGES = ['get_initial_itime', 'to_csr', 'build_cch', 'tram_geometries', 'build_trams_index', 'build_igraph',
+          'build_igraph_incremental', 'customize_cch', 'nearest_node', 'nearest_nodes_batch',
+          'shortest_path_dijkstra', 'shortest_path_bidirectional', 'shortest_path_astar', 'shortest_path_alt',
+          'shortest_path_cch', 'get_shortest_path_with_itimes', 'render_location',
+          'plot_congestions', 'travel_matrices']
+
+
+def grid_graph(nodes, seed=0):
+    '''
+    Returns a synthetic city like the graphs of osmnx (Networkx MultiDiGraph with the attributes x, y,
+    length and maxspeed): a square grid of about the given number of nodes, with some one-way streets.
+    '''
+    rnd = random.Random(seed)
+    side = max(2, int(round(nodes ** 0.5)))
+    positions = {}
+    for i in range(side):
+        for j in range(side):
+            positions[len(positions)] = (i + rnd.uniform(-0.2, 0.2), j + rnd.uniform(-0.2, 0.2))
+
+    streets = []
+    for i in range(side):
+        for j in range(side):
+            if i + 1 < side:
+                streets.append((i * side + j, (i + 1) * side + j))
+            if j + 1 < side:
+                streets.append((i * side + j, i * side + j + 1))
+    return _city_graph(positions, streets, rnd)
+
+
+def planar_graph(nodes, seed=0):
+    '''
+    Returns a synthetic city like the graphs of osmnx (see grid_graph): random intersections joined by the
+    streets of their Delaunay triangulation, without the longest ones, so the blocks are irregular.
+    '''
+    rnd = random.Random(seed)
+    side = nodes ** 0.5
+    points = np.random.default_rng(seed).random((nodes, 2)) * side
+    positions = {i: (float(y), float(x)) for i, (y, x) in enumerate(points)}
+
+    streets = set()
+    for a, b, c in Delaunay(points).simplices:
+        for u, v in ((a, b), (b, c), (c, a)):
+            streets.add((min(u, v), max(u, v)))
+    streets = sorted(streets)
+    lengths = np.array([np.hypot(*(points[u] - points[v])) for u, v in streets])
+    streets = [street for street, length in zip(streets, lengths) if length <= np.quantile(lengths, 0.85)]
+    return _city_graph(positions, [(int(u), int(v)) for u, v in streets], rnd)
+
+
+def _city_graph(positions, streets, rnd):
+    '''
+    Returns the MultiDiGraph with the given intersections (position: row and column, in streets) and streets.
+    70% of the streets are two-way, the rest one-way in a random direction.
+    '''
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    meters_per_degree_lon = METERS_PER_DEGREE * np.cos(np.radians(CENTER[0]))
+    side = max(max(i, j) for i, j in positions.values())
+    for node, (i, j) in positions.items():
+        # the node IDs are big like the ones of OpenStreetMap
+        graph.add_node(10**9 + node,
+                       y=CENTER[0] + (i - side / 2) * STREET_LENGTH / METERS_PER_DEGREE,
+                       x=CENTER[1] + (j - side / 2) * STREET_LENGTH / meters_per_degree_lon)
+
+    for u, v in streets:
+        u, v = 10**9 + u, 10**9 + v
+        dy = (graph.nodes[u]['y'] - graph.nodes[v]['y']) * METERS_PER_DEGREE
+        dx = (graph.nodes[u]['x'] - graph.nodes[v]['x']) * meters_per_degree_lon
+        attributes = {'length': float(np.hypot(dx, dy)) * rnd.uniform(1.0, 1.1)}
+        if rnd.random() >= MISSING_MAXSPEED:
+            attributes['maxspeed'] = rnd.choice(MAXSPEEDS)
+
+        # two-way (70%), from u to v (15%) or from v to u (15%)
+        direction = rnd.random()
+        if direction < 0.85:
+            graph.add_edge(u, v, **attributes)
+        if direction < 0.7 or direction >= 0.85:
+            graph.add_edge(v, u, **attributes)
+    return graph
+
+
+def fake_feeds(graph, trams, seed=0):
+    '''
+    Returns fake highways and congestions of the given synthetic city, with the columns of the real feeds.
+    Every tram (highway) is a walk of some streets of the graph, and its coordinates are the ones of its
+    intersections with some noise, like the real ones.
+    Output: highways and congestions (DataFrames, see igo.download_highways and igo.download_congestions).
+    '''
+    rnd = random.Random(seed)
+    nodes = list(graph.nodes)
+    rows = []
+    for tram in range(1, trams + 1):
+        node = rnd.choice(nodes)
+        walk = [node]
+        for _ in range(rnd.randint(2, 6)):
+            successors = list(graph.successors(node))
+            if not successors:
+                break
+            node = rnd.choice(successors)
+            walk.append(node)
+
+        coordinates = []
+        for node in walk:
+            coordinates += [graph.nodes[node]['x'] + rnd.uniform(-2e-5, 2e-5),
+                            graph.nodes[node]['y'] + rnd.uniform(-2e-5, 2e-5)]
+        rows.append((tram, tram, f"Tram {tram}", ','.join(f"{c:.10f}" for c in coordinates)))
+
+    highways = pd.DataFrame(rows, columns=['Tram', 'Tram_Components', 'Descripció', 'Coordenades'])
+    return highways, fake_congestions(highways, seed)
+
+
+def fake_congestions(highways, seed=0, previous=None, changed=1.0):
+    '''
+    Returns fake congestions of the given highways (see fake_feeds). If previous congestions are given,
+    only a proportion (changed) of the trams have a new congestion.
+    '''
+    rng = np.random.default_rng(seed)
+    trams = highways['Tram'].to_numpy()
+    current = rng.choice(len(igo.TIME_MULTIPLIER), size=len(trams), p=[0.3, 0.3, 0.2, 0.1, 0.05, 0.04, 0.01])
+    if previous is not None:
+        keep = rng.random(len(trams)) >= changed
+        current = np.where(keep, previous['Congestio_actual'].to_numpy(), current)
+    date = int(time.strftime('%Y%m%d%H%M%S'))
+    return pd.DataFrame({'Tram': trams, 'Data': date, 'Congestio_actual': current,
+                         'Congestio_prevista': current}, columns=igo.CONGESTIONS_COLUMNS)
+
+
+class TileServer:
+    '''Local tile server that answers every tile with the same blank image, so the maps are rendered offline.'''
+
+    def __init__(self):
+        image = io.BytesIO()
+        Image.new('RGB', (256, 256), (238, 238, 238)).save(image, 'PNG')
+        content = image.getvalue()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url_template = f"http://127.0.0.1:{self.server.server_port}/{{z}}/{{x}}/{{y}}.png"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class FeedServer:
+    '''
+    Local stand-in of the servers of the feeds (see feeds module), to check the fetches without network access.
+    It serves the same content in every path, and validates the conditional requests with the validators of its mode.
+    Attributes:
+           - content: bytes served.
+           - mode: 'etag' or 'last_modified' (the validator it sends and checks), 'none' (no validators),
+             or 'down' (it answers 503 Service Unavailable).
+           - requests and not_modified: number of requests received, and of them answered with 304 Not Modified.
+    '''
+
+    def __init__(self, content, mode='etag'):
+        self.content = content
+        self.mode = mode
+        self.modified = formatdate(time.time(), usegmt=True)
+        self.requests = 0
+        self.not_modified = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests += 1
+                if server.mode == 'down':
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                headers = {}
+                if server.mode == 'etag':
+                    headers['ETag'] = f'"{hashlib.sha1(server.content).hexdigest()}"'
+                    not_modified = self.headers.get('If-None-Match') == headers['ETag']
+                elif server.mode == 'last_modified':
+                    headers['Last-Modified'] = server.modified
+                    not_modified = self.headers.get('If-Modified-Since') == server.modified
+                else:
+                    not_modified = False
+
+                if not_modified:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    content = b''
+                else:
+                    self.send_response(200)
+                    content = server.content
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/feed.csv"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def update(self, content):
+        '''Changes the content served, as the real servers do when the feed is updated.'''
+        self.content = content
+        self.modified = formatdate(time.time() + 1, usegmt=True)
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def check_feeds(highways, congestions, directory='feeds'):
+    '''
+    Checks the fetches of the feeds (see feeds module and igo.parse_feed) against a FeedServer, for both validators:
+    the second fetch of a feed that did not change is answered with 304 and is not parsed again, a new content is
+    downloaded and parsed, the same content without validators is not parsed again, and the last good copy is used
+    while the server is down or unreachable. Raises AssertionError if a check fails.
+    Input: - highways and congestions: DataFrames of the feeds (see fake_feeds) served by the FeedServer.
+           - directory where the copies of the feeds are saved.
+    Output: dict with the number of requests and 304 answers of every mode.
+    '''
+    content = congestions.to_csv(sep='#', header=False, index=False).encode()
+    changed_content = fake_congestions(highways, 1, congestions, changed=0.1).to_csv(sep='#', header=False,
+                                                                                       index=False).encode()
+
+    def parse(feed):
+        return igo.parse_feed(feed, sep='#', names=igo.CONGESTIONS_COLUMNS)
+
+    results = {}
+    for mode in ('etag', 'last_modified'):
+        server = FeedServer(content, mode)
+        # every mode has its own copies, so the first fetch always downloads the feed
+        mode_directory = os.path.join(directory, mode)
+        try:
+            feed = feeds.fetch(server.url, mode_directory)
+            assert feed.changed and not feed.stale and feed.content == content, f"{mode}: first fetch"
+            parsed = parse(feed)
+
+            feed = feeds.fetch(server.url, mode_directory)
+            assert server.not_modified == 1, f"{mode}: the second fetch was not answered with 304"
+            assert not feed.changed and feed.content == content, f"{mode}: the second fetch changed"
+            assert parse(feed) is parsed, f"{mode}: the feed was parsed again"
+
+            server.update(changed_content)
+            feed = feeds.fetch(server.url, mode_directory)
+            assert feed.changed and feed.content == changed_content, f"{mode}: the new content was not downloaded"
+            parsed = parse(feed)
+            assert len(parsed) == len(congestions), f"{mode}: the new content was not parsed"
+
+            server.mode = 'none'
+            feed = feeds.fetch(server.url, mode_directory)
+            assert not feed.changed and parse(feed) is parsed, f"{mode}: the same content was parsed again"
+
+            server.mode = 'down'
+            feed = feeds.fetch(server.url, mode_directory)
+            assert feed.stale and feed.content == changed_content, f"{mode}: the last good copy was not used (503)"
+            results[mode] = {'requests': server.requests, 'not_modified': server.not_modified}
+        finally:
+            server.shutdown()
+
+        feed = feeds.fetch(server.url, mode_directory, timeout=(1, 1))
+        assert feed.stale and feed.content == changed_content, f"{mode}: the last good copy was not used (no server)"
+
+    # without a copy, the errors are raised
+    try:
+        feeds.fetch(server.url, os.path.join(directory, 'empty'), timeout=(1, 1))
+        raise AssertionError("a feed that could never be fetched did not fail")
+    except requests.RequestException:
+        pass
+    return results
+
+
+def measure(function, repeat, memory=True):
+    '''
+    Calls function() repeat times and returns its statistics: number of runs, mean, percentiles, minimum and
+    maximum of the times (in seconds), and the peak of memory allocated (in bytes, see tracemalloc) in one more run.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    statistics = {'runs': repeat, 'mean': float(np.mean(times)), 'min': float(np.min(times)),
+                  'p50': float(np.percentile(times, 50)), 'p90': float(np.percentile(times, 90)),
+                  'p99': float(np.percentile(times, 99)), 'max': float(np.max(times))}
+
+    # tracemalloc slows down the code, so the memory is measured apart
+    if memory:
+        tracemalloc.start()
+        function()
+        statistics['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return statistics
+
+
+def run(arguments):
+    '''Runs the benchmark with the given arguments (see main) and returns the results (dict).'''
+    generate = grid_graph if arguments.graph == 'grid' else planar_graph
+    graph = generate(arguments.nodes, arguments.seed)
+    highways, congestions = fake_feeds(graph, arguments.trams, arguments.seed)
+    changed_congestions = fake_congestions(highways, arguments.seed + 1, congestions, changed=0.1)
+    stages = arguments.stages or STAGES
+
+    rng = np.random.default_rng(arguments.seed)
+    ys = np.array([y for _, y in graph.nodes(data='y')])
+    xs = np.array([x for _, x in graph.nodes(data='x')])
+    points = np.c_[rng.uniform(ys.min(), ys.max(), 2 * arguments.queries),
+                   rng.uniform(xs.min(), xs.max(), 2 * arguments.queries)]
+    pairs = [(tuple(points[i]), tuple(points[arguments.queries + i])) for i in range(arguments.queries)]
+
+    def per_query(function):
+        # every run of the stage is a different query
+        queries = iter(pairs * (arguments.repeat // len(pairs) + 2))
+        return lambda: function(*next(queries))
+
+    results = {}
+    repeat = arguments.repeat
+
+    igo.get_initial_itime(graph)
+    if 'get_initial_itime' in stages:
+        results['get_initial_itime'] = measure(lambda: igo.get_initial_itime(graph), repeat, arguments.memory)
+
+    if 'to_csr' in stages:
+        results['to_csr'] = measure(lambda: routing.CSRGraph.from_networkx(graph), repeat, arguments.memory)
+    csr = igo.get_csr(graph)
+    igo.get_node_index(csr)
+
+    if 'build_cch' in stages:
+        results['build_cch'] = measure(lambda: cch.ContractionHierarchy.build(csr), 1, arguments.memory)
+        csr.hierarchy = cch.ContractionHierarchy.build(csr)
+
+    if 'tram_geometries' in stages:
+        results['tram_geometries'] = measure(lambda: igo.TramGeometries.from_highways(highways), repeat,
+                                             arguments.memory)
+
+    if 'build_trams_index' in stages:
+        results['build_trams_index'] = measure(lambda: igo.build_trams_index(csr, highways), repeat, arguments.memory)
+
+    igraph = igo.build_igraph(csr, highways, congestions)  # it builds the trams index once
+    if 'build_igraph' in stages:
+        results['build_igraph'] = measure(lambda: igo.build_igraph(csr, highways, congestions), repeat,
+                                          arguments.memory)
+    if 'build_igraph_incremental' in stages:
+        results['build_igraph_incremental'] = measure(
+            lambda: igo.build_igraph(csr, highways, changed_congestions, igraph), repeat, arguments.memory)
+
+    if 'customize_cch' in stages and csr.hierarchy is not None:
+        results['customize_cch'] = measure(lambda: csr.hierarchy.customize(igraph.itime), repeat, arguments.memory)
+
+    if 'nearest_node' in stages:
+        results['nearest_node'] = measure(per_query(lambda origin, destination: routing.nearest_node(igraph, origin)),
+                                          repeat, arguments.memory)
+    if 'nearest_nodes_batch' in stages:
+        results['nearest_nodes_batch'] = measure(lambda: routing.nearest_nodes(igraph, points[:, 0], points[:, 1]),
+                                                 repeat, arguments.memory)
+
+    def route(origin, destination, search):
+        try:
+            return search(routing.nearest_node(igraph, origin), routing.nearest_node(igraph, destination))
+        except routing.NoPath:
+            return None
+
+    # the searches of routing.search, with the mean number of nodes they settle
+    for method in routing.SEARCH_METHODS:
+        stage = f'shortest_path_{method}'
+        if stage not in stages:
+            continue
+        if method == 'alt':
+            igo.get_landmarks(igraph)
+        settled = []
+
+        def search(source, target, method=method, settled=settled):
+            route, count = routing.search(igraph, source, target, method=method)
+            settled.append(count)
+            return route
+
+        results[stage] = measure(per_query(lambda o, d: route(o, d, search)), repeat, arguments.memory)
+        results[stage]['settled'] = float(np.mean(settled)) if settled else 0.0
+    if 'shortest_path_cch' in stages and igraph.metric is not None:
+        results['shortest_path_cch'] = measure(per_query(lambda o, d: route(o, d, igraph.metric.shortest_path)),
+                                               repeat, arguments.memory)
+
+    # the maps are rendered with a local tile server, and the route cache is disabled so every query is computed
+    tile_server = TileServer()
+    tiles.TILE_URL_TEMPLATE = tile_server.url_template
+    igo.ROUTE_CACHE.max_entries = 0
+
+    def get_shortest_path_with_itimes(origin, destination):
+        try:
+            image_filename, aprox_time, distance = igo.get_shortest_path_with_itimes(igraph, origin, destination)
+            os.remove(image_filename)
+        except routing.NoPath:
+            pass
+
+    if 'get_shortest_path_with_itimes' in stages:
+        results['get_shortest_path_with_itimes'] = measure(per_query(get_shortest_path_with_itimes), repeat,
+                                                           arguments.memory)
+    if 'render_location' in stages:
+        results['render_location'] = measure(per_query(lambda origin, destination: igo.render_location(origin)),
+                                             repeat, arguments.memory)
+    if 'plot_congestions' in stages:
+        results['plot_congestions'] = measure(
+            lambda: igo.plot_congestions(highways, congestions, 'congestions.png', igo.SIZE), repeat, arguments.memory)
+    tile_server.shutdown()
+
+    if 'travel_matrices' in stages:
+        size = arguments.matrix_size
+        results['travel_matrices'] = measure(
+            lambda: igo.get_travel_matrices(igraph, points[:size], points[-size:]), max(1, repeat // 10),
+            arguments.memory)
+
+    return {'config': vars(arguments),
+            'graph': {'nodes': csr.number_of_nodes(), 'edges': csr.number_of_edges(), 'trams': len(highways)},
+            'platform': {'python': platform.python_version(), 'machine': platform.machine(),
+                         'cpus': os.cpu_count()},
+            'stages': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures the main stages of iGo on a synthetic city, without network access. '
+                    'The results are written as JSON (times in seconds, memory in bytes).')
+    parser.add_argument('--graph', choices=['grid', 'planar'], default='grid', help='kind of synthetic city')
+    parser.add_argument('--nodes', type=int, default=2500, help='number of intersections (Barcelona has ~10000)')
+    parser.add_argument('--trams', type=int, default=500, help='number of highways of the fake feeds')
+    parser.add_argument('--repeat', type=int, default=20, help='number of runs of every stage')
+    parser.add_argument('--queries', type=int, default=20, help='number of different random routes')
+    parser.add_argument('--matrix-size', type=int, default=100, help='origins and destinations of travel_matrices')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='*', choices=STAGES, help='stages to measure (all by default)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='do not measure the memory')
+    parser.add_argument('--output', help='file where the results are written (standard output by default)')
+    parser.add_argument('--check-feeds', action='store_true',
+                        help='instead of measuring, check the fetches of the feeds against a local stand-in server')
+    arguments = parser.parse_args()
+
+    # all the files (trams index, tiles...) are written in a temporary directory
+    output = os.path.abspath(arguments.output) if arguments.output else None
+    directory = tempfile.mkdtemp(prefix='igo-benchmark-')
+    current_directory = os.getcwd()
+    os.chdir(directory)
+    tiles.TILE_CACHE = tiles.TileCache(directory=os.path.join(directory, 'tiles'))
+    try:
+        if arguments.check_feeds:
+            highways, congestions = fake_feeds(grid_graph(arguments.nodes, arguments.seed), arguments.trams,
+                                               arguments.seed)
+            results = {'feeds': check_feeds(highways, congestions)}
+        else:
+            results = run(arguments)
+    finally:
+        os.chdir(current_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
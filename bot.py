@@ -1,8 +1,14 @@
 from igo import *
-from threading import Timer
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-import os
+from scheduler import Scheduler, WorkerProcess
+from service import RoutingPool, PoolBusy
+from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from datetime import datetime
+import os
+import time
+import asyncio
+import logging
+import metrics
+import users
 
 # Messages sent by the bot
 START = '''Hi there! I'm iGo DJ, your favorite GPS from Barcelona (Spain)! 🤠
@@ -40,42 +46,93 @@ WARNING_GO = '''Error 💣 Please make sure you give the correct and precise nam
                 '''
 MISSING_USER_LOC = '''Error: Missing user location.
 Please send us your location before using /go or /where, to do so you can press the safety pin icon and select the location.'''
+BUSY = "Sorry, I'm finding a lot of routes right now 🚦 Please try again in a few seconds."
+USER_BUSY = "I'm still working on your previous request ⏳ Please wait for it before asking again."
 
-WAIT_TIME_SECONDS = 300  # number of seconds between each update of the igraph
+# Number of seconds between each update of the igraph, and maximum random variation of that time
+# (they can be changed with the environment variables IGO_UPDATE_INTERVAL and IGO_UPDATE_JITTER)
+WAIT_TIME_SECONDS = float(os.environ.get('IGO_UPDATE_INTERVAL', 300))
+WAIT_TIME_JITTER = float(os.environ.get('IGO_UPDATE_JITTER', 15))
 
-# Global variables
-GRAPH = get_graph()
+# Maximum number of requests (/go and /where) in course of every user and of all of them (see RequestLimits)
+MAX_USER_REQUESTS = 2
+MAX_REQUESTS = 64
+
+# Global variables (see main)
+GRAPH = None
 iGRAPH = None
+UPDATE_SCHEDULER = None
+ROUTING_POOL = None  # the routes are found and plotted by its worker processes
+
+# Locations of the users, shared by all the processes of the bot (see users module)
+USER_STORE = users.open_user_store()
+
+# Time to answer every command (see metrics module)
+REQUEST_SECONDS = metrics.histogram('igo_request_seconds', 'Time to answer the commands of the bot (seconds)',
+                                    'command')
+
+# The igraphs are built in this worker process, so the updates do not slow down the requests
+UPDATE_WORKER = WorkerProcess()
+
+
+class RequestLimits:
+    '''
+    Counts the requests in course of every user and of all of them, so a user cannot take all the workers and the bot
+    does not accept more requests than it can answer. It is only used from the event loop, so it needs no locks.
+    '''
+
+    def __init__(self, max_user_requests=MAX_USER_REQUESTS, max_requests=MAX_REQUESTS):
+        self.max_user_requests = max_user_requests
+        self.max_requests = max_requests
+        self.requests = 0
+        self.user_requests = {}  # user ID -> number of requests in course
+
+    def acquire(self, user):
+        '''
+        Starts a request of the given user. Returns None if it can go on, otherwise the message for the user
+        (USER_BUSY or BUSY). Every accepted request must be finished with release.
+        '''
+        if self.user_requests.get(user, 0) >= self.max_user_requests:
+            return USER_BUSY
+        if self.requests >= self.max_requests:
+            return BUSY
+        self.user_requests[user] = self.user_requests.get(user, 0) + 1
+        self.requests += 1
+        return None
+
+    def release(self, user):
+        self.requests -= 1
+        self.user_requests[user] -= 1
+        if self.user_requests[user] == 0:
+            del self.user_requests[user]
 
-# Necessary items to work with Telegram
-TOKEN = open('token.txt').read().strip()
-updater = Updater(token=TOKEN, use_context=True)
-dispatcher = updater.dispatcher
 
+REQUEST_LIMITS = RequestLimits()
 
-def start(update, context):
+
+async def start(update, context):
     '''
     Gives a warm welcome to the user and gives him further instructions such
     as sending his location before using any functionality.
     '''
-    context.bot.send_message(chat_id=update.effective_chat.id, text=START)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=START)
 
 
-def help(update, context):
+async def help(update, context):
     '''Explains what the bot can do for the user.'''
-    context.bot.send_message(chat_id=update.effective_chat.id, text=HELP)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=HELP)
 
 
-def author(update, context):
+async def author(update, context):
     '''Shows to the user the authors of the bot.'''
-    context.bot.send_message(chat_id=update.effective_chat.id, text=AUTHORS)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=AUTHORS)
 
 
-def go(update, context):
+async def go(update, context):
     '''
     Given the command /go followed by a destination, either in the format of an address or with the coordinates,
     returns information about the shortest path from the user's current location to the given destination.
-    More precisely, the bot sends:
+    More precisely, the bot sends a single message with:
     1) An image with the route the costumer has to follow.
     2) The estimate time it takes to get to the destination.
     3) The estimate time arrival.
@@ -84,76 +141,111 @@ def go(update, context):
     '''
     # This print is for testing purposes, uncomment it in order to see when this command is being executed
     # print("Starting command /go...")
+    start_time = time.perf_counter()
 
     # Check we have the current user location
-    try:
-        user_lat, user_lon = context.user_data['user_location']
-    except:
-        context.bot.send_message(chat_id=update.effective_chat.id, text=MISSING_USER_LOC)
+    # The store can wait for its database, so it is read in another thread (like all the uses of USER_STORE)
+    user = update.effective_user.id
+    location = await asyncio.to_thread(USER_STORE.get_location, user)
+    if location is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=MISSING_USER_LOC)
         print("Missing current user location on command /go")
         return
+    user_lat, user_lon = location
 
-    try:
-        lat, lon = query_to_location("/go", update, context)
-        path_image, aprox_time, distance = get_shortest_path_with_itimes(iGRAPH,
-                                                                         (user_lat, user_lon),
-                                                                         (lat, lon))
-    except:
-        print("---Error in /go query---")
-        context.bot.send_message(chat_id=update.effective_chat.id, text=WARNING_GO)
+    refusal = REQUEST_LIMITS.acquire(user)
+    if refusal is not None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=refusal)
         return
 
-    # Sends picture of the path and deletes it from the directory
-    context.bot.send_photo(chat_id=update.effective_chat.id, photo=open(path_image, 'rb'))
-    os.remove(path_image)
+    try:
+        # We take the current igraph once, so the whole request uses the same version even if it is updated meanwhile
+        igraph = iGRAPH
+
+        # The geocoding can wait for the network, and the route is found by a worker process (see service module),
+        # so the event loop keeps answering the other users meanwhile. The points are snapped in a thread too.
+        # The igraph was already published by update_igraph, so no snapshot is written here.
+        try:
+            lat, lon = await asyncio.to_thread(query_to_location, "/go", update, context)
+            job = await asyncio.to_thread(ROUTING_POOL.submit, igraph, (user_lat, user_lon), (lat, lon))
+            path_image, aprox_time, distance = await asyncio.wrap_future(job)
+        except PoolBusy:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=BUSY)
+            return
+        except:
+            print("---Error in /go query---")
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=WARNING_GO)
+            return
+
+        # Sends picture of the path directly from memory, with all the information in its caption
+        with STAGE_SECONDS.time('telegram_send'):
+            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=path_image,
+                                         caption=route_caption(aprox_time, distance))
+    finally:
+        REQUEST_LIMITS.release(user)
+
+    REQUEST_SECONDS.observe('go', time.perf_counter() - start_time)
 
+    # This print is for testing purposes, uncomment it in order to see when this command is being executed
+    # print("...Command /go finished")
+
+
+def route_caption(aprox_time, distance):
+    '''
+    Returns the text sent with the image of a route (see go): the estimate time, the estimate time arrival,
+    the distance to the destination and the colors of the map.
+    Input: aprox_time (datetime.timedelta) and distance (in meters).
+    '''
     # Gives the estimate time
     if aprox_time.seconds//3600 == 0:  # estimate time is less than an hour
         str_aprox_time = "Estimated time: {:d} minutes".format(aprox_time.seconds//60)
     else:
         str_aprox_time = "Estimated time: {:d} hours and {:02d} minutes".format(aprox_time.seconds//3600,
-                                                                                aprox_time.seconds//60)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=str_aprox_time)
+                                                                                aprox_time.seconds//60 % 60)
 
     # Gives the estimate time arrival
     aprox_arrival = datetime.now() + aprox_time
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="Estimated time arrival: {:d}:{:02d}".format(aprox_arrival.hour,
-                                                                               aprox_arrival.minute))
+    str_aprox_arrival = "Estimated time arrival: {:d}:{:02d}".format(aprox_arrival.hour, aprox_arrival.minute)
 
     # Gives the distance to the destination
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f"Distance: {round(distance/1000, 1)} km")
+    str_distance = f"Distance: {round(distance/1000, 1)} km"
 
     # Gives further information about the colors of the map
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f"Origin          ➡️ {ORIGIN_COLOR} \nDestination ➡️ {DESTINATION_COLOR}")
+    str_colors = f"Origin          ➡️ {ORIGIN_COLOR} \nDestination ➡️ {DESTINATION_COLOR}"
 
-    # This print is for testing purposes, uncomment it in order to see when this command is being executed
-    # print("...Command /go finished")
-    return
+    return '\n'.join([str_aprox_time, str_aprox_arrival, str_distance, str_colors])
 
 
-def where(update, context):
+async def where(update, context):
     '''
     Sends an image of the current user's location in the map.
     If the user has not given its location it sends an error message to the user.
     '''
-    try:
-        image_filename = get_location_image(context.user_data['user_location'])
+    user = update.effective_user.id
+    location = await asyncio.to_thread(USER_STORE.get_location, user)
+    if location is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=MISSING_USER_LOC)
+        return
 
-        # Sends picture of the location and deletes it from the directory
-        context.bot.send_photo(chat_id=update.effective_chat.id,
-                               photo=open(image_filename, 'rb'))
-        os.remove(image_filename)
+    refusal = REQUEST_LIMITS.acquire(user)
+    if refusal is not None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=refusal)
+        return
+
+    try:
+        with REQUEST_SECONDS.time('where'):
+            # The map is rendered in another thread, so the event loop keeps answering the other users meanwhile
+            image = await asyncio.to_thread(render_location, location)
 
+            # Sends picture of the location directly from memory
+            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=image)
     except:
-        context.bot.send_message(chat_id=update.effective_chat.id, text=MISSING_USER_LOC)
-    return
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=MISSING_USER_LOC)
+    finally:
+        REQUEST_LIMITS.release(user)
 
 
-def pos(update, context):
+async def pos(update, context):
     '''
     This method is for testing purposes, is called sending /pos location to the bot,
     it will save a fictitious user's location, specified by location.
@@ -161,24 +253,28 @@ def pos(update, context):
     '''
 
     try:
-        context.user_data['user_location'] = query_to_location("/pos", update, context)
+        location = await asyncio.to_thread(query_to_location, "/pos", update, context)
+        await asyncio.to_thread(USER_STORE.set_location, update.effective_user.id, location)
     except:
         print("Error with the position given by command /pos")
     return
 
 
-def user_location(update, context):
+async def user_location(update, context):
     '''
     This method is called every time the user sends a new location. It is adapted to work
-    with static and dynamic location and it saves it.
+    with static and dynamic location and it saves it (see USER_STORE).
     '''
 
     # Takes the message of the user.
     # If its dynamic, the updates are considered as an edition of the message.
     message = update.edited_message if update.edited_message else update.message
 
-    # Takes the location from the message and saves it.
-    context.user_data['user_location'] = message.location.latitude, message.location.longitude
+    # Takes the location from the message and saves it. The live locations are sent again every few seconds,
+    # so they are written in batches.
+    live = update.edited_message is not None or message.location.live_period is not None
+    await asyncio.to_thread(USER_STORE.set_location, update.effective_user.id,
+                            (message.location.latitude, message.location.longitude), live)
 
 
 def filter_coordinates(x):
@@ -192,6 +288,7 @@ def query_to_location(command, update, context):
     '''
     Converts the given location by the user into a tuple of coordinates (latitude, longitude).
     The command can be "/go", "/pos", or another one if it uses this method.
+    It can wait for the geocoder, so the bot calls it in another thread (see go).
     '''
 
     # This print is for testing purposes, uncomment it in order to see when this command is being executed
@@ -218,47 +315,125 @@ def query_to_location(command, update, context):
     return lat, lon
 
 
-def update_igraph():
+def update_igraph(highways=None, congestions=None):
     '''
-    This method is called every 5 minutes in another thread in order to make the bot fluid while the
-    igraph is updating. It updates the igraph with the newest highways and congestions information.
+    This method is called every 5 minutes by the UPDATE_SCHEDULER thread in order to make the bot fluid while the
+    igraph is updating. It updates the igraph with the newest highways and congestions information,
+    or with the given ones (see igo.refresh_igraph and replay.py).
     '''
     # This print is for testing purposes, uncomment it in order to see when this command is being executed
     # print("Updating the igraph")
 
     global iGRAPH
 
-    iGRAPH = get_igraph(GRAPH)
+    # The igraph is built in the worker process. Only the edges of the trams whose congestion changed since
+    # its last igraph are updated, and if the feeds did not change there is nothing to do.
+    with STAGE_SECONDS.time('update_igraph'):
+        arrays, observations = UPDATE_WORKER.call(metrics.collecting, refresh_igraph, highways, congestions)
+    metrics.merge(observations)
+    if arrays is None:
+        return
+
+    # The new igraph shares the graph and only has its own itime, so replacing the reference is an atomic swap:
+    # the /go requests in course keep the igraph they took, and the next ones use the new version.
+    igraph = adopt_igraph(GRAPH, arrays)
+
+    # The weights are saved for the routing workers before the swap, so the new requests can use them
+    ROUTING_POOL.publish(igraph)
+    iGRAPH = igraph
+
+    # The cached routes of the previous igraph are not valid anymore
+    ROUTE_CACHE.publish(iGRAPH.version)
 
     # This print is for testing purposes, uncomment it in order to see when this command is being executed
     # print("Igraph updated")
 
-    # This commands sets a task that will be executed in background every 5 minutes. The task is the method itself,
-    # so it will update the graph every 5 minutes.
-    Timer(WAIT_TIME_SECONDS, update_igraph).start()
 
+async def status(update, context):
+    '''
+    This method is for testing purposes, is called sending /status to the bot.
+    It sends the version of the igraph, when it was updated for the last time and how many trams and edges changed.
+    '''
+    state = UPDATE_SCHEDULER.status()
+    if state['last_success'] is None:
+        text = f"igraph version {iGRAPH.version}, not updated yet"
+        if iGRAPH.congestion is not None:
+            text += " (congestions of {:%d/%m %H:%M})".format(datetime.fromtimestamp(iGRAPH.congestion['built']))
+    else:
+        text = "igraph version {:d}, updated at {:%H:%M:%S} in {:.1f} seconds".format(
+            iGRAPH.version, datetime.fromtimestamp(state['last_success']), state['last_duration'])
+        if iGRAPH.congestion is not None and 'changed_trams' in iGRAPH.congestion:
+            text += f" ({iGRAPH.congestion['changed_trams']} trams and {iGRAPH.congestion['changed_edges']} edges changed)"
+    if state['failures'] > 0:
+        text += f" ({state['failures']} failed updates: {state['last_error']})"
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+
+def main():
+    '''Loads the graph, starts the updates of the igraph and turns on the bot.'''
+    global GRAPH, iGRAPH, UPDATE_SCHEDULER, ROUTING_POOL
+
+    # The metrics can be read in http://127.0.0.1:9108/metrics, and they are logged every 5 minutes
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s', level=logging.INFO)
+    metrics.start_server()
+    metrics.start_log()
+
+    GRAPH = get_graph()
+
+    # Until the first update finishes (in the background), the routes use the last igraph built before the bot was
+    # stopped (its congestions can be a bit old), or the initial itime, without congestions, if there is none.
+    iGRAPH = load_latest_igraph(GRAPH)
+    if iGRAPH is None:
+        GRAPH.metric = GRAPH.hierarchy.customize(GRAPH.itime)
+        iGRAPH = GRAPH
+    ROUTING_POOL = RoutingPool()
+    ROUTING_POOL.publish(iGRAPH)
 
-# The first time the igraph must be updated "manually". Then, the Timer, updates it every 5 minutes.
-update_igraph()
+    # The scheduler updates the igraph now and then every 5 minutes, one update at a time.
+    # If an update fails, it is retried sooner.
+    UPDATE_SCHEDULER = Scheduler(update_igraph, WAIT_TIME_SECONDS, WAIT_TIME_JITTER, name='update_igraph').start()
+
+    # turns on the bot
+    token = open('token.txt').read().strip()
+    build_application(token).run_polling()
+
+    # the live locations that are not written yet are saved for the next time
+    USER_STORE.close()
+
+
+def build_application(token, base_url=None):
+    '''
+    Returns the telegram Application of the bot with the given token, with all its handlers.
+    base_url is the address of the Bot API (https://api.telegram.org/bot by default), replay.py gives a fake one.
+    '''
+    # Necessary items to work with Telegram. The updates are answered concurrently by the event loop,
+    # up to the limits of REQUEST_LIMITS.
+    builder = Application.builder().token(token).concurrent_updates(True)
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
+    # Indicates the bot will execute the specified methods (second parameter)
+    # when it receives the message /command (first parameter)
+    application.add_handler(CommandHandler('start', start))
 
-# Indicates the bot will execute the specified methods (second parameter)
-# when it receives the message /command (first parameter)
-dispatcher.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('help', help))
 
-dispatcher.add_handler(CommandHandler('help', help))
+    application.add_handler(CommandHandler('author', author))
 
-dispatcher.add_handler(CommandHandler('author', author))
+    application.add_handler(CommandHandler('go', go))
 
-dispatcher.add_handler(CommandHandler('go', go))
+    application.add_handler(CommandHandler('where', where))
 
-dispatcher.add_handler(CommandHandler('where', where))
+    application.add_handler(CommandHandler('pos', pos))
 
-dispatcher.add_handler(CommandHandler('pos', pos))
+    application.add_handler(CommandHandler('status', status))
 
-# Indicates the bot must execute user_location method when it receives a location
-dispatcher.add_handler(MessageHandler(Filters.location, user_location))
+    # Indicates the bot must execute user_location method when it receives a location
+    application.add_handler(MessageHandler(filters.LOCATION, user_location))
+    return application
 
 
-# turns on the bot
-updater.start_polling()
+# The worker process imports this module too, so the bot is only turned on when it is executed
+if __name__ == "__main__":
+    main()
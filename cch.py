@@ -0,0 +1,351 @@
+from array import array
+import numpy as np
+import routing
+
+INFINITE_WEIGHT = float('inf')
+HIERARCHY_ARRAYS = ['rank', 'up_indptr', 'up_heads', 'edge_low', 'parent', 'arc_edge', 'arc_up',
+                    'tri_a', 'tri_b', 'tri_c', 'level_ptr']
+
+
+class ContractionHierarchy:
+    '''
+    Customizable contraction hierarchy (CCH) of a CSRGraph. It is built in two phases:
+       1) Preprocessing (build), which only depends on the topology of the graph: the nodes are contracted
+          in nested dissection order and every contraction adds the shortcuts between the neighbors of the node.
+       2) Customization (customize), which computes the weights of the edges of the hierarchy for the given
+          edge weights of the graph (the itime of the igraph). It is cheap, so it can be done after every
+          update of the congestions.
+    The hierarchy is an undirected graph: the edge {x, y}, with rank[x] < rank[y], is stored once as an
+    upward edge of x, and has two weights, "up" (from x to y) and "down" (from y to x).
+    Attributes:
+           - rank: int32 array with the position of every node in the contraction order.
+           - up_indptr, up_heads: CSR layout of the upward edges of every node (edge e goes from edge_low[e] to up_heads[e]).
+           - edge_low: int32 array with the lower end of every edge.
+           - parent: int32 array with the parent of every node in the elimination tree (its lowest upward neighbor, -1 for roots).
+           - arc_edge, arc_up: the edge of the hierarchy of every edge (arc) of the graph (-1 for loops),
+             and whether it goes from the lower end to the higher end.
+           - tri_a, tri_b, tri_c: the triangles {x, u, v} of the hierarchy, rank[x] < rank[u] < rank[v], given by their
+             edges a = {x, u}, b = {x, v}, c = {u, v}, and sorted by the level of x (see build).
+           - level_ptr: the triangles of level l are the positions level_ptr[l]..level_ptr[l+1]-1.
+    '''
+
+    def __init__(self, rank, up_indptr, up_heads, edge_low, parent, arc_edge, arc_up, tri_a, tri_b, tri_c, level_ptr):
+        self.rank = rank
+        self.up_indptr = up_indptr
+        self.up_heads = up_heads
+        self.edge_low = edge_low
+        self.parent = parent
+        self.arc_edge = arc_edge
+        self.arc_up = arc_up
+        self.tri_a = tri_a
+        self.tri_b = tri_b
+        self.tri_c = tri_c
+        self.level_ptr = level_ptr
+
+    @classmethod
+    def build(cls, csr):
+        '''
+        Builds the hierarchy (metric independent) of the given graph.
+        Input: CSRGraph (see routing module).
+        Output: ContractionHierarchy.
+        '''
+        n = csr.number_of_nodes()
+        tails = np.repeat(np.arange(n, dtype=np.int32), np.diff(csr.indptr))
+        heads = csr.indices
+
+        # we get the undirected graph, without loops
+        neighbors = [set() for _ in range(n)]
+        for u, v in zip(tails.tolist(), heads.tolist()):
+            if u != v:
+                neighbors[u].add(v)
+                neighbors[v].add(u)
+
+        # we contract the nodes in nested dissection order (see dissection_order). When a node is contracted,
+        # all its remaining neighbors become connected (these are the shortcuts).
+        order = dissection_order(neighbors, csr.x, csr.y)
+        rank = np.empty(n, dtype=np.int32)
+        rank[order] = np.arange(n, dtype=np.int32)
+        upward = [None] * n
+        for x in order.tolist():
+            upward[x] = neighbors[x]
+            for u in upward[x]:
+                neighbors[u].discard(x)
+                neighbors[u].update(upward[x])
+                neighbors[u].discard(u)
+            neighbors[x] = None
+
+        # we number the edges of the hierarchy, the upward edges of every node sorted by rank
+        rank_list = rank.tolist()
+        upward = [sorted(upward[x], key=lambda y: rank_list[y]) for x in range(n)]
+        up_indptr = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum([len(upward[x]) for x in range(n)], out=up_indptr[1:])
+        up_heads = np.array([y for x in range(n) for y in upward[x]], dtype=np.int32)
+        edge_low = np.repeat(np.arange(n, dtype=np.int32), np.diff(up_indptr))
+        edge_id = {(x, y): e for e, (x, y) in enumerate(zip(edge_low.tolist(), up_heads.tolist()))}
+        parent = np.array([upward[x][0] if upward[x] else -1 for x in range(n)], dtype=np.int32)
+
+        # every arc of the graph is an edge of the hierarchy
+        arc_up = rank[tails] < rank[heads]
+        arc_edge = np.array([edge_id[(u, v)] if up else (edge_id[(v, u)] if u != v else -1)
+                             for u, v, up in zip(tails.tolist(), heads.tolist(), arc_up.tolist())], dtype=np.int64)
+
+        # we enumerate the triangles {x, u, v} from their lowest node x. The level of a node is 0 if it has no
+        # lower neighbors and 1 + the maximum level of its lower neighbors otherwise, so the edges of a triangle
+        # whose x is at level l only get their final weight from triangles of lower levels.
+        level = [0] * n
+        tri_level, tri_a, tri_b, tri_c = array('i'), array('i'), array('i'), array('i')
+        for x in np.argsort(rank).tolist():
+            up_x = upward[x]
+            for i, u in enumerate(up_x):
+                level[u] = max(level[u], level[x] + 1)
+                a = edge_id[(x, u)]
+                for v in up_x[i+1:]:
+                    tri_level.append(level[x])
+                    tri_a.append(a)
+                    tri_b.append(edge_id[(x, v)])
+                    tri_c.append(edge_id[(u, v)])
+
+        tri_level = np.frombuffer(tri_level, dtype=np.int32)
+        order = np.argsort(tri_level, kind='stable')
+        levels = max(level, default=0) + 1
+        level_ptr = np.zeros(levels + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tri_level, minlength=levels), out=level_ptr[1:])
+
+        return cls(rank, up_indptr, up_heads, edge_low, parent, arc_edge, arc_up,
+                   np.frombuffer(tri_a, dtype=np.int32)[order], np.frombuffer(tri_b, dtype=np.int32)[order],
+                   np.frombuffer(tri_c, dtype=np.int32)[order], level_ptr)
+
+    def save(self, filename, metadata=None):
+        '''
+        Saves the hierarchy into the given filename (see routing.save_arrays), with the given metadata.
+        The file is replaced atomically, so the processes that have the previous one memory-mapped are not affected.
+        '''
+        routing.save_arrays(filename, {name: getattr(self, name) for name in HIERARCHY_ARRAYS}, metadata)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Loads the hierarchy saved in the given filename, memory-mapped (see routing.load_arrays).
+        Output: ContractionHierarchy and the dict with its metadata.
+        Raises ValueError if the file is not a hierarchy saved with save (see routing.load_arrays).
+        '''
+        arrays, metadata = routing.load_arrays(filename)
+        missing = [name for name in HIERARCHY_ARRAYS if name not in arrays]
+        if missing:
+            raise ValueError(f"'{filename}' is not a contraction hierarchy, it has no {', '.join(missing)}")
+        return cls(*[arrays[name] for name in HIERARCHY_ARRAYS]), metadata
+
+    def number_of_nodes(self):
+        return len(self.rank)
+
+    def number_of_edges(self):
+        return len(self.up_heads)
+
+    def ancestors(self, node):
+        '''
+        Returns the ancestors of the node in the elimination tree, from the node itself to the root.
+        They are the nodes the upward searches from the node can reach.
+        '''
+        parent = memoryview(self.parent)
+        ancestors = []
+        while node != -1:
+            ancestors.append(node)
+            node = parent[node]
+        return ancestors
+
+    def customize(self, weights):
+        '''
+        Returns the Metric of the hierarchy for the given weights of the arcs of the graph (for instance, its itime).
+        Input: array with the weight of every edge of the CSRGraph the hierarchy was built from.
+        Output: Metric.
+        '''
+        weights = np.asarray(weights, dtype=np.float64)
+        k = self.number_of_edges()
+        up = np.full(k, INFINITE_WEIGHT)
+        down = np.full(k, INFINITE_WEIGHT)
+
+        # the edges of the hierarchy that are arcs of the graph get their weight
+        arcs_up = (self.arc_edge >= 0) & self.arc_up
+        arcs_down = (self.arc_edge >= 0) & ~self.arc_up
+        np.minimum.at(up, self.arc_edge[arcs_up], weights[arcs_up])
+        np.minimum.at(down, self.arc_edge[arcs_down], weights[arcs_down])
+
+        # the triangle (if any) used as the shortest way of every edge, to unpack the shortcuts
+        up_triangle = np.full(k, -1, dtype=np.int64)
+        down_triangle = np.full(k, -1, dtype=np.int64)
+
+        # for every triangle {x, u, v}, u -> x -> v may be shorter than u -> v (and v -> x -> u than v -> u).
+        # all the triangles of the same level are independent, so we process them at once.
+        for level in range(len(self.level_ptr) - 1):
+            first, last = self.level_ptr[level], self.level_ptr[level+1]
+            a, b, c = self.tri_a[first:last], self.tri_b[first:last], self.tri_c[first:last]
+
+            through_up = down[a] + up[b]
+            through_down = down[b] + up[a]
+            np.minimum.at(up, c, through_up)
+            np.minimum.at(down, c, through_down)
+
+            triangle = np.arange(first, last)
+            used = (through_up == up[c]) & (through_up < INFINITE_WEIGHT)
+            up_triangle[c[used]] = triangle[used]
+            used = (through_down == down[c]) & (through_down < INFINITE_WEIGHT)
+            down_triangle[c[used]] = triangle[used]
+
+        return Metric(self, up, down, up_triangle, down_triangle)
+
+
+def dissection_order(neighbors, x, y):
+    '''
+    Returns the nested dissection order of the nodes of the graph (int array with the nodes, first to last).
+    The nodes are split in two halves by the median of their longest coordinate (longitude or latitude), the
+    nodes of one half with neighbors in the other one (the separator) go last, and both halves are ordered the
+    same way. Road networks have small separators, so this order adds far fewer shortcuts than a greedy one.
+    Input: - neighbors: list with the set of neighbors of every node (undirected graph).
+           - x, y: arrays with the longitude and latitude of every node.
+    '''
+    order = []
+    part = np.zeros(len(neighbors), dtype=np.int64)  # the nodes of the part being split have the same number
+    next_part = 1
+    stack = [(np.arange(len(neighbors)), False)]
+    while stack:
+        nodes, is_separator = stack.pop()
+        if is_separator or len(nodes) <= 2:
+            order.extend(nodes.tolist())
+            continue
+
+        # we split the nodes by the median of their longest side
+        xs, ys = x[nodes], y[nodes]
+        width = (xs.max() - xs.min()) * np.cos(np.radians(ys.mean()))
+        coordinates = xs if width >= ys.max() - ys.min() else ys
+        by_coordinate = nodes[np.argsort(coordinates, kind='stable')]
+        left, right = by_coordinate[:len(nodes) // 2], by_coordinate[len(nodes) // 2:]
+
+        part[right] = next_part
+        part[left] = next_part + 1
+        next_part += 2
+        right_part = next_part - 2
+
+        # the separator is the smallest boundary between the two halves
+        left_boundary = np.array([u for u in left.tolist() if any(part[v] == right_part for v in neighbors[u])], dtype=np.int64)
+        right_boundary = np.array([u for u in right.tolist() if any(part[v] == right_part + 1 for v in neighbors[u])], dtype=np.int64)
+        if len(left_boundary) <= len(right_boundary):
+            separator = left_boundary
+            left = np.setdiff1d(left, separator, assume_unique=True)
+        else:
+            separator = right_boundary
+            right = np.setdiff1d(right, separator, assume_unique=True)
+
+        # the stack is a LIFO: the halves are ordered before the separator
+        stack.append((separator, True))
+        stack.append((right, False))
+        stack.append((left, False))
+
+    return np.array(order, dtype=np.int64)
+
+
+class Metric:
+    '''
+    Weights of a ContractionHierarchy for a given metric (see ContractionHierarchy.customize),
+    used to find shortest paths.
+    '''
+
+    def __init__(self, cch, up, down, up_triangle, down_triangle):
+        self.cch = cch
+        self.up = up
+        self.down = down
+        self.up_triangle = up_triangle
+        self.down_triangle = down_triangle
+
+    def shortest_path(self, source, target):
+        '''
+        Returns the shortest path from source to target (positions of the nodes of the graph).
+        Output: list of positions of the nodes of the path.
+        Raises routing.NoPath if target can not be reached from source.
+        '''
+        # both searches only go up in the hierarchy, they meet at the highest node of the path,
+        # which is a common ancestor of source and target in the elimination tree
+        forward_nodes, forward_dist, forward_pred = self._upward_search(source, self.up)
+        backward_nodes, backward_dist, backward_pred = self._upward_search(target, self.down)
+
+        common = np.intersect1d(forward_nodes, backward_nodes)
+        total = forward_dist[common] + backward_dist[common]
+        if len(common) == 0 or total.min() == INFINITE_WEIGHT:
+            raise routing.NoPath(f"No path from {source} to {target}")
+        meeting = int(common[np.argmin(total)])
+
+        # the edges of the hierarchy from source to the meeting node (going up), and from there to target (going down)
+        edges = []
+        node = meeting
+        while node != source:
+            edge = int(forward_pred[node])
+            edges.append((edge, True))
+            node = int(self.cch.edge_low[edge])
+        edges.reverse()
+        node = meeting
+        while node != target:
+            edge = int(backward_pred[node])
+            edges.append((edge, False))
+            node = int(self.cch.edge_low[edge])
+
+        route = [source]
+        for edge, going_up in edges:
+            route.extend(self._unpack(edge, going_up)[1:])
+        return route
+
+    def _upward_search(self, source, weights):
+        '''
+        Returns the nodes reached by the upward search from source (its ancestors), the array of distances from (or to)
+        source and the array with the edge used to reach every node.
+        '''
+        up_indptr = memoryview(self.cch.up_indptr)
+        up_heads = self.cch.up_heads
+        nodes = self.cch.ancestors(source)
+
+        dist = np.full(self.cch.number_of_nodes(), INFINITE_WEIGHT)
+        pred = np.full(self.cch.number_of_nodes(), -1, dtype=np.int64)
+        dist[source] = 0.0
+
+        # all the upward neighbors of a node are its ancestors, so visiting the ancestors from the bottom
+        # to the top settles them. The edges of every node are relaxed at once.
+        for x in nodes:
+            d = dist[x]
+            if d == INFINITE_WEIGHT:
+                continue
+            first, last = up_indptr[x], up_indptr[x+1]
+            heads = up_heads[first:last]
+            new_dist = weights[first:last] + d
+            better = np.flatnonzero(new_dist < dist[heads])
+            if len(better) > 0:
+                dist[heads[better]] = new_dist[better]
+                pred[heads[better]] = better + first
+
+        return np.array(nodes, dtype=np.int64), dist, pred
+
+    def _unpack(self, edge, going_up):
+        '''
+        Returns the path of the graph (list of node positions) represented by the given edge of the hierarchy.
+        '''
+        route = []
+        stack = [(edge, going_up)]
+        while stack:
+            edge, going_up = stack.pop()
+            low, high = int(self.cch.edge_low[edge]), int(self.cch.up_heads[edge])
+            triangle = self.up_triangle[edge] if going_up else self.down_triangle[edge]
+
+            if triangle == -1:  # it is an arc of the graph
+                start, end = (low, high) if going_up else (high, low)
+                if not route:
+                    route.append(start)
+                route.append(end)
+            else:  # it is a shortcut through the lowest node x of the triangle
+                a, b = self.cch.tri_a[triangle], self.cch.tri_b[triangle]
+                # low -> x -> high is "a" going down and "b" going up. high -> x -> low is "b" going down and "a" going up.
+                # the stack is a LIFO, so the second part of the path is pushed first.
+                if going_up:
+                    stack.append((b, True))
+                    stack.append((a, False))
+                else:
+                    stack.append((a, True))
+                    stack.append((b, False))
+
+        return route
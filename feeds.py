@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+import requests
+
+# Directory where the last good copy of every feed is kept, and maximum time (in seconds) to wait for a server
+FEEDS_DIRECTORY = 'feeds'
+FETCH_TIMEOUT = (5, 30)  # (connect, read)
+
+# Connections are reused between fetches
+SESSION = requests.Session()
+
+
+class Feed:
+    '''
+    Result of fetching a feed (see fetch).
+    Attributes:
+           - url: URL of the feed.
+           - content: bytes of the feed.
+           - digest: SHA-256 of the content (hexadecimal string).
+           - changed: False if the content is the same as the last time it was fetched.
+           - stale: True if the server could not be reached and the content is the last good copy.
+    '''
+
+    def __init__(self, url, content, digest, changed, stale=False):
+        self.url = url
+        self.content = content
+        self.digest = digest
+        self.changed = changed
+        self.stale = stale
+
+
+def fetch(url, directory=FEEDS_DIRECTORY, timeout=FETCH_TIMEOUT):
+    '''
+    Fetches the given URL, using the copy saved in the directory to avoid downloading it again if possible.
+    The request is conditional (ETag / If-Modified-Since headers), so the server answers 304 Not Modified
+    without the content if it has not changed. If it is downloaded, its SHA-256 tells if it really changed.
+    If the server can not be reached or it fails, the last good copy is returned (stale).
+    Input: - url of the feed.
+           - directory where the copies of the feeds are saved.
+           - timeout (in seconds) of the request, see requests.
+    Output: Feed.
+    Raises requests.RequestException if the feed can not be fetched and there is no saved copy.
+    '''
+    data_filename, info_filename = _cache_filenames(url, directory)
+    info = {}
+    if os.path.isfile(info_filename) and os.path.isfile(data_filename):
+        with open(info_filename) as file:
+            info = json.load(file)
+
+    headers = {}
+    if 'etag' in info:
+        headers['If-None-Match'] = info['etag']
+    if 'last_modified' in info:
+        headers['If-Modified-Since'] = info['last_modified']
+
+    try:
+        response = SESSION.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and info:
+            return Feed(url, _read(data_filename), info['digest'], changed=False)
+        response.raise_for_status()
+    except requests.RequestException:
+        if not info:
+            raise
+        # we use the last good copy
+        return Feed(url, _read(data_filename), info['digest'], changed=False, stale=True)
+
+    content = response.content
+    digest = hashlib.sha256(content).hexdigest()
+    changed = digest != info.get('digest')
+
+    # we save the new copy (if it changed) and the headers to validate it the next time
+    os.makedirs(directory, exist_ok=True)
+    if changed:
+        _write(data_filename, content)
+    info = {'url': url, 'digest': digest}
+    if 'ETag' in response.headers:
+        info['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        info['last_modified'] = response.headers['Last-Modified']
+    _write(info_filename, json.dumps(info).encode())
+
+    return Feed(url, content, digest, changed)
+
+
+def _cache_filenames(url, directory):
+    '''Returns the names of the files with the copy of the feed of the given URL and its information.'''
+    name = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(directory, name + '.data'), os.path.join(directory, name + '.json')
+
+
+def _read(filename):
+    with open(filename, 'rb') as file:
+        return file.read()
+
+
+def _write(filename, content):
+    '''Writes the file atomically, so a copy is never left half written.'''
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'wb') as file:
+        file.write(content)
+    os.replace(temporary_filename, filename)
@@ -0,0 +1,194 @@
+import os
+import re
+import json
+import time
+import bisect
+import difflib
+import sqlite3
+import threading
+import unicodedata
+
+# Geocoding cache: file, time (in seconds) a result is valid and maximum number of results
+GEOCODE_CACHE_FILENAME = 'geocode.sqlite'
+GEOCODE_TTL = 30 * 24 * 3600
+GEOCODE_CACHE_ENTRIES = 100000
+
+# Words that are removed from the names of the gazetteer (articles and prepositions),
+# and the abbreviations and translations of the types of street, so "C/ Mallorca" and "Carrer de Mallorca" are the same
+NAME_STOPWORDS = {'de', 'del', 'dels', 'la', 'les', 'el', 'els', 'l', 'd', 'los', 'las'}
+STREET_TYPES = {'c': 'carrer', 'calle': 'carrer', 'cl': 'carrer',
+                'av': 'avinguda', 'avda': 'avinguda', 'avenida': 'avinguda',
+                'pg': 'passeig', 'paseo': 'passeig', 'pl': 'placa', 'plaza': 'placa', 'pza': 'placa',
+                'rbla': 'rambla', 'rda': 'ronda', 'tra': 'travessera', 'travesera': 'travessera'}
+STREET_TYPE_NAMES = set(STREET_TYPES.values()) | {'via', 'gran', 'passatge', 'baixada', 'cami', 'carretera', 'moll'}
+
+# Minimum similarity (from 0 to 1, see difflib) of a fuzzy match of the gazetteer
+FUZZY_CUTOFF = 0.85
+
+
+def normalize_query(query, place=None):
+    '''
+    Returns the normalized form of a query: lowercase, without accents, punctuation or extra spaces,
+    and without the given place at the end (for instance "Sagrada Família, Barcelona, Catalonia" -> "sagrada familia").
+    '''
+    key = _normalize_text(query)
+    if place is not None:
+        place_words = set(_normalize_text(place).split())
+        words = key.split()
+        while len(words) > 1 and words[-1] in place_words:
+            words.pop()
+        key = ' '.join(words)
+    return key
+
+
+def _normalize_text(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r"[^\w]+", ' ', text).split())
+
+
+def _name_key(name):
+    '''Returns the key of a name in the gazetteer: normalized, without articles and with the full types of street.'''
+    words = [STREET_TYPES.get(word, word) for word in _normalize_text(name).split()]
+    return ' '.join(word for word in words if word not in NAME_STOPWORDS)
+
+
+class GeocodeCache:
+    '''
+    Persistent cache of geocoding results (query key -> (latitude, longitude)) saved in a SQLite database.
+    The results expire after ttl seconds, and when there are more than max_entries the least recently used are deleted.
+    It can be used from several threads at once.
+    '''
+
+    def __init__(self, filename=GEOCODE_CACHE_FILENAME, ttl=GEOCODE_TTL, max_entries=GEOCODE_CACHE_ENTRIES):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = None  # it is opened the first time it is used
+
+    def get(self, key):
+        '''Returns the cached (latitude, longitude) of the given key, or None if it is not cached or it expired.'''
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            row = connection.execute('SELECT lat, lon, created FROM geocodes WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            lat, lon, created = row
+            if now - created > self.ttl:
+                connection.execute('DELETE FROM geocodes WHERE key = ?', (key,))
+                connection.commit()
+                return None
+            connection.execute('UPDATE geocodes SET used = ? WHERE key = ?', (now, key))
+            connection.commit()
+            return lat, lon
+
+    def put(self, key, lat_lon):
+        '''Saves the (latitude, longitude) of the given key, deleting the least recently used results if it is full.'''
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            connection.execute('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)',
+                               (key, float(lat_lon[0]), float(lat_lon[1]), now, now))
+            excess = connection.execute('SELECT COUNT(*) FROM geocodes').fetchone()[0] - self.max_entries
+            if excess > 0:
+                connection.execute('DELETE FROM geocodes WHERE key IN '
+                                   '(SELECT key FROM geocodes ORDER BY used LIMIT ?)', (excess,))
+            connection.commit()
+
+    def _connect(self):
+        '''Opens the database (creating it if needed) the first time. Prec: lock taken.'''
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS geocodes '
+                                    '(key TEXT PRIMARY KEY, lat REAL, lon REAL, created REAL, used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS geocodes_used ON geocodes (used)')
+            self.connection.commit()
+        return self.connection
+
+
+class Gazetteer:
+    '''
+    Offline index of the names of the streets and places of interest of the city.
+    The lookup of a query tries, in this order:
+       - the exact name ("carrer de mallorca", "sagrada familia").
+       - the name without the type of street ("mallorca"), if only one street has it.
+    The approximate lookup, for the queries that nobody else finds, tries:
+       - the names that start with the query ("sagrada fam").
+       - the most similar name, with small spelling mistakes ("sagrada familai").
+    '''
+
+    def __init__(self, entries):
+        '''Input: list of (name, latitude, longitude).'''
+        self.entries = list(entries)
+        self.names = {}
+        aliases = {}
+        for name, lat, lon in self.entries:
+            key = _name_key(name)
+            if key and key not in self.names:
+                self.names[key] = (lat, lon)
+
+            # the alias is the name without the type of street, only used if it is not ambiguous
+            words = key.split()
+            if len(words) > 1 and words[0] in STREET_TYPE_NAMES:
+                alias = ' '.join(word for word in words if word not in STREET_TYPE_NAMES)
+                if alias:
+                    aliases.setdefault(alias, set()).add(key)
+        self.aliases = {alias: self.names[next(iter(keys))] for alias, keys in aliases.items()
+                        if len(keys) == 1 and alias not in self.names}
+        self.sorted_keys = sorted(self.names)
+
+    def lookup(self, query):
+        '''
+        Returns the (latitude, longitude) of the given query (normalized, see normalize_query) if it is the exact name
+        of a street or place, or the name of a street without its type, or None if not found.
+        Queries with numbers (house numbers) are not resolved, since the gazetteer only knows whole streets.
+        '''
+        key = self._key(query)
+        if key is None:
+            return None
+        if key in self.names:
+            return self.names[key]
+        return self.aliases.get(key)
+
+    def lookup_approximate(self, query):
+        '''
+        Returns the (latitude, longitude) of the shortest name that starts with the given query (normalized, see
+        normalize_query), or else of the most similar name (see FUZZY_CUTOFF), or None if not found.
+        '''
+        key = self._key(query)
+        if key is None:
+            return None
+
+        i = bisect.bisect_left(self.sorted_keys, key)
+        matches = []
+        while i < len(self.sorted_keys) and self.sorted_keys[i].startswith(key):
+            matches.append(self.sorted_keys[i])
+            i += 1
+        if matches:
+            return self.names[min(matches, key=len)]
+
+        matches = difflib.get_close_matches(key, self.sorted_keys, n=1, cutoff=FUZZY_CUTOFF)
+        if matches:
+            return self.names[matches[0]]
+        return None
+
+    def _key(self, query):
+        '''Returns the key of the given query in the gazetteer, or None if it cannot be resolved by it.'''
+        if any(c.isdigit() for c in query):
+            return None
+        return _name_key(query) or None
+
+    def save(self, filename):
+        '''Saves the entries of the gazetteer into the given file (JSON).'''
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, ensure_ascii=False)
+        os.replace(temporary_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''Returns the gazetteer saved in the given file.'''
+        with open(filename, encoding='utf-8') as file:
+            return cls(json.load(file))
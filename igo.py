@@ -1,32 +1,127 @@
 import os
+import io
+import time
 import pickle
-import networkx as nx
+import hashlib
 import random
-import osmnx as ox
-from staticmap import StaticMap, Line, CircleMarker
-import pandas as pd
+import numpy as np
 import datetime
+import itertools
+import collections
+import threading
+import routing
+import cch
+import feeds
+import archive
+import geocoding
+import metrics
+
+# osmnx, networkx, pandas and staticmap (with the tiles module) take a while to import, so they are imported
+# by the functions that use them: the bot can start answering without them.
 
 # We define the map constants and parameters
 PLACE = 'Barcelona, Catalonia'
-GRAPH_FILENAME = 'barcelona.graph'
+GRAPH_FILENAME = 'barcelona.csr'
+PICKLE_GRAPH_FILENAME = 'barcelona.graph'  # format of the graph saved by the previous versions
+TRAMS_INDEX_FILENAME = 'barcelona.trams'
+CCH_FILENAME = 'barcelona.cch'
+GAZETTEER_FILENAME = 'barcelona.gazetteer'
+IGRAPH_FILENAME = 'barcelona.igraph'  # last igraph built, to start with it (see save_latest_igraph)
+
+# Slim graphs (see load_graph) do not keep the OSM IDs of the nodes in memory, set IGO_SLIM_GRAPH=0 to keep them.
+# Only these attributes of the downloaded graph are kept (see download_graph).
+SLIM_GRAPH = os.environ.get('IGO_SLIM_GRAPH', '1') != '0'
+NODE_ATTRIBUTES = ['x', 'y']
+EDGE_ATTRIBUTES = ['length', 'maxspeed', 'name']
 SIZE = 800
 LINE_SIZE = 2
 INFINITE_TIME = float('inf')
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+CONGESTIONS_COLUMNS = ['Tram', 'Data', 'Congestio_actual', 'Congestio_prevista']
 COLOR_CONGESTIONS = ['silver', 'aqua', 'lime', 'orange', 'red', 'darkred', 'black']
 TIME_MULTIPLIER = [2.3, 1.5, 3.0, 4.5, 7.5, 13.0, INFINITE_TIME]
 ORIGIN_COLOR = 'red'
 DESTINATION_COLOR = 'green'
 PATH_COLOR = 'blue'
 
+# Encoding of the rendered images (see encode_image): PNG with a low compression level is about twice as fast
+# as the default one and the images are barely bigger. Use 'JPEG' with {'quality': 85} for smaller images.
+IMAGE_FORMAT = 'PNG'
+IMAGE_OPTIONS = {'compress_level': 3}
+
+# Places of interest of the gazetteer (see download_pois), as tags of OpenStreetMap
+POI_TAGS = {'tourism': ['attraction', 'museum', 'hotel'], 'railway': 'station', 'aeroway': 'aerodrome',
+            'amenity': ['hospital', 'university', 'marketplace'], 'leisure': ['park', 'stadium']}
+
+# Size limits of the cache of routes (see RouteCache)
+ROUTE_CACHE_ENTRIES = 1000
+ROUTE_CACHE_BYTES = 64 * 2**20
+
+# Numbers of the weight snapshots (igraphs) built by build_igraph
+IGRAPH_VERSIONS = itertools.count(1)
+
+# Trams index of the last highways (see get_trams_index): fingerprint -> DataFrame
+TRAMS_INDEX_CACHE = {}
+
+# The routes of the segments of the trams (see build_trams_index) are found by this number of processes
+# (one for every core by default, 1 to find them in this process), in chunks of this number of segments.
+# Starting the processes takes about a second, so they are only used when there are many segments
+# (Barcelona has about 2000, which take a fraction of a second in a single process).
+TRAMS_WORKERS = int(os.environ.get('IGO_TRAMS_WORKERS', os.cpu_count() or 1))
+TRAMS_CHUNK_SIZE = 256
+TRAMS_PARALLEL_SEGMENTS = int(os.environ.get('IGO_TRAMS_PARALLEL_SEGMENTS', 20000))
+
+# Graph of every process of build_trams_index (see _start_trams_worker)
+TRAMS_WORKER_STATE = {'graph': None}
+
+# Algorithm of the searches without contraction hierarchy (see routing.search): 'astar' is guided to the target by
+# the great circle distance, 'alt' by landmarks (see get_landmarks), which are better with the congestions but
+# cost a few searches of the whole graph for every new igraph.
+ROUTING_METHOD = os.environ.get('IGO_ROUTING_METHOD', 'astar')
+
+# Positions of the landmarks of every graph (see get_landmarks): graph fingerprint -> array
+LANDMARK_NODES = {}
+
+# Last parsed content of every feed (see parse_feed): url -> (digest, DataFrame)
+PARSED_FEEDS = {}
+
+# Geometries of the last highways (see get_tram_geometries): (DataFrame, TramGeometries)
+TRAM_GEOMETRIES_CACHE = {}
+
+# Graph and last igraph of the process that builds the igraphs (see refresh_igraph)
+REFRESH_STATE = {'graph': None, 'igraph': None}
+
+# Every new congestions feed is saved into this archive, so the traffic can be replayed (see get_igraph and replay.py).
+# Set the environment variable IGO_ARCHIVE_CONGESTIONS=0 to not save them.
+ARCHIVE_CONGESTIONS = os.environ.get('IGO_ARCHIVE_CONGESTIONS', '1') != '0'
+CONGESTION_ARCHIVE = archive.CongestionArchive()
+
+# Metrics of the stages of iGo (see metrics module)
+STAGE_SECONDS = metrics.histogram('igo_stage_seconds', 'Time spent in every stage of iGo (seconds)', 'stage')
+GEOCODE_TOTAL = metrics.counter('igo_geocode_total', 'Geocoded queries, by where they were found', 'source')
+ROUTE_CACHE_TOTAL = metrics.counter('igo_route_cache_total', 'Lookups in the route cache', 'result')
+SETTLED_NODES = metrics.histogram('igo_settled_nodes', 'Nodes settled by every search, by method', 'method',
+                                  buckets=(10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000))
+CHANGED_TRAMS = metrics.histogram('igo_changed_trams', 'Trams whose congestion changed in every update of the igraph, '
+                                  'by kind of update', 'update', buckets=(0, 10, 30, 100, 300, 1000, 3000))
+CHANGED_EDGES = metrics.histogram('igo_changed_edges', 'Edges whose itime was recomputed in every update of the igraph, '
+                                  'by kind of update', 'update',
+                                  buckets=(0, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000))
+
+# Results of the geocoder, and gazetteer of PLACE (loaded the first time it is needed, see get_gazetteer)
+GEOCODE_CACHE = geocoding.GeocodeCache()
+GAZETTEER = None
+
 
 def download_graph(place):
     '''
     Downloads and returns the graph from the given place on earth (osmnx module required).
-    The returned graph is a MultiDiGraph from the module networkx.
+    The returned graph is a MultiDiGraph from the module networkx, whose nodes and edges only have the attributes
+    NODE_ATTRIBUTES and EDGE_ATTRIBUTES (the ones needed to build the itime, the CSRGraph and the gazetteer).
     '''
+    import networkx as nx
+    import osmnx as ox
 
     # Get the MultiDiGraph from the given place and for driving purposes.
     graph = ox.graph_from_place(place, network_type='drive', simplify=True)
@@ -34,10 +129,15 @@ def download_graph(place):
     # We convert the graph to a Digraph to only have at most one edge for each pair of vertices.
     graph = ox.utils_graph.get_digraph(graph, weight='length')
 
-    # We convert it to a MultiDiGraph (because its the type of graphs Osmnx uses)
-    graph = nx.MultiDiGraph(graph)
+    # We convert it to a MultiDiGraph (because its the type of graphs Osmnx uses), without the attributes we do not use
+    # (osmid, highway, geometry...), which take most of its memory.
+    slim_graph = nx.MultiDiGraph(**graph.graph)
+    slim_graph.add_nodes_from((node, {key: data[key] for key in NODE_ATTRIBUTES})
+                              for node, data in graph.nodes(data=True))
+    slim_graph.add_edges_from((u, v, {key: data[key] for key in EDGE_ATTRIBUTES if key in data})
+                              for u, v, data in graph.edges(data=True))
 
-    return graph
+    return slim_graph
 
 
 def download_highways(url):
@@ -46,7 +146,7 @@ def download_highways(url):
     Input: URL with a csv file of the highways and their information.
     Output: Pandas DataFrame
     '''
-    return pd.read_csv(url)
+    return parse_feed(feeds.fetch(url))
 
 
 def download_congestions(url):
@@ -55,31 +155,233 @@ def download_congestions(url):
     Input:  URL with a csv file of the highways and their information.
     Output: Pandas DataFrame with the given information
     '''
-    return pd.read_csv(url, sep='#', names=['Tram', 'Data', 'Congestio_actual', 'Congestio_prevista'])
+    return parse_feed(feeds.fetch(url), sep='#', names=CONGESTIONS_COLUMNS)
+
+
+def parse_feed(feed, **read_csv_arguments):
+    '''
+    Returns the DataFrame with the csv content of the given feed (see feeds module). The feed is only parsed
+    if its content changed since the last time, otherwise the same DataFrame is returned (it must not be modified).
+    Input: - Feed.
+           - arguments of pandas.read_csv.
+    Output: Pandas DataFrame
+    '''
+    import pandas as pd
+
+    digest, dataframe = PARSED_FEEDS.get(feed.url, (None, None))
+    if digest != feed.digest:
+        dataframe = pd.read_csv(io.BytesIO(feed.content), **read_csv_arguments)
+        PARSED_FEEDS[feed.url] = (feed.digest, dataframe)
+    return dataframe
+
+
+class TramGeometries:
+    '''
+    Columnar form of the highways: the coordinates of all the trams are parsed once into a single array, so they can
+    be used without going through the DataFrame row by row.
+    Attributes: - trams: IDs of the trams (int64 array).
+                - offsets: the points of the i-th tram are coordinates[offsets[i]:offsets[i+1]] (int64 array).
+                - coordinates: (longitude, latitude) of the points of all the trams (float64 array of shape (n, 2)).
+                - fingerprint: string that identifies the trams and their coordinates.
+    '''
+
+    def __init__(self, trams, offsets, coordinates):
+        self.trams = np.ascontiguousarray(trams, dtype=np.int64)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.coordinates = np.ascontiguousarray(coordinates, dtype=np.float64).reshape(-1, 2)
+
+        fingerprint = hashlib.sha1(self.trams.tobytes())
+        fingerprint.update(self.offsets.tobytes() + self.coordinates.tobytes())
+        self.fingerprint = fingerprint.hexdigest()
+
+    @classmethod
+    def from_highways(cls, highways):
+        '''
+        Returns the geometries of the given highways (DataFrame with the columns Tram and Coordenades, where the
+        coordinates are "lon1,lat1,lon2,lat2,...").
+        '''
+        texts = highways['Coordenades'].astype(str)
+
+        # all the coordinates are parsed at once, and the number of points of every tram gives the offsets
+        values = np.fromstring(','.join(texts), dtype=np.float64, sep=',') if len(texts) else np.empty(0)
+        numbers = texts.str.count(',').to_numpy() + 1
+        if len(values) != numbers.sum() or (numbers % 2).any():
+            raise ValueError("The coordinates of some highways are not pairs of numbers")
+        offsets = np.zeros(len(numbers) + 1, dtype=np.int64)
+        np.cumsum(numbers // 2, out=offsets[1:])
+
+        return cls(highways['Tram'].to_numpy(), offsets, values)
+
+    def __len__(self):
+        return len(self.trams)
+
+    def line(self, i):
+        '''Returns the points of the i-th tram, as a list of [longitude, latitude] (see staticmap.Line).'''
+        return self.coordinates[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def segments(self):
+        '''
+        Returns the segments of all the trams: the positions of their ends in coordinates (arrays first and second)
+        and the position of their tram (array).
+        '''
+        points = np.diff(self.offsets)
+        position = np.repeat(np.arange(len(self.trams)), points)
+        first = np.flatnonzero(position[:-1] == position[1:])
+        return first, first + 1, position[first]
+
+    def join(self, congestions):
+        '''
+        Returns the positions of the trams of the given congestions (DataFrame) and their current congestion
+        (arrays, with one element for every pair of tram and congestion with the same ID, like pandas.merge).
+        '''
+        import pandas as pd
+
+        pairs = pd.merge(pd.DataFrame({'Tram': self.trams, 'position': np.arange(len(self.trams))}),
+                         congestions[['Tram', 'Congestio_actual']], on='Tram')
+        return pairs['position'].to_numpy(), pairs['Congestio_actual'].to_numpy()
+
+
+def get_tram_geometries(highways):
+    '''
+    Returns the TramGeometries of the given highways (DataFrame). They are parsed only once: while the feed does not
+    change, parse_feed returns the same DataFrame. A TramGeometries is returned as it is.
+    '''
+    if isinstance(highways, TramGeometries):
+        return highways
+
+    cached = TRAM_GEOMETRIES_CACHE.get('last')
+    if cached is not None and cached[0] is highways:
+        return cached[1]
+
+    geometries = TramGeometries.from_highways(highways)
+    TRAM_GEOMETRIES_CACHE['last'] = (highways, geometries)
+    return geometries
 
 
 def save_graph(graph, filename):
-    '''Saves the given graph into the given filename.
-    Input: - Networkx Graph
+    '''Saves the given graph into the given filename, in the binary format of the routing module (see routing.save_arrays).
+    Input: - Networkx MultiDiGraph (with the attribute itime) or CSRGraph
            - name of the file where we want to save the graph
     No output.
     '''
-    with open(filename, 'wb') as file:
-        pickle.dump(graph, file)
+    get_csr(graph).save(filename)
 
 
-def load_graph(filename):
+def load_graph(filename, slim=SLIM_GRAPH):
     '''
-    Loads the graph stored in the given filename.
-    Input:  name of the file we want to load.
-    Output: Networkx Graph
+    Loads the graph stored in the given filename. The file is memory-mapped, so the loading is almost immediate and
+    all the processes that load the same file share its memory.
+    Input:  - name of the file we want to load.
+            - slim: if True, the nodes are only identified by their positions, and their OSM IDs stay in the file
+              (see get_osm_ids).
+    Output: CSRGraph (see routing module), read-only.
     Prec: The file from the input exists
     '''
     assert exists_graph(filename), f"No such file or directory: '{filename}'"
 
-    with open(filename, 'rb') as file:
+    return routing.CSRGraph.load(filename, slim).freeze()
+
+
+def get_osm_ids(graph, positions):
+    '''
+    Returns the OSM IDs of the nodes of the given graph in the given positions (array).
+    A slim graph (see load_graph) does not have them, so they are read from the side table of the file it was loaded from.
+    '''
+    csr = get_csr(graph)
+    if csr.node_ids is not None:
+        return csr.node_ids[positions]
+    assert csr.filename is not None, "A slim graph needs the file it was loaded from to get the OSM IDs"
+    return routing.load_node_ids(csr.filename)[positions]
+
+
+def save_snapshot(igraph, filename, metadata=None):
+    '''
+    Saves the weights of the given igraph (its itime and the metric of its contraction hierarchy, if any)
+    and its version into the given file, in the binary format of the routing module (see routing.save_arrays),
+    which replaces it atomically, so other processes never load it half written.
+    Input: - igraph (CSRGraph).
+           - name of the file.
+           - metadata: dictionary (JSON) saved with the weights, if any.
+    '''
+    arrays = {'itime': igraph.itime}
+    if igraph.metric is not None:
+        arrays.update(up=igraph.metric.up, down=igraph.metric.down,
+                      up_triangle=igraph.metric.up_triangle, down_triangle=igraph.metric.down_triangle)
+    routing.save_arrays(filename, arrays, dict(metadata or {}, version=igraph.version))
+
+
+def load_snapshot(graph, filename):
+    '''
+    Returns the igraph of the given graph with the weights saved in the given file (see save_snapshot).
+    The file is memory-mapped, so all the processes that load it share its memory.
+    '''
+    arrays, metadata = routing.load_arrays(filename)
+    return _snapshot_igraph(get_csr(graph), arrays, metadata['version'])
+
+
+def _snapshot_igraph(csr, arrays, version):
+    '''Returns the igraph of the given CSRGraph with the weights of a snapshot (see save_snapshot).'''
+    igraph = csr.with_itime(arrays['itime'], version)
+    if 'up' in arrays and csr.hierarchy is not None:
+        igraph.metric = cch.Metric(csr.hierarchy, arrays['up'], arrays['down'],
+                                   arrays['up_triangle'], arrays['down_triangle'])
+    return igraph
+
+
+def save_latest_igraph(igraph, filename=IGRAPH_FILENAME):
+    '''
+    Saves the given igraph as the last one built (see save_snapshot), so after a restart the bot can start
+    with it instead of waiting for a new one (see load_latest_igraph).
+    Output: False if it could not be saved (the last one saved is kept), True otherwise.
+    '''
+    built = igraph.congestion.get('built', time.time()) if igraph.congestion is not None else time.time()
+    try:
+        save_snapshot(igraph, filename, {'graph_fingerprint': get_graph_fingerprint(igraph), 'built': built})
+    except OSError:
+        # in Windows a file cannot be replaced while a process maps it (the bot maps the one it started with),
+        # the igraph is only needed after a restart, so the update goes on and the next one is saved instead
+        return False
+    return True
+
+
+def load_latest_igraph(graph, filename=IGRAPH_FILENAME):
+    '''
+    Returns the last igraph saved with save_latest_igraph for the given graph, with a new version number,
+    or None if there is none or it was built for another graph. Its congestions can be old: the time when it was built
+    is in igraph.congestion['built'] (see time.time).
+    '''
+    if not exists_graph(filename):
+        return None
+    try:
+        arrays, metadata = routing.load_arrays(filename)
+    except (OSError, ValueError):  # a damaged file or from an older version, it will be replaced by the next igraph
+        return None
+
+    csr = get_csr(graph)
+    if (metadata.get('graph_fingerprint') != get_graph_fingerprint(csr) or 'built' not in metadata
+            or 'itime' not in arrays or len(arrays['itime']) != len(csr.itime)):
+        return None
+    igraph = _snapshot_igraph(csr, arrays, next(IGRAPH_VERSIONS))
+    igraph.congestion = {'built': metadata['built']}
+    return igraph
+
+
+def convert_pickle_graph(pickle_filename, filename):
+    '''
+    Converts the graph saved with pickle by the previous versions (a Networkx MultiDiGraph with the attribute itime)
+    into the binary format of save_graph. This only has to be done once.
+    Input: - name of the pickle file.
+           - name of the file where we want to save the graph.
+    No output.
+    '''
+    assert exists_graph(pickle_filename), f"No such file or directory: '{pickle_filename}'"
+
+    with open(pickle_filename, 'rb') as file:
         graph = pickle.load(file)
-        return graph
+    save_graph(graph, filename)
+
+    # the names of the streets are only in this graph, so we keep them in the gazetteer
+    build_gazetteer(graph).save(GAZETTEER_FILENAME)
 
 
 def exists_graph(filename):
@@ -96,20 +398,118 @@ def exists_graph(filename):
 def get_graph():
     '''
     Returns the graph of PLACE (see global variable), if the graph doesn't exist, it downloads it and saves it.
-    Output: Networkx MultiDiGraph with an additional edge attribute, itime, containing
+    A graph saved with pickle by the previous versions (PICKLE_GRAPH_FILENAME) is converted instead of downloaded.
+    Output: CSRGraph (see routing module) with an additional edge attribute, itime, containing
     the minimum time it takes to cross every edge of the graph. This attribute will further be
     modified to be adjusted to the congestions of PLACE.
     '''
     if not exists_graph(GRAPH_FILENAME):
-        graph = download_graph(PLACE)
-        get_initial_itime(graph)  # we create the additional attribute
-        save_graph(graph, GRAPH_FILENAME)
-    else:
-        graph = load_graph(GRAPH_FILENAME)
+        if exists_graph(PICKLE_GRAPH_FILENAME):
+            convert_pickle_graph(PICKLE_GRAPH_FILENAME, GRAPH_FILENAME)
+        else:
+            graph = download_graph(PLACE)
+            get_initial_itime(graph)  # we create the additional attribute
+            graph.graph['place'] = PLACE
+            save_graph(graph, GRAPH_FILENAME)
+            build_gazetteer(graph, PLACE).save(GAZETTEER_FILENAME)
+
+    graph = load_graph(GRAPH_FILENAME)
+
+    # the spatial index of the nodes and the contraction hierarchy are built once,
+    # and shared by all the igraphs built from this graph
+    get_node_index(graph)
+    get_cch(graph)
 
     return graph
 
 
+def get_csr(graph):
+    '''
+    Returns the CSRGraph (see routing module) of the given graph, with its initial itime.
+    If the graph is a Networkx MultiDiGraph it is converted the first time, made read-only and kept in the graph
+    attributes (graph.graph['csr']). All the igraphs built from the graph share its arrays, and only have their own itime.
+    Input: CSRGraph or Networkx MultiDiGraph (Osmnx Graph) with the attribute itime.
+    Output: CSRGraph.
+    '''
+    if isinstance(graph, routing.CSRGraph):
+        return graph
+
+    if graph.graph.get('csr') is None:
+        graph.graph['csr'] = routing.CSRGraph.from_networkx(graph).freeze()
+    return graph.graph['csr']
+
+
+def get_node_index(graph):
+    '''
+    Returns the spatial index (NodeIndex, see routing module) of the nodes of the given graph.
+    It is built the first time and kept in its CSRGraph (see get_csr).
+    Input: CSRGraph or Networkx MultiDiGraph (Osmnx Graph).
+    Output: NodeIndex.
+    '''
+    csr = get_csr(graph)
+    if csr.node_index is None:
+        csr.node_index = routing.NodeIndex(csr.node_ids, csr.x, csr.y)
+    return csr.node_index
+
+
+def get_cch(graph):
+    '''
+    Returns the contraction hierarchy (see cch module) of the given graph, which only depends on its topology.
+    It is loaded from CCH_FILENAME if it was built for the same graph, otherwise it is built and saved.
+    It is kept in its CSRGraph (see get_csr), so the igraphs built from this graph use it.
+    Input: CSRGraph or Networkx MultiDiGraph (Osmnx Graph) with the attribute itime.
+    Output: ContractionHierarchy.
+    '''
+    csr = get_csr(graph)
+    if csr.hierarchy is None:
+        fingerprint = get_graph_fingerprint(csr)
+
+        if exists_graph(CCH_FILENAME):
+            try:
+                hierarchy, metadata = cch.ContractionHierarchy.load(CCH_FILENAME)
+                if metadata.get('fingerprint') == fingerprint:
+                    csr.hierarchy = hierarchy
+            except (OSError, ValueError):  # a damaged file or from an older version, it is built again
+                pass
+
+        if csr.hierarchy is None:
+            csr.hierarchy = cch.ContractionHierarchy.build(csr)
+            csr.hierarchy.save(CCH_FILENAME, {'fingerprint': fingerprint})
+
+    return csr.hierarchy
+
+
+def get_landmarks(igraph):
+    '''
+    Returns the landmarks of the ALT heuristic (see routing.Landmarks) for the itime of the given igraph.
+    The landmarks are chosen once for every graph (kept in LANDMARK_NODES), and their distances are computed again for
+    every igraph the first time they are needed (with_itime keeps the ones of the previous weights, which are stale).
+    They are kept in the igraph (igraph.landmarks).
+    '''
+    landmarks = igraph.landmarks
+    if landmarks is not None and landmarks.weights is igraph.itime:
+        return landmarks
+
+    with STAGE_SECONDS.time('landmarks'):
+        if landmarks is not None:
+            landmarks = landmarks.refresh(igraph)
+        else:
+            fingerprint = get_graph_fingerprint(igraph)
+            if fingerprint in LANDMARK_NODES:
+                landmarks = routing.Landmarks(igraph, LANDMARK_NODES[fingerprint])
+            else:
+                landmarks = routing.Landmarks.build(igraph)
+                LANDMARK_NODES[fingerprint] = landmarks.nodes
+    igraph.landmarks = landmarks
+    return landmarks
+
+
+def get_graph_fingerprint(graph):
+    '''Returns a string that identifies the nodes and edges of the given graph (CSRGraph or MultiDiGraph).'''
+    csr = get_csr(graph)
+    return hashlib.sha1(csr.indptr.tobytes() + csr.indices.tobytes()).hexdigest()
+
+
 def get_initial_itime(graph):
     '''Given a graph, creates a new attribute, itime (in seconds), with the optimal time for each edge.
     Note that the itime calculated in this method is not the final itime, it does not take into account
@@ -117,6 +517,8 @@ def get_initial_itime(graph):
     Input: Networkx MultiDiGraph (Osmnx Graph) graph.
     No output.
     '''
+    import networkx as nx
+
     nx.set_edge_attributes(graph, 0, 'itime')
     for u, v, attr in graph.edges(data=True):
         # length is in meters
@@ -135,88 +537,371 @@ def get_initial_itime(graph):
                 attr['itime'] = length / 50.0 * 3.6
 
 
-def get_igraph(graph):
+def get_igraph(graph, previous=None):
     '''
-    Input: Networkx MultiDiGraph (OSmnx Graph) graph, containing the initial values of the attribute itime.
-    Output: Networkx MultiDiGraph (OSmnx Graph) igraph, containing the adjusted attribute itime with the congestions of PLACE.
+    Input: - CSRGraph (see routing module) or Networkx MultiDiGraph (OSmnx Graph) graph, containing the initial values of the attribute itime.
+           - previous: the last igraph built from the graph, if any (see build_igraph).
+    Output: CSRGraph (see routing module) igraph, containing the adjusted attribute itime with the congestions of PLACE.
     Prec: The graph must be not empty and must be the PLACE graph from osmnx.
+    The feeds are fetched with the feeds module: if they have not changed since the previous igraph was built,
+    the previous igraph is returned without parsing or building anything. The new congestions are saved into
+    CONGESTION_ARCHIVE (see archive module).
+    '''
+    with STAGE_SECONDS.time('fetch_feeds'):
+        highways_feed = feeds.fetch(HIGHWAYS_URL)
+        congestions_feed = feeds.fetch(CONGESTIONS_URL)
+    digests = (highways_feed.digest, congestions_feed.digest)
+
+    if previous is not None and previous.congestion is not None and previous.congestion.get('feeds') == digests:
+        return previous
+
+    with STAGE_SECONDS.time('parse_feeds'):
+        highways = parse_feed(highways_feed)
+        congestions = parse_feed(congestions_feed, sep='#', names=CONGESTIONS_COLUMNS)
+
+    # the new congestions are archived (a stale copy was archived when it was fetched)
+    previous_digests = (None, None)
+    if previous is not None and previous.congestion is not None:
+        previous_digests = previous.congestion.get('feeds', previous_digests)
+    if ARCHIVE_CONGESTIONS and not congestions_feed.stale and previous_digests[1] != digests[1]:
+        with STAGE_SECONDS.time('archive'):
+            CONGESTION_ARCHIVE.append(congestions)
+
+    igraph = build_igraph(graph, highways, congestions, previous)
+    igraph.congestion['feeds'] = digests
+    return igraph
+
+
+def refresh_igraph(highways=None, congestions=None):
+    '''
+    Builds the igraph with the current congestions of PLACE. It is meant to be called in a worker process
+    (see bot and scheduler modules), which keeps its graph and its last igraph so the updates are incremental.
+    Input: highways and congestions (DataFrames, see build_igraph) to build the igraph with them instead of the feeds,
+           for instance the ones of the archive (see replay.py). This igraph is not saved.
+    Output: None if the feeds have not changed since the last call, otherwise a tuple (itime, congestion, metric)
+    with the arrays of the new igraph, which is small enough to be sent to another process (see adopt_igraph).
+    Every new igraph is saved into IGRAPH_FILENAME (see save_latest_igraph).
+    '''
+    if REFRESH_STATE['graph'] is None:
+        REFRESH_STATE['graph'] = get_graph()
+
+    previous = REFRESH_STATE['igraph']
+    if congestions is not None:
+        igraph = build_igraph(REFRESH_STATE['graph'], highways, congestions, previous)
+    else:
+        igraph = get_igraph(REFRESH_STATE['graph'], previous)
+        if igraph is previous:
+            return None
+        save_latest_igraph(igraph)
+    REFRESH_STATE['igraph'] = igraph
+
+    metric = None
+    if igraph.metric is not None:
+        metric = (igraph.metric.up, igraph.metric.down, igraph.metric.up_triangle, igraph.metric.down_triangle)
+    return np.asarray(igraph.itime), igraph.congestion, metric
+
+
+def adopt_igraph(graph, arrays):
+    '''
+    Returns the igraph of the given graph with the arrays built by refresh_igraph (maybe in another process).
+    It has a new version number of this process, like the ones of build_igraph.
     '''
-    highways = download_highways(HIGHWAYS_URL)
-    congestions = download_congestions(CONGESTIONS_URL)
-    return build_igraph(graph, highways, congestions)
+    itime, congestion, metric = arrays
+    csr = get_csr(graph)
+    igraph = csr.with_itime(itime, next(IGRAPH_VERSIONS))
+    igraph.congestion = congestion
+    if metric is not None and csr.hierarchy is not None:
+        igraph.metric = cch.Metric(csr.hierarchy, *metric)
+    return igraph
 
 
-def build_igraph(graph, highways, congestions):
+def build_igraph(graph, highways, congestions, previous=None):
     '''
     Returns the igraph, which incorporates the notion of itime adjusted to the congestions of the graph's place
-    Input: - Networkx MultiDiGraph (OSmnx Graph) graph: already includes the initial values of itime.
-           - DataFrame highways: contains the different highways and their coordinates.
+    Input: - CSRGraph (see routing module) or Networkx MultiDiGraph (OSmnx Graph) graph: already includes the initial values of itime.
+           - DataFrame highways: contains the different highways and their coordinates (or their TramGeometries).
            - DataFrame congestions: contains the level of congestion of the highways, but without the coordinates.
-    Output: Networkx MultiDiGraph (OSmnx Graph) igraph.
+           - previous: the last igraph built from the same graph and highways, or None. If it is given, only the edges
+             of the trams whose congestion has changed are updated.
+    Output: CSRGraph (see routing module) igraph: a weight snapshot of the graph, which shares all its arrays
+            with the graph except itime, and has a new version number. Its attribute congestion has the multiplier
+            of every tram, and the number of trams and edges that changed with respect to previous.
     Prec: The igraph given must have an attribute called "itime".
     '''
-    igraph = graph.copy()
+    csr = get_csr(graph)
 
-    # we merge highways and congestions to have the coordinates and the level of congestion in the same place
-    highways_and_congestions = pd.merge(
-        left=highways, right=congestions, left_on='Tram', right_on='Tram')
+    # the edges covered by every tram only depend on the highways and the graph, so they are computed once
+    with STAGE_SECONDS.time('trams_index'):
+        highways = get_tram_geometries(highways)
+        trams_fingerprint = get_trams_fingerprint(graph, highways)
+        trams_index = get_trams_index(graph, highways)
 
-    for index, row in highways_and_congestions.iterrows():
+    with STAGE_SECONDS.time('itime'):
+        igraph = _update_itime(csr, trams_fingerprint, trams_index, congestions, previous)
 
-        coordinates = row['Coordenades']
-        coordinates = list(map(float, coordinates.split(',')))
+    # if the graph has a contraction hierarchy (see get_cch), we customize it with the new itime
+    if csr.hierarchy is not None:
+        with STAGE_SECONDS.time('customize'):
+            igraph.metric = csr.hierarchy.customize(igraph.itime)
 
-        # we create the nodes that form the section ("tram")
-        nodes = [(coordinates[i+1], coordinates[i]) for i in range(0, len(coordinates), 2)]
+    return igraph
 
-        # get_nearest_node() takes points as (latitude, longitude) tuples, which is the opposite of what we get from the Ajuntament.
-        # for each segment, we assign the congestion to all the edges of the shortest path from one end of the segment to the other.
-        # we are actually modifying itime attribute based on the congestion (see update_itime).
-        node1 = ox.distance.get_nearest_node(igraph, nodes[0])  # nodes[0] is the initial end
-        for i in range(1, len(nodes)):  # for every edge in the segment of the highway
 
-            node2 = ox.distance.get_nearest_node(igraph, nodes[i])
+def _update_itime(csr, trams_fingerprint, trams_index, congestions, previous):
+    '''Returns the igraph of build_igraph, without the metric of the contraction hierarchy.'''
+    import pandas as pd
 
-            try:  # if the path is from node1 to node2
-                route = ox.shortest_path(igraph, node1, node2, weight='itime')
-                # update itime
-                update_itime(igraph, route, TIME_MULTIPLIER[row['Congestio_actual']])
-            except nx.NetworkXNoPath:
-                try:  # if the path is from node2 to node 1
-                    route = ox.shortest_path(igraph, node2, node1, weight='itime')
-                    # update itime
-                    update_itime(igraph, route, TIME_MULTIPLIER[row['Congestio_actual']])
-                except nx.NetworkXNoPath:  # there is no path between the nodes, only happens in a few cases
-                    pass
+    # the multiplier of every tram (the product of them if the tram appears several times)
+    tram_multipliers = pd.Series(np.asarray(TIME_MULTIPLIER)[congestions['Congestio_actual'].to_numpy()],
+                                 index=congestions['Tram'].to_numpy()).groupby(level=0).prod()
 
-            node1 = node2
+    incremental = (previous is not None and previous.congestion is not None and previous.indices is csr.indices
+                   and previous.congestion.get('trams_fingerprint') == trams_fingerprint)
 
+    if incremental:
+        # we compare the multipliers with the ones of the previous igraph. A missing tram has multiplier 1.
+        both = pd.concat([previous.congestion['tram_multipliers'].rename('old'), tram_multipliers.rename('new')],
+                         axis=1).fillna(1.0)
+        changed_trams = both.index[both['old'] != both['new']]
+        edges = np.unique(trams_index['edge'].to_numpy()[trams_index['Tram'].isin(changed_trams).to_numpy()])
+        itime = previous.itime.copy()
+    else:
+        changed_trams = tram_multipliers.index
+        edges = np.unique(trams_index['edge'].to_numpy())
+        itime = csr.itime.copy()
+
+    # we recompute the itime of the affected edges. An edge covered several times gets the product of all its multipliers.
+    covered = trams_index[trams_index['edge'].isin(edges)]
+    multipliers = np.ones(len(edges))
+    np.multiply.at(multipliers, np.searchsorted(edges, covered['edge'].to_numpy()),
+                   covered['Tram'].map(tram_multipliers).fillna(1.0).to_numpy())
+    itime[edges] = csr.itime[edges] * multipliers
+
+    update = 'incremental' if incremental else 'full'
+    CHANGED_TRAMS.observe(update, len(changed_trams))
+    CHANGED_EDGES.observe(update, len(edges))
+
+    # the graph is not copied: the igraph only has its own itime
+    igraph = csr.with_itime(itime, next(IGRAPH_VERSIONS))
+    igraph.congestion = {'trams_fingerprint': trams_fingerprint, 'tram_multipliers': tram_multipliers,
+                         'changed_trams': len(changed_trams), 'changed_edges': len(edges), 'built': time.time()}
     return igraph
 
 
-def update_itime(igraph, route, multiplier):
+def get_trams_index(graph, highways):
     '''
-    Given the route from a segment, update the itime of the igraph using the factor multiplier (see global variable TIME_MULTIPLIER).
-    Input: - igraph (Networkx MultiDiGraph (Osmnx Graph)).
-           - route (list of Node IDs).
-           - multiplier (float): multiplies itime.
-    No output.
-    Prec:  - The igraph must have:
-               - the given nodes from route.
-               - the attribute "itime".
-               - at most one edge between two nodes.
+    Returns the trams index of the given graph and highways (see build_trams_index). If it has already been
+    computed for the same highways and graph it is taken from memory or loaded from TRAMS_INDEX_FILENAME,
+    otherwise it is built and saved.
+    Input: - CSRGraph or Networkx MultiDiGraph (OSmnx Graph) graph: already includes the initial values of itime.
+           - DataFrame highways: contains the different highways and their coordinates (or their TramGeometries).
+    Output: DataFrame with the columns Tram and edge.
+    '''
+    fingerprint = get_trams_fingerprint(graph, highways)
+    if fingerprint in TRAMS_INDEX_CACHE:
+        return TRAMS_INDEX_CACHE[fingerprint]
+
+    trams_index = None
+    if exists_graph(TRAMS_INDEX_FILENAME):
+        with open(TRAMS_INDEX_FILENAME, 'rb') as file:
+            saved_fingerprint, trams_index = pickle.load(file)
+        if saved_fingerprint != fingerprint:
+            trams_index = None
+        else:  # the index saved by the previous versions also has the IDs of the nodes of the edges
+            trams_index = trams_index[['Tram', 'edge']]
+
+    if trams_index is None:
+        trams_index = build_trams_index(graph, highways)
+        with open(TRAMS_INDEX_FILENAME, 'wb') as file:
+            pickle.dump((fingerprint, trams_index), file)
+
+    # we only keep the index of the last highways in memory
+    TRAMS_INDEX_CACHE.clear()
+    TRAMS_INDEX_CACHE[fingerprint] = trams_index
+    return trams_index
+
+
+def get_trams_fingerprint(graph, highways):
+    '''
+    Returns a string that identifies the given highways and graph, used to know if a saved trams index is still valid.
+    '''
+    csr = get_csr(graph)
+    fingerprint = hashlib.sha1(get_tram_geometries(highways).fingerprint.encode())
+    fingerprint.update(csr.indptr.tobytes() + csr.indices.tobytes())
+    return fingerprint.hexdigest()
+
+
+def build_trams_index(graph, highways, workers=None):
+    '''
+    Returns the edges of the graph covered by every highway section ("tram").
+    Input: - CSRGraph or Networkx MultiDiGraph (OSmnx Graph) graph: already includes the initial values of itime.
+           - DataFrame highways: contains the different highways and their coordinates (or their TramGeometries).
+           - workers: number of processes that find the routes of the segments (TRAMS_WORKERS by default), only used
+             if there are at least TRAMS_PARALLEL_SEGMENTS segments.
+    Output: DataFrame with one row (Tram, edge) for every edge of the graph covered by the tram, where edge is
+            the position of the edge in the CSRGraph of the graph (see get_csr). An edge appears as many times as
+            it is covered by the segments of the tram.
+            It is the same with any number of workers.
+    '''
+    import pandas as pd
+
+    csr = get_csr(graph)
+    highways = get_tram_geometries(highways)
+    workers = TRAMS_WORKERS if workers is None else workers
+
+    # we snap all the points of all the trams at once. The Ajuntament gives (longitude, latitude).
+    snapped = get_node_index(csr).nearest(highways.coordinates[:, 1], highways.coordinates[:, 0])
+    first, second, tram_positions = highways.segments()
+    sources, targets = snapped[first], snapped[second]
+
+    # for each segment, we assign the tram to all the edges of the shortest path from one end of the segment to the
+    # other. The segments are independent, so they are split into chunks that can be routed by several processes.
+    chunks = [(sources[i:i + TRAMS_CHUNK_SIZE], targets[i:i + TRAMS_CHUNK_SIZE])
+              for i in range(0, len(sources), TRAMS_CHUNK_SIZE)]
+    if workers > 1 and len(chunks) > 1 and len(sources) >= TRAMS_PARALLEL_SEGMENTS:
+        routes = _route_segments_in_parallel(csr, chunks, workers)
+    else:
+        routes = [route_segments(csr, chunk_sources, chunk_targets) for chunk_sources, chunk_targets in chunks]
+
+    # the chunks are merged in order, so the result does not depend on which process routed each one
+    counts = np.concatenate([np.empty(0, dtype=np.int64)] + [counts for counts, us, vs in routes])
+    us = np.concatenate([np.empty(0, dtype=np.int64)] + [us for counts, us, vs in routes])
+    vs = np.concatenate([np.empty(0, dtype=np.int64)] + [vs for counts, us, vs in routes])
+    trams = np.repeat(highways.trams[tram_positions], counts)
+
+    # we only keep the position of every edge in the arrays of the graph, its nodes are not needed (see get_osm_ids)
+    return pd.DataFrame({'Tram': trams, 'edge': csr.edge_positions(us, vs)}, columns=['Tram', 'edge'])
+
+
+def route_segments(csr, sources, targets):
+    '''
+    Finds the route of every segment of a tram (see build_trams_index): the shortest path from its source to its target,
+    or from its target to its source if there is none.
+    Input: - CSRGraph.
+           - sources, targets: arrays with the positions of the ends of the segments.
+    Output: arrays with the number of edges of the route of every segment, and the tails and heads of all these edges
+            (positions of the nodes), one route after another.
+    '''
+    # the segments are short, so the landmarks would cost more than they save: we use the great circle distance
+    method = 'astar' if ROUTING_METHOD == 'alt' else ROUTING_METHOD
+    counts, us, vs = [], [], []
+    for node1, node2 in zip(np.asarray(sources).tolist(), np.asarray(targets).tolist()):
+        try:  # if the path is from node1 to node2
+            route = routing.shortest_path(csr, node1, node2, weight='itime', method=method)
+        except routing.NoPath:
+            try:  # if the path is from node2 to node 1
+                route = routing.shortest_path(csr, node2, node1, weight='itime', method=method)
+            except routing.NoPath:  # there is no path between the nodes, only happens in a few cases
+                route = []
+
+        counts.append(max(len(route) - 1, 0))
+        us.extend(route[:-1])
+        vs.extend(route[1:])
+    return np.array(counts, dtype=np.int64), np.array(us, dtype=np.int64), np.array(vs, dtype=np.int64)
+
+
+def _route_segments_in_parallel(csr, chunks, workers):
+    '''
+    Returns route_segments of every chunk (sources, targets), in the same order, using a pool of the given number of
+    processes. The graph is saved into a temporary file that all of them memory-map, so it is in memory only once.
+    '''
+    import tempfile
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'graph.csr')
+        csr.save(filename)
+
+        # new processes (not forks), so they do not inherit the threads and locks of this one
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), initializer=_start_trams_worker,
+                                 initargs=(filename,), mp_context=multiprocessing.get_context('spawn')) as executor:
+            return list(executor.map(_route_segments_chunk, *zip(*chunks)))
+
+
+def _start_trams_worker(filename):
+    '''Loads the graph (read only) in a new process of _route_segments_in_parallel.'''
+    TRAMS_WORKER_STATE['graph'] = routing.CSRGraph.load(filename, slim=True).freeze()
+
+
+def _route_segments_chunk(sources, targets):
+    '''Runs in a process of _route_segments_in_parallel: returns route_segments of the given chunk.'''
+    return route_segments(TRAMS_WORKER_STATE['graph'], sources, targets)
+
+
+class RouteCache:
+    '''
+    LRU cache of the results of render_shortest_path: route, approximate time, distance and image.
+    The key is (origin node, destination node, version of the igraph), so a result is never used with other weights.
+    It keeps at most max_entries results and max_bytes bytes of images, and counts its hits and misses.
+    It can be used from several threads at once.
     '''
-    for i in range(len(route)-1):
-        # we put 0 as a key because its a MultiDigraph but with at most one edge between two nodes.
-        igraph[route[i]][route[i+1]][0]['itime'] *= multiplier
 
-    return
+    def __init__(self, max_entries=ROUTE_CACHE_ENTRIES, max_bytes=ROUTE_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()  # key -> (route, image, aprox_time, distance), oldest first
+        self.used_bytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''Returns the result of the given key, or None if it is not cached.'''
+        with self.lock:
+            result = self.results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.results.move_to_end(key)
+                self.hits += 1
+        ROUTE_CACHE_TOTAL.increment('miss' if result is None else 'hit')
+        return result
+
+    def put(self, key, result):
+        '''Saves the result of the given key, removing the least recently used ones if the cache is full.'''
+        with self.lock:
+            # results of an old version can not be used anymore
+            if self.version is not None and key[2] != self.version:
+                return
+            if key in self.results:
+                return
+            self.results[key] = result
+            self.used_bytes += self._size(result)
+            while self.results and (len(self.results) > self.max_entries or self.used_bytes > self.max_bytes):
+                _, evicted = self.results.popitem(last=False)
+                self.used_bytes -= self._size(evicted)
+
+    def publish(self, version):
+        '''Tells the cache that the igraph with the given version is the current one, removing the other results.'''
+        with self.lock:
+            if version == self.version:
+                return
+            self.version = version
+            for key in [key for key in self.results if key[2] != version]:
+                self.used_bytes -= self._size(self.results.pop(key))
+
+    def stats(self):
+        '''Returns a dictionary with the number of results, bytes, hits and misses of the cache.'''
+        with self.lock:
+            return {'entries': len(self.results), 'bytes': self.used_bytes, 'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def _size(result):
+        route, image, aprox_time, distance = result
+        return len(image) + route.nbytes
+
+
+# Cache of the routes of the current igraph, shared by all the requests
+ROUTE_CACHE = RouteCache()
 
 
 def get_shortest_path_with_itimes(igraph, origin, destination):
     '''
     Given an igraph, an origin and a destination, finds the shortest path using the concept of itime.
-    Input: - igraph (Networkx MultiDiGraph (OSmnx Graph)).
+    It is the same as render_shortest_path, but the image is saved into a file.
+    Input: - igraph (CSRGraph, see routing module).
            - origin (has to be in the format (latitude, longitude)).
            - destination (has to be in the format (latitude, longitude)).
     Output:
@@ -226,21 +911,68 @@ def get_shortest_path_with_itimes(igraph, origin, destination):
     Prec:
            - the igraph given must have an attribute called "itime".
     '''
+    image, aprox_time, distance = render_shortest_path(igraph, origin, destination)
+    return save_image(image), aprox_time, distance
+
+
+def render_shortest_path(igraph, origin, destination, cache=ROUTE_CACHE):
+    '''
+    Given an igraph, an origin and a destination, finds the shortest path using the concept of itime.
+    The results are saved in the given cache (None to not use any), so a repeated query is not computed again.
+    Input: - igraph (CSRGraph, see routing module).
+           - origin (has to be in the format (latitude, longitude)).
+           - destination (has to be in the format (latitude, longitude)).
+    Output:
+           - image: bytes of the image (see IMAGE_FORMAT) in which the path is plotted.
+           - aprox_time: approximate time (timedelta from datetime module) from the given origin to the given destination.
+           - distance: approximate distance from the given origin to the given destination.
+    Prec:
+           - the igraph given must have an attribute called "itime".
+    '''
+
+    # We convert the (latitude, longitude) format into the position of a node in the igraph.
+    with STAGE_SECONDS.time('snap'):
+        origin = routing.nearest_node(igraph, origin)
+        destination = routing.nearest_node(igraph, destination)
+
+    key = (origin, destination, igraph.version)
+    result = cache.get(key) if cache is not None else None
+    if result is None:
+        result = compute_shortest_path(igraph, origin, destination)
+        if cache is not None:
+            cache.put(key, result)
+
+    route, image, aprox_time, distance = result
+    return image, aprox_time, distance
+
+
+def compute_shortest_path(igraph, origin, destination):
+    '''
+    Finds and plots the shortest path between two nodes of the igraph using the concept of itime.
+    Input: - igraph (CSRGraph, see routing module).
+           - origin and destination: positions of the nodes in the igraph.
+    Output: route (array with the positions of its nodes), image (bytes), aprox_time (timedelta) and distance.
+    '''
+    from staticmap import Line, CircleMarker
+    from tiles import CachedStaticMap
 
     # This print is for testing purposes, uncomment it to see when the shortest path begins.
     # print("Shortest path beginning...")
 
-    route_map = StaticMap(SIZE, SIZE)
+    route_map = CachedStaticMap(SIZE, SIZE)
 
-    # We convert the (latitude, longitude) format into an ID of a node in the igraph.
-    origin = ox.distance.get_nearest_node(igraph, origin)
-    destination = ox.distance.get_nearest_node(igraph, destination)
+    # We search the shortest path from origin to destination, using the contraction hierarchy if the igraph has one.
+    with STAGE_SECONDS.time('route'):
+        if igraph.metric is not None:
+            route = igraph.metric.shortest_path(origin, destination)
+        else:
+            if ROUTING_METHOD == 'alt':
+                get_landmarks(igraph)
+            route, settled = routing.search(igraph, origin, destination, weight='itime', method=ROUTING_METHOD)
+            SETTLED_NODES.observe(ROUTING_METHOD, settled)
 
-    # We search the shortest path from origin to destination.
-    route = ox.shortest_path(igraph, origin, destination, weight='itime')
-
-    # We convert each node ID of the path into the format (longitude, latitude).
-    coordinates = [[igraph.nodes[node]['x'], igraph.nodes[node]['y']] for node in route]
+    # We convert each node of the path into the format (longitude, latitude).
+    coordinates = [[float(igraph.x[node]), float(igraph.y[node])] for node in route]
 
     # We add the path in the map.
     line = Line(coordinates, PATH_COLOR, 4)
@@ -254,30 +986,169 @@ def get_shortest_path_with_itimes(igraph, origin, destination):
     route_map.add_marker(CircleMarker(coordinates[-1], 'white', 18))
     route_map.add_marker(CircleMarker(coordinates[-1], DESTINATION_COLOR, 12))
 
-    # We save the image into a file
-    image = route_map.render()
-    image_filename = "temp%d.png" % random.randint(1000000, 9999999)
-    image.save(image_filename)
+    # We draw the map (downloading the tiles that are not in the cache, see tiles module) and encode it in memory
+    with STAGE_SECONDS.time('render'):
+        image = route_map.render()
+    image = encode_image(image)
 
     # We approximate the duration of the path
-    aprox_time = sum([igraph[route[i]][route[i+1]][0]['itime'] for i in range(len(route)-1)])
+    aprox_time = routing.route_cost(igraph, route, 'itime')
     aprox_time = datetime.timedelta(seconds=int(aprox_time))
 
     # We approximate the distance of the path
-    distance = sum([igraph[route[i]][route[i+1]][0]['length'] for i in range(len(route)-1)])
+    distance = routing.route_cost(igraph, route, 'length')
 
     # This print is for testing purposes, uncomment it to see when the shortest path ends.
     # print("...Shortest path finished")
 
-    return image_filename, aprox_time, round(distance, 1)
+    return np.array(route, dtype=np.int32), image, aprox_time, round(distance, 1)
+
+
+def get_travel_matrices(igraph, origins, destinations):
+    '''
+    Given an igraph and lists of origins and destinations, computes the itime and the length of the fastest
+    route from every origin to every destination (for instance, to find the nearest of some vehicles to a customer).
+    The points are snapped all at once, there is one search for every different origin (or destination) and
+    nothing is plotted, so it is much faster than calling get_shortest_path_with_itimes for every pair.
+    Input: - igraph (CSRGraph, see routing module).
+           - origins and destinations: lists (or arrays) of points in the format (latitude, longitude).
+    Output:
+           - itimes: array of shape (len(origins), len(destinations)) with the itime (in seconds) of the routes.
+           - lengths: array of the same shape with their length (in meters).
+           Both are infinite (float('inf')) if there is no route.
+    '''
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+    destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+    with STAGE_SECONDS.time('snap_batch'):
+        sources = routing.nearest_nodes(igraph, origins[:, 0], origins[:, 1])
+        targets = routing.nearest_nodes(igraph, destinations[:, 0], destinations[:, 1])
+    with STAGE_SECONDS.time('travel_matrices'):
+        return routing.travel_matrices(igraph, sources, targets, weight='itime', other='length')
+
+
+def encode_image(image, image_format=IMAGE_FORMAT, options=IMAGE_OPTIONS):
+    '''
+    Returns the bytes of the given image (from PIL module) encoded in the given format (PNG by default).
+    The options are the ones of PIL.Image.save for that format.
+    '''
+    if image_format == 'JPEG':
+        image = image.convert('RGB')
+    with STAGE_SECONDS.time('encode'):
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, **options)
+        return buffer.getvalue()
+
+
+def save_image(image):
+    '''
+    Saves the given image (bytes) into a temporary file, using a random number as a filename, and returns its name.
+    '''
+    image_filename = "temp%d.%s" % (random.randint(1000000, 9999999), IMAGE_FORMAT.lower())
+    with open(image_filename, 'wb') as file:
+        file.write(image)
+    return image_filename
 
 
 def get_lat_lon(query):
     '''
     Given a name of a location (query) as a string,
-    returns its coordinates in the format (latitude, longitude)
+    returns its coordinates in the format (latitude, longitude).
+    The exact names of the streets and places of interest of PLACE are found in the gazetteer without any request
+    (see get_gazetteer). Otherwise it is geocoded with Nominatim (osmnx module), and the result is kept in
+    GEOCODE_CACHE. If Nominatim does not find it either, it is looked up approximately in the gazetteer
+    (the beginning of a name, or spelling mistakes).
     '''
-    return ox.geocoder.geocode(query)
+    with STAGE_SECONDS.time('geocode'):
+        key = geocoding.normalize_query(query, PLACE)
+
+        gazetteer = get_gazetteer()
+        if gazetteer is not None:
+            lat_lon = gazetteer.lookup(key)
+            if lat_lon is not None:
+                GEOCODE_TOTAL.increment('gazetteer')
+                return lat_lon
+
+        lat_lon = GEOCODE_CACHE.get(key)
+        if lat_lon is not None:
+            GEOCODE_TOTAL.increment('cache')
+            return lat_lon
+
+        import osmnx as ox
+        import requests
+        try:
+            lat_lon = ox.geocoder.geocode(query)
+        except requests.RequestException:
+            raise
+        except Exception:
+            # osmnx raises a plain exception when Nominatim has no results
+            lat_lon = gazetteer.lookup_approximate(key) if gazetteer is not None else None
+            if lat_lon is None:
+                raise
+            GEOCODE_TOTAL.increment('gazetteer_approximate')
+            return lat_lon
+
+        GEOCODE_TOTAL.increment('nominatim')
+        GEOCODE_CACHE.put(key, lat_lon)
+        return lat_lon
+
+
+def get_gazetteer():
+    '''
+    Returns the gazetteer (see geocoding module) of PLACE, loading it from GAZETTEER_FILENAME the first time.
+    Returns None if it does not exist (it is built when the graph is downloaded or converted, see get_graph).
+    '''
+    global GAZETTEER
+    if GAZETTEER is None and os.path.isfile(GAZETTEER_FILENAME):
+        GAZETTEER = geocoding.Gazetteer.load(GAZETTEER_FILENAME)
+    return GAZETTEER
+
+
+def build_gazetteer(graph, place=None):
+    '''
+    Builds the gazetteer with the names of the streets of the given graph, and the places of interest of the given place.
+    Input: - Networkx MultiDiGraph (Osmnx Graph) with the attribute name in its edges.
+           - place whose places of interest are downloaded (see download_pois), None to not include them.
+    Output: Gazetteer (see geocoding module).
+    '''
+    entries = get_street_entries(graph)
+    if place is not None:
+        entries += download_pois(place)
+    return geocoding.Gazetteer(entries)
+
+
+def get_street_entries(graph):
+    '''
+    Returns a list with the name, latitude and longitude of every street of the given graph.
+    The coordinates of a street are the ones of its node nearest to the median of all of them, so it is on the street.
+    '''
+    streets = {}
+    for u, v, data in graph.edges(data=True):
+        names = data.get('name')
+        if names is None:
+            continue
+        for name in (names if isinstance(names, list) else [names]):
+            streets.setdefault(name, set()).update((u, v))
+
+    entries = []
+    for name, nodes in streets.items():
+        coordinates = np.array([(graph.nodes[node]['y'], graph.nodes[node]['x']) for node in nodes])
+        median = np.median(coordinates, axis=0)
+        lat, lon = coordinates[np.argmin(((coordinates - median)**2).sum(axis=1))]
+        entries.append((name, float(lat), float(lon)))
+    return entries
+
+
+def download_pois(place):
+    '''
+    Downloads the places of interest of the given place (see POI_TAGS) that have a name.
+    Output: list with the name, latitude and longitude of every place of interest.
+    '''
+    import osmnx as ox
+
+    pois = ox.geometries_from_place(place, POI_TAGS)
+    pois = pois[pois['name'].notna()]
+    centroids = pois.geometry.centroid
+    return [(name, float(point.y), float(point.x)) for name, point in zip(pois['name'], centroids)]
 
 
 def get_location_image(lat_lon):
@@ -289,53 +1160,67 @@ def get_location_image(lat_lon):
     Output:
            - Filename of the generated image: temp random number
     '''
+    return save_image(render_location(lat_lon))
+
+
+def render_location(lat_lon):
+    '''
+    Given a location, specified by latitude and longitude, generates an image of that location in the map.
+    Input:
+           - A latitude, longitude pair.
+    Output:
+           - Bytes of the image (see IMAGE_FORMAT).
+    '''
+    from staticmap import CircleMarker
+    from tiles import CachedStaticMap
+
     lat, lon = lat_lon
 
     # Saves the map in order to add the marker
-    user_map = StaticMap(SIZE-200, SIZE-200)
+    user_map = CachedStaticMap(SIZE-200, SIZE-200)
 
     # Add the marker to the given location
     user_map.add_marker(CircleMarker((lon, lat), 'white', 24))
     user_map.add_marker(CircleMarker((lon, lat), ORIGIN_COLOR, 18))
 
-    # Generates and saves the image, as it will be a temporary
-    # file it receives a distinctive name.
-    image = user_map.render()
-    image_filename = "temp%d.png" % random.randint(1000000, 9999999)
-    image.save(image_filename)
-
-    return image_filename
+    # Generates the image in memory
+    with STAGE_SECONDS.time('render'):
+        image = user_map.render()
+    return encode_image(image)
 
 
 def plot_graph(graph):
     '''
-    Plots the given MultiDiGraph graph, and saves the image in the file barcelona_graph.png
+    Plots the given MultiDiGraph (or CSRGraph) graph, and saves the image in the file barcelona_graph.png
     We need to save the image because of a known issue with windows users, who can't see the plot directly
 
     Prec: The graph must be not empty
     '''
+    import osmnx as ox
+
+    if isinstance(graph, routing.CSRGraph):
+        graph = graph.to_networkx()
+
     fig, ax = ox.plot_graph(graph, show=True, save=True, filepath='barcelona_graph.png')
 
 
 def plot_highways(highways, image_filename, size):
     '''
     Saves the plot of highways in the given image_filename with the given size.
-    Input: - highways (DataFrame).
+    Input: - highways (DataFrame or TramGeometries).
            - image_filename (name of the file where you want to save the plot).
            - size of the image.
     No Output.
     '''
-    place_map = StaticMap(size, size)
-    for coordinates in highways['Coordenades']:
-
-        # we separate the coordinates and put them in a list
-        coordinates = list(map(float, coordinates.split(',')))
+    from staticmap import Line
+    from tiles import CachedStaticMap
 
-        # we create the nodes that form the section ("tram")
-        coordinates = [[coordinates[i], coordinates[i+1]] for i in range(0, len(coordinates), 2)]
+    highways = get_tram_geometries(highways)
+    place_map = CachedStaticMap(size, size)
+    for i in range(len(highways)):
 
-        # we paint the section in the map
-        pol = Line(coordinates, PATH_COLOR, LINE_SIZE)
+        # we paint the section ("tram") in the map
+        pol = Line(highways.line(i), PATH_COLOR, LINE_SIZE)
         place_map.add_line(pol)
 
     image = place_map.render()
@@ -346,7 +1231,7 @@ def plot_congestions(highways, congestions, image_filename, size):
     '''
     Translates the information of highways and their congestions into a map (the plot) using a color coding.
     Saves the map in the image_filename given using the given size of the image.
-    Input: - highways (DataFrame).
+    Input: - highways (DataFrame or TramGeometries).
            - congestions (DataFrame).
            - image_filename (name of the file you want to save the plot).
            - size of the image.
@@ -361,23 +1246,19 @@ def plot_congestions(highways, congestions, image_filename, size):
     darkred --> jam
     black --> cut off
     '''
+    from staticmap import Line
+    from tiles import CachedStaticMap
 
-    highways_and_congestions = pd.merge(
-        left=highways, right=congestions, left_on='Tram', right_on='Tram')
-
-    place_map = StaticMap(size, size)
-
-    for index, row in highways_and_congestions.iterrows():
-        coordinates = row['Coordenades']
+    # we join every congestion with the position of its tram in the geometries
+    highways = get_tram_geometries(highways)
+    positions, congestion_codes = highways.join(congestions)
 
-        # we separate the coordinates and put them in a list
-        coordinates = list(map(float, coordinates.split(',')))
+    place_map = CachedStaticMap(size, size)
 
-        # we create the nodes that form the section ("tram")
-        coordinates = [[coordinates[i], coordinates[i+1]] for i in range(0, len(coordinates), 2)]
+    for position, congestion in zip(positions.tolist(), congestion_codes.tolist()):
 
-        # we paint the section in the map using the color coding for each congestion
-        pol = Line(coordinates, COLOR_CONGESTIONS[row['Congestio_actual']], LINE_SIZE)
+        # we paint the section ("tram") in the map using the color coding for each congestion
+        pol = Line(highways.line(position), COLOR_CONGESTIONS[congestion], LINE_SIZE)
         place_map.add_line(pol)
 
     image = place_map.render()
@@ -0,0 +1,267 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (in seconds) of the buckets of the histograms of times
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Local HTTP endpoint with the metrics, and seconds between the log lines (see start_server and start_log).
+# The port can be changed with the environment variable IGO_METRICS_PORT (0 or empty to not serve them).
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORT = int(os.environ.get('IGO_METRICS_PORT', '9108') or 0)
+LOG_INTERVAL = 300
+
+# All the metrics of the process: name -> Histogram or Counter
+REGISTRY = {}
+REGISTRY_LOCK = threading.Lock()
+
+logger = logging.getLogger('igo.metrics')
+
+
+class Histogram:
+    '''
+    Distribution of some values (for instance, the times of a stage) for every value of its label,
+    as the counts of the values up to every bucket bound, like the histograms of Prometheus.
+    Observing a value takes about a microsecond, so it can always be on.
+    '''
+
+    def __init__(self, name, description, label, buckets=TIME_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # label value -> [counts of every bucket (and one more for the rest), sum, count]
+
+    def observe(self, label_value, value):
+        '''Adds the given value to the histogram of the given label value.'''
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(label_value)
+            if data is None:
+                data = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][bucket] += 1
+            data[1] += value
+            data[2] += 1
+
+    def time(self, label_value):
+        '''Returns a context manager that observes the seconds spent inside it. Usage: with histogram.time('x'): ...'''
+        return Timer(self, label_value)
+
+    def quantile(self, label_value, q):
+        '''Returns the upper bound of the bucket of the quantile q (from 0 to 1) of the given label value.'''
+        with self.lock:
+            counts, total, count = self.values[label_value]
+            counts = list(counts)
+        rank = q * count
+        accumulated = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            accumulated += bucket_count
+            if accumulated >= rank:
+                return bound
+        return float('inf')
+
+    def collect(self):
+        '''Returns the values observed since the last call and forgets them (see metrics.collect).'''
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        '''Adds the values returned by collect (maybe in another process).'''
+        with self.lock:
+            for label_value, (counts, total, count) in values.items():
+                data = self.values.get(label_value)
+                if data is None:
+                    data = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                data[0] = [a + b for a, b in zip(data[0], counts)]
+                data[1] += total
+                data[2] += count
+
+    def exposition(self):
+        '''Returns the lines of the histogram in the text format of Prometheus.'''
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = sorted((label_value, list(data[0]), data[1], data[2]) for label_value, data in self.values.items())
+        for label_value, counts, total, count in values:
+            labels = f'{self.label}="{label_value}"'
+            accumulated = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                accumulated += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {accumulated}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Timer:
+    '''Context manager that observes the seconds spent inside it in a Histogram (see Histogram.time).'''
+
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(self.label_value, time.perf_counter() - self.start)
+        return False
+
+
+class Counter:
+    '''Number of times something happened, for every value of its label.'''
+
+    def __init__(self, name, description, label):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.lock = threading.Lock()
+        self.values = {}  # label value -> count
+
+    def increment(self, label_value, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for label_value, amount in values.items():
+                self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        lines += [f'{self.name}{{{self.label}="{label_value}"}} {amount}' for label_value, amount in values]
+        return lines
+
+
+def histogram(name, description, label, buckets=TIME_BUCKETS):
+    '''Returns the Histogram with the given name, which is created the first time.'''
+    return _register(name, lambda: Histogram(name, description, label, buckets))
+
+
+def counter(name, description, label):
+    '''Returns the Counter with the given name, which is created the first time.'''
+    return _register(name, lambda: Counter(name, description, label))
+
+
+def _register(name, create):
+    with REGISTRY_LOCK:
+        if name not in REGISTRY:
+            REGISTRY[name] = create()
+        return REGISTRY[name]
+
+
+def collect():
+    '''
+    Returns the values of all the metrics observed since the last call, and forgets them.
+    It is used to send the metrics of a worker process to the main one (see collecting and merge).
+    '''
+    with REGISTRY_LOCK:
+        metrics = list(REGISTRY.values())
+    return {metric.name: (type(metric).__name__, metric.collect()) for metric in metrics}
+
+
+def merge(collected):
+    '''Adds the values returned by collect (maybe in another process) to the metrics of this process.'''
+    for name, (kind, values) in collected.items():
+        with REGISTRY_LOCK:
+            metric = REGISTRY.get(name)
+        if metric is not None and type(metric).__name__ == kind:
+            metric.merge(values)
+
+
+def collecting(function, *args):
+    '''
+    Returns function(*args) and the metrics observed meanwhile (see collect). It is meant to be called in a
+    worker process, and its metrics are added to the ones of the main process with merge.
+    '''
+    collect()
+    result = function(*args)
+    return result, collect()
+
+
+def exposition():
+    '''Returns all the metrics in the text format of Prometheus.'''
+    with REGISTRY_LOCK:
+        metrics = sorted(REGISTRY.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        lines += metric.exposition()
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    '''
+    Returns a line with the count, median and 95th percentile (upper bounds of their buckets) of every histogram,
+    and the counters.
+    '''
+    with REGISTRY_LOCK:
+        metrics = sorted(REGISTRY.values(), key=lambda metric: metric.name)
+    parts = []
+    for metric in metrics:
+        with metric.lock:
+            label_values = sorted(metric.values)
+        for label_value in label_values:
+            if isinstance(metric, Histogram):
+                count = metric.values[label_value][2]
+                parts.append(f"{metric.name}[{label_value}] n={count} p50<={metric.quantile(label_value, 0.5)} "
+                             f"p95<={metric.quantile(label_value, 0.95)}")
+            else:
+                parts.append(f"{metric.name}[{label_value}]={metric.values[label_value]}")
+    return '; '.join(parts)
+
+
+def start_server(port=METRICS_PORT, address=METRICS_ADDRESS):
+    '''
+    Serves the metrics (see exposition) in http://address:port/metrics, in a background thread.
+    Output: the server, or None if port is 0 or it cannot listen on it (for instance, another process of the bot
+            already does), so the bot works anyway without the endpoint.
+    '''
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            content = exposition().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((address, port), Handler)
+    except OSError as error:
+        logger.warning(f"The metrics are not served in {address}:{port}: {error}")
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def start_log(interval=LOG_INTERVAL):
+    '''Logs the summary of the metrics every interval seconds, in a background thread.'''
+
+    def log():
+        while True:
+            time.sleep(interval)
+            logger.info(summary())
+
+    threading.Thread(target=log, name='metrics_log', daemon=True).start()
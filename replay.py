@@ -0,0 +1,433 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import email.parser
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import igo
+import bot
+import tiles
+import users
+import archive
+import benchmark
+from service import RoutingPool
+
+# Token of the bot of the replay (the fake Bot API accepts any)
+TOKEN = '123456:replay'
+
+# Seconds to wait for the answers of the queries after the last one is sent
+DRAIN_SECONDS = 30
+
+
+class FakeTelegram:
+    '''
+    Stand-in of the Telegram Bot API (https://core.telegram.org/bots/api) for the bot of the replay: it gives the bot
+    the updates added with send (getUpdates), and passes every answer of the bot (sendMessage, sendPhoto...) to
+    on_answer(chat, method, parameters). The other methods succeed without doing anything.
+    '''
+
+    def __init__(self, on_answer):
+        self.on_answer = on_answer
+        self.condition = threading.Condition()
+        self.updates = []  # updates not confirmed by the bot yet
+        self.next_update_id = 1
+        self.next_message_id = 1
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                result = fake.call(method, _parameters(self.headers.get('Content-Type', ''), body))
+                content = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                try:
+                    self.wfile.write(content)
+                except ConnectionError:  # the bot stopped waiting for the updates
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/bot"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def send(self, message):
+        '''Adds an update with the given message (dict, see _message) for the bot.'''
+        with self.condition:
+            self.updates.append({'update_id': self.next_update_id, 'message': message})
+            self.next_update_id += 1
+            self.condition.notify_all()
+
+    def call(self, method, parameters):
+        '''Returns the result of the given method of the Bot API.'''
+        if method == 'getMe':
+            return {'id': int(TOKEN.split(':')[0]), 'is_bot': True, 'first_name': 'iGo DJ',
+                    'username': 'igo_replay_bot'}
+
+        if method == 'getUpdates':
+            # the updates before offset are confirmed, and if there is none we wait for them up to timeout seconds
+            offset = int(parameters.get('offset') or 0)
+            deadline = time.monotonic() + float(parameters.get('timeout') or 0)
+            with self.condition:
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+                while not self.updates and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                return self.updates[:int(parameters.get('limit') or 100)]
+
+        if method.startswith('send'):
+            chat = int(parameters['chat_id'])
+            self.on_answer(chat, method, parameters)
+            with self.condition:
+                message_id = self.next_message_id
+                self.next_message_id += 1
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat, 'type': 'private'},
+                    'text': parameters.get('text', parameters.get('caption', ''))}
+
+        return True
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+def _parameters(content_type, body):
+    '''Returns the parameters (dict from name to string or bytes) of a request of the Bot API.'''
+    if content_type.startswith('multipart/form-data'):
+        headers = b'Content-Type: ' + content_type.encode() + b'\r\n\r\n'
+        message = email.parser.BytesParser().parsebytes(headers + body)
+        parameters = {}
+        for part in message.get_payload():
+            content = part.get_payload(decode=True)
+            name = part.get_param('name', header='content-disposition')
+            parameters[name] = content if part.get_filename() else content.decode()
+        return parameters
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    return {name: values[-1] for name, values in urllib.parse.parse_qs(body.decode()).items()}
+
+
+def _message(message_id, chat, user, text=None, location=None):
+    '''Returns a message of the Bot API from the given user, with a command (text) or a location (lat, lon).'''
+    message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat, 'type': 'private'},
+               'from': {'id': user, 'is_bot': False, 'first_name': f"User {user}"}}
+    if text is not None:
+        message['text'] = text
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if location is not None:
+        message['location'] = {'latitude': location[0], 'longitude': location[1]}
+    return message
+
+
+def synthetic_queries(csr, rate, duration, users, seed=0):
+    '''
+    Returns a stream of /go queries between random points of the graph, at the given rate (queries per second,
+    as a Poisson process) for duration seconds, from the given number of users.
+    Output: list of dicts with the time of the query (seconds since the beginning), its user, its origin and its
+            destination ((latitude, longitude)), like the lines of the files of --queries.
+    '''
+    rng = np.random.default_rng(seed)
+    ys, xs = np.asarray(csr.y), np.asarray(csr.x)
+    queries = []
+    moment = rng.exponential(1 / rate)
+    while moment < duration:
+        queries.append({'time': float(moment), 'user': int(rng.integers(1, users + 1)),
+                        'origin': [float(rng.uniform(ys.min(), ys.max())), float(rng.uniform(xs.min(), xs.max()))],
+                        'destination': [float(rng.uniform(ys.min(), ys.max())),
+                                        float(rng.uniform(xs.min(), xs.max()))]})
+        moment += rng.exponential(1 / rate)
+    return queries
+
+
+def memory():
+    '''
+    Returns the resident memory (in bytes) of this process and of all its children (the workers of the bot).
+    Without /proc (not in Linux), it is the peak of this process, and 0.
+    '''
+    if not os.path.isdir('/proc'):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 0
+
+    def rss(pid):
+        try:
+            with open(f'/proc/{pid}/statm') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            return 0
+
+    children = 0
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open(f'/proc/{name}/stat') as file:
+                    parent = int(file.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if parent == os.getpid():
+                children += rss(name)
+    return rss(os.getpid()), children
+
+
+def latency_statistics(latencies):
+    '''Returns the number, mean, percentiles and maximum of the given latencies (in seconds).'''
+    if len(latencies) == 0:
+        return {'count': 0}
+    return {'count': len(latencies), 'mean': float(np.mean(latencies)),
+            'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)), 'p999': float(np.percentile(latencies, 99.9)),
+            'max': float(np.max(latencies))}
+
+
+class Replay:
+    '''
+    Replays a stream of /go queries through the bot (see bot.build_application) with the fake Bot API, while the
+    igraph is updated with a stream of congestions (see bot.update_igraph), and measures the answers.
+    Every query is sent from its own chat, so its answer is found by the chat.
+    '''
+
+    def __init__(self, queries, highways, congestions, update_interval, sample_interval):
+        self.queries = queries
+        self.highways = highways
+        self.congestions = congestions  # iterable of DataFrames, the first one is used before the replay
+        self.update_interval = update_interval
+        self.sample_interval = sample_interval
+
+        self.lock = threading.Lock()
+        self.sent = {}  # chat -> time when the query was sent
+        self.answers = []  # (time since the beginning, latency, kind), kind is 'route', 'refused' or 'failed'
+        self.updates = []  # (time since the beginning, seconds, version of the igraph)
+        self.timeline = []
+        self.count_sent = 0
+        self.start = None
+        self.finished = threading.Event()
+
+    def on_answer(self, chat, method, parameters):
+        now = time.perf_counter()
+        with self.lock:
+            sent = self.sent.pop(chat, None)
+            if sent is None:
+                return
+            if method == 'sendPhoto':
+                kind = 'route'
+            elif parameters.get('text') in (bot.BUSY, bot.USER_BUSY):
+                kind = 'refused'
+            else:
+                kind = 'failed'
+            self.answers.append((now - self.start, now - sent, kind))
+
+    def update(self):
+        '''Updates the igraph with the congestions, one every update_interval seconds, until the end.'''
+        for i, congestions in enumerate(self.congestions):
+            if self.finished.wait(max(0.0, self.start + (i + 1) * self.update_interval - time.perf_counter())):
+                return
+            begin = time.perf_counter()
+            bot.update_igraph(self.highways, congestions)
+            self.updates.append((begin - self.start, time.perf_counter() - begin, bot.iGRAPH.version))
+
+    def sample(self):
+        '''Adds to the timeline, every sample_interval seconds, the counters of the queries and the memory.'''
+        last = 0
+        while not self.finished.wait(self.sample_interval):
+            rss, workers_rss = memory()
+            with self.lock:
+                recent = [latency for _, latency, kind in self.answers[last:] if kind == 'route']
+                last = len(self.answers)
+                self.timeline.append({
+                    'time': time.perf_counter() - self.start, 'sent': self.count_sent, 'answered': len(self.answers),
+                    'pending': len(self.sent), 'p50': float(np.percentile(recent, 50)) if recent else None,
+                    'p99': float(np.percentile(recent, 99)) if recent else None,
+                    'rss': rss, 'workers_rss': workers_rss, 'igraph_version': bot.iGRAPH.version})
+
+    async def run(self, drain=DRAIN_SECONDS):
+        '''Sends all the queries on time, waits for their answers (up to drain seconds) and returns the results.'''
+        fake = FakeTelegram(self.on_answer)
+        application = bot.build_application(TOKEN, base_url=fake.base_url)
+        message_id = 1
+
+        async with application:
+            await application.start()
+            await application.updater.start_polling(poll_interval=0.0, timeout=1)
+
+            self.start = time.perf_counter()
+            threads = [threading.Thread(target=self.update, daemon=True),
+                       threading.Thread(target=self.sample, daemon=True)]
+            for thread in threads:
+                thread.start()
+
+            # every query is a location (the origin) and the command /go with the coordinates of the destination
+            for chat, query in enumerate(self.queries, 1):
+                await asyncio.sleep(max(0.0, self.start + query['time'] - time.perf_counter()))
+                fake.send(_message(message_id, chat, query['user'], location=query['origin']))
+                with self.lock:
+                    self.sent[chat] = time.perf_counter()
+                    self.count_sent += 1
+                fake.send(_message(message_id + 1, chat, query['user'],
+                                   text="/go {}, {}".format(*query['destination'])))
+                message_id += 2
+
+            deadline = time.perf_counter() + drain
+            while self.sent and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            end = time.perf_counter()
+
+            self.finished.set()
+            for thread in threads:
+                thread.join()
+            await application.updater.stop()
+            await application.stop()
+        fake.shutdown()
+
+        routes = [latency for _, latency, kind in self.answers if kind == 'route']
+        last_answer = max([moment for moment, _, _ in self.answers], default=0.0)
+        rss, workers_rss = memory()
+        return {'queries': {'sent': self.count_sent, 'routes': len(routes),
+                            'refused': sum(1 for _, _, kind in self.answers if kind == 'refused'),
+                            'failed': sum(1 for _, _, kind in self.answers if kind == 'failed'),
+                            'lost': len(self.sent)},
+                'duration': end - self.start,
+                'throughput': len(routes) / last_answer if last_answer > 0 else 0.0,
+                'latency': latency_statistics(routes),
+                'updates': {'count': len(self.updates),
+                            'seconds': latency_statistics([seconds for _, seconds, _ in self.updates])},
+                'memory': {'rss': rss, 'workers_rss': workers_rss,
+                           'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024},
+                'timeline': self.timeline}
+
+
+def run(arguments):
+    '''Runs the replay with the given arguments (see main) in the current directory, and returns the results (dict).'''
+    if arguments.archive:
+        # the recorded congestions of the graph and highways of PLACE
+        graph = igo.get_graph()
+        highways = pd.read_csv(arguments.highways)
+        snapshots = archive.CongestionArchive(arguments.archive).read(arguments.start, arguments.end)
+        first = next(snapshots, (None, None))[1]
+        if first is None:
+            raise ValueError(f"There are no congestions in the archive {arguments.archive}")
+        congestions = (congestions for _, congestions in snapshots)
+    else:
+        # a synthetic city, with a change of the congestions of 10% of the trams in every update
+        city = benchmark.grid_graph(arguments.nodes, arguments.seed)
+        igo.get_initial_itime(city)
+        igo.save_graph(city, igo.GRAPH_FILENAME)
+        graph = igo.get_graph()
+        highways, first = benchmark.fake_feeds(city, arguments.trams, arguments.seed)
+
+        def fake_congestions(previous):
+            for i in range(1, int(arguments.duration // arguments.update_interval) + 1):
+                previous = benchmark.fake_congestions(highways, arguments.seed + i, previous, changed=0.1)
+                yield previous
+        congestions = fake_congestions(first)
+
+    if arguments.queries:
+        with open(arguments.queries) as file:
+            queries = [json.loads(line) for line in file if line.strip()]
+    else:
+        queries = synthetic_queries(igo.get_csr(graph), arguments.rate, arguments.duration, arguments.users,
+                                    arguments.seed)
+    if arguments.record:
+        with open(arguments.record, 'w') as file:
+            file.writelines(json.dumps(query) + '\n' for query in queries)
+
+    # the bot starts like bot.main, with the igraph of the first congestions.
+    # The locations of the replay are not mixed with the ones of the real users.
+    users_directory = tempfile.mkdtemp(prefix='igo-replay-users-')
+    bot.USER_STORE = users.UserStore(os.path.join(users_directory, 'users.sqlite'))
+    bot.GRAPH = graph
+    bot.ROUTING_POOL = RoutingPool() if arguments.workers is None else RoutingPool(workers=arguments.workers)
+    bot.iGRAPH = graph
+    try:
+        bot.update_igraph(highways, first)
+        results = asyncio.run(Replay(queries, highways, congestions, arguments.update_interval,
+                                     arguments.sample_interval).run(arguments.drain))
+    finally:
+        bot.ROUTING_POOL.shutdown()
+        bot.UPDATE_WORKER.shutdown()
+        bot.USER_STORE.close()
+        shutil.rmtree(users_directory, ignore_errors=True)
+
+    csr = igo.get_csr(graph)
+    results['config'] = vars(arguments)
+    results['graph'] = {'nodes': csr.number_of_nodes(), 'edges': csr.number_of_edges(), 'trams': len(highways)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays a stream of /go queries through the bot, with a fake Telegram Bot API, while the igraph '
+                    'is updated with a stream of congestions. Writes the throughput, the latency of the routes and '
+                    'the memory over time as JSON (times in seconds, memory in bytes).')
+    parser.add_argument('--archive', help='directory of an archive of congestions (see archive module) to replay, '
+                                          'with the graph of the current directory (synthetic city by default)')
+    parser.add_argument('--highways', help='csv file of the highways feed of the archive')
+    parser.add_argument('--start', type=float, help='first time of the archive to replay (seconds since the epoch)')
+    parser.add_argument('--end', type=float, help='last time of the archive to replay (seconds since the epoch)')
+    parser.add_argument('--nodes', type=int, default=2500, help='number of intersections of the synthetic city')
+    parser.add_argument('--trams', type=int, default=500, help='number of highways of the synthetic city')
+    parser.add_argument('--queries', help='file with the queries to replay, a JSON per line with their time, user, '
+                                          'origin and destination (synthetic queries by default)')
+    parser.add_argument('--record', help='file where the queries are written, to replay them again')
+    parser.add_argument('--rate', type=float, default=5, help='synthetic queries per second')
+    parser.add_argument('--users', type=int, default=100, help='number of users of the synthetic queries')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of synthetic queries')
+    parser.add_argument('--update-interval', type=float, default=20, help='seconds between the igraph updates')
+    parser.add_argument('--sample-interval', type=float, default=1, help='seconds between the points of the timeline')
+    parser.add_argument('--drain', type=float, default=DRAIN_SECONDS, help='seconds to wait for the last answers')
+    parser.add_argument('--workers', type=int, help='routing workers (see service module, one for every core by '
+                                                    'default), their queue is IGO_ROUTING_QUEUE_SIZE')
+    parser.add_argument('--real-tiles', action='store_true', help='render the maps with the real tile server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file where the results are written (standard output by default)')
+    arguments = parser.parse_args()
+    if arguments.archive and not arguments.highways:
+        parser.error('--archive needs --highways')
+
+    # the workers of the bot are new processes, so they get the local tile server by the environment
+    tile_server = None
+    if not arguments.real_tiles:
+        tile_server = benchmark.TileServer()
+        os.environ['IGO_TILE_URL'] = tile_server.url_template
+        tiles.TILE_URL_TEMPLATE = tile_server.url_template
+
+    # the synthetic city and all its files are in a temporary directory
+    output = os.path.abspath(arguments.output) if arguments.output else None
+    for name in ('archive', 'highways', 'queries', 'record'):
+        if getattr(arguments, name):
+            setattr(arguments, name, os.path.abspath(getattr(arguments, name)))
+    directory = None if arguments.archive else tempfile.mkdtemp(prefix='igo-replay-')
+    current_directory = os.getcwd()
+    if directory is not None:
+        os.chdir(directory)
+    try:
+        results = run(arguments)
+    finally:
+        os.chdir(current_directory)
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+        if tile_server is not None:
+            tile_server.shutdown()
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
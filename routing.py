@@ -0,0 +1,668 @@
+import os
+import heapq
+import json
+import mmap
+import threading
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+# Mean radius of the earth in meters, the same one osmnx uses for its great circle distances.
+EARTH_RADIUS = 6371009
+
+# Binary format of the files of arrays (see save_arrays): magic string, version and alignment of the arrays in bytes
+ARRAYS_MAGIC = b'IGOARRAY'
+ARRAYS_VERSION = 1
+ARRAYS_ALIGNMENT = 64
+CSR_ARRAYS = ['node_ids', 'x', 'y', 'indptr', 'indices', 'length', 'itime']
+
+# Number of searches of travel_matrices done at once (it uses chunk_size * number of nodes * 8 bytes several times)
+MATRIX_CHUNK_SIZE = 64
+
+# Algorithms of shortest_path (see search), and number of landmarks of the ALT heuristic (see Landmarks)
+SEARCH_METHODS = ['dijkstra', 'bidirectional', 'astar', 'alt']
+LANDMARKS = 8
+
+
+class NoPath(Exception):
+    '''Raised when there is no path between the given origin and destination.'''
+    pass
+
+
+class CSRGraph:
+    '''
+    Directed graph stored in contiguous arrays using the CSR (compressed sparse row) layout.
+    Nodes are identified by their position (0..n-1), the original IDs are kept in node_ids.
+    The edges leaving node u are the positions indptr[u]..indptr[u+1]-1 of the edge arrays.
+    Attributes:
+           - node_ids: int64 array with the original ID (OSM ID) of every node, sorted. It is None in a slim graph
+             (see load), whose nodes are only identified by their position.
+           - x, y: float64 arrays with the longitude and the latitude of every node.
+           - indptr: int32 array of size n+1.
+           - indices: int32 array with the head (destination node) of every edge.
+           - length: float32 array with the length (in meters) of every edge.
+           - itime: float32 array with the itime (in seconds) of every edge.
+           - node_index: NodeIndex of the nodes (built when it is first needed).
+           - metric: customized contraction hierarchy for itime (see cch module) used to speed up the queries, or None.
+           - version: number of the weight snapshot (see with_itime), 0 for the base graph.
+           - hierarchy: contraction hierarchy of the graph (see cch module), or None.
+           - metadata: dict with additional information about the graph (for instance, its place).
+           - congestion: dict with the congestions the weight snapshot was built from (see igo.build_igraph), or None.
+           - reverse: the edges sorted by their head (see reverse_edges), built when they are first needed.
+           - landmarks: Landmarks of the ALT heuristic (see search), or None.
+           - speed_bounds: dict from the name of an edge array to the maximum speed of the edges in meters per unit
+             of that weight (see search), computed when it is first needed.
+           - filename: file the graph was loaded from (see load), or None. A slim graph reads the OSM IDs of its nodes
+             from it (see load_node_ids).
+    '''
+
+    def __init__(self, node_ids, x, y, indptr, indices, length, itime, node_index=None, metric=None, version=0,
+                 hierarchy=None, metadata=None):
+        self.node_ids = np.ascontiguousarray(node_ids, dtype=np.int64) if node_ids is not None else None
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.indptr = np.ascontiguousarray(indptr, dtype=np.int32)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int32)
+        self.length = np.ascontiguousarray(length, dtype=np.float32)
+        self.itime = np.ascontiguousarray(itime, dtype=np.float32)
+        self.node_index = node_index
+        self.metric = metric
+        self.version = version
+        self.hierarchy = hierarchy
+        self.metadata = metadata if metadata is not None else {}
+        self.congestion = None
+        self.reverse = None
+        self.landmarks = None
+        self.speed_bounds = {}
+        self.filename = None
+
+    @classmethod
+    def from_networkx(cls, graph):
+        '''
+        Builds the CSRGraph of the given graph.
+        Input: Networkx MultiDiGraph (Osmnx Graph) with the node attributes x, y and the edge attributes length, itime.
+        Output: CSRGraph.
+        Prec: The graph has at most one edge between two nodes.
+        '''
+        node_ids = np.array(sorted(graph.nodes), dtype=np.int64)
+        position = {node: i for i, node in enumerate(node_ids.tolist())}
+        x = np.array([graph.nodes[node]['x'] for node in node_ids.tolist()], dtype=np.float64)
+        y = np.array([graph.nodes[node]['y'] for node in node_ids.tolist()], dtype=np.float64)
+
+        edges = [(position[u], position[v], attr['length'], attr['itime']) for u, v, attr in graph.edges(data=True)]
+        tails = np.array([edge[0] for edge in edges], dtype=np.int32)
+        heads = np.array([edge[1] for edge in edges], dtype=np.int32)
+        length = np.array([edge[2] for edge in edges], dtype=np.float32)
+        itime = np.array([edge[3] for edge in edges], dtype=np.float32)
+
+        # we sort the edges by their tail, so the edges leaving every node are contiguous
+        order = np.lexsort((heads, tails))
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(tails, minlength=len(node_ids)), out=indptr[1:])
+
+        metadata = {key: value for key, value in graph.graph.items() if isinstance(value, (str, int, float))}
+        return cls(node_ids, x, y, indptr, heads[order], length[order], itime[order], metadata=metadata)
+
+    def to_networkx(self):
+        '''
+        Returns the Networkx MultiDiGraph of this graph, with the node attributes x, y and the edge attributes
+        length and itime (for instance, to plot it with osmnx).
+        '''
+        import networkx as nx
+
+        # the nodes of a slim graph are identified by their positions
+        ids = self.node_ids if self.node_ids is not None else np.arange(self.number_of_nodes(), dtype=np.int64)
+        graph = nx.MultiDiGraph(**self.metadata)
+        graph.add_nodes_from((node, {'x': x, 'y': y})
+                             for node, x, y in zip(ids.tolist(), self.x.tolist(), self.y.tolist()))
+        tails = np.repeat(ids, np.diff(self.indptr)).tolist()
+        heads = ids[self.indices].tolist()
+        graph.add_edges_from((u, v, {'length': length, 'itime': itime})
+                             for u, v, length, itime in zip(tails, heads, self.length.tolist(), self.itime.tolist()))
+        return graph
+
+    def save(self, filename):
+        '''
+        Saves the graph (its arrays and metadata) into the given filename, see save_arrays.
+        The OSM IDs of a slim graph are copied from the file it was loaded from, if any.
+        '''
+        arrays = {name: getattr(self, name) for name in CSR_ARRAYS if getattr(self, name) is not None}
+        if self.node_ids is None and self.filename is not None:
+            arrays['node_ids'] = load_node_ids(self.filename)
+        save_arrays(filename, arrays, self.metadata)
+
+    @classmethod
+    def load(cls, filename, slim=False):
+        '''
+        Loads the graph saved in the given filename. Its arrays are memory-mapped (see load_arrays), so the
+        loading is almost immediate and the processes that load the same file share its memory.
+        If slim is True, the graph only has what the routing and the rendering need: its nodes are identified by their
+        positions (int32, like the edges) and the OSM IDs stay in the file, as a side table (see load_node_ids).
+        '''
+        arrays, metadata = load_arrays(filename)
+        if slim:
+            arrays['node_ids'] = None
+        graph = cls(*[arrays.get(name) for name in CSR_ARRAYS], metadata=metadata)
+        graph.filename = filename
+        return graph
+
+    def with_itime(self, itime, version):
+        '''
+        Returns a weight snapshot of this graph: a CSRGraph that shares all the arrays of this one
+        (nodes, edges, length, NodeIndex and reversed edges) except itime, which is the given one.
+        It keeps the landmarks of this graph, which have to be refreshed for the new itime (see Landmarks.refresh).
+        Input: - itime: array with the itime of every edge.
+               - version: number that identifies the snapshot.
+        Output: CSRGraph, whose itime is read-only.
+        '''
+        if self.node_index is None:
+            self.node_index = NodeIndex(self.node_ids, self.x, self.y)
+        snapshot = CSRGraph(self.node_ids, self.x, self.y, self.indptr, self.indices, self.length, itime,
+                            node_index=self.node_index, version=version, hierarchy=self.hierarchy,
+                            metadata=self.metadata)
+        snapshot.itime.flags.writeable = False
+        snapshot.reverse = self.reverse
+        snapshot.landmarks = self.landmarks
+        snapshot.filename = self.filename
+        return snapshot
+
+    def freeze(self):
+        '''Makes all the arrays of the graph read-only, so it can be safely shared.'''
+        for name in CSR_ARRAYS:
+            if getattr(self, name) is not None:
+                getattr(self, name).flags.writeable = False
+        return self
+
+    def number_of_nodes(self):
+        return len(self.indptr) - 1
+
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def edge_positions(self, tails, heads):
+        '''
+        Returns the positions of the edges from tails[i] to heads[i] (arrays of node positions), -1 if they do not exist.
+        '''
+        # the edges are sorted by (tail, head), so the key tail * n + head of the edges is sorted too
+        n = self.number_of_nodes()
+        tails = np.asarray(tails, dtype=np.int64)
+        heads = np.asarray(heads, dtype=np.int64)
+        edge_tails = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+        edge_keys = edge_tails * n + self.indices
+        keys = tails * n + heads
+        positions = np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)
+        return np.where(edge_keys[positions] == keys, positions, -1)
+
+    def edge_position(self, u, v):
+        '''Returns the position of the edge from u to v (positions of the nodes), or -1 if it does not exist.'''
+        start, end = self.indptr[u], self.indptr[u+1]
+        found = np.nonzero(self.indices[start:end] == v)[0]
+        return int(start + found[0]) if len(found) > 0 else -1
+
+    def reverse_edges(self):
+        '''
+        Returns the edges sorted by their head, in CSR layout: the edges entering node v are the positions
+        reverse_edges[reverse_indptr[v]..reverse_indptr[v+1]-1] of the edge arrays, and their tails are reverse_tails.
+        They are built the first time (they only depend on the topology, so they are shared by the weight snapshots).
+        Output: reverse_indptr, reverse_tails and reverse_edges (int32 arrays).
+        '''
+        if self.reverse is None:
+            n = self.number_of_nodes()
+            tails = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.indptr))
+            order = np.argsort(self.indices, kind='stable').astype(np.int32)
+            reverse_indptr = np.zeros(n + 1, dtype=np.int32)
+            np.cumsum(np.bincount(self.indices, minlength=n), out=reverse_indptr[1:])
+            self.reverse = (reverse_indptr, tails[order], order)
+        return self.reverse
+
+
+def load_node_ids(filename):
+    '''
+    Returns the original IDs (OSM IDs) of the nodes of the graph saved in the given filename (see CSRGraph.save),
+    memory-mapped. It is the side table of the slim graphs: node_ids[position] is the ID of the node in that position.
+    '''
+    return load_arrays(filename)[0]['node_ids']
+
+
+def save_arrays(filename, arrays, metadata=None):
+    '''
+    Saves the given numpy arrays into a binary file that can be memory-mapped (see load_arrays).
+    The file has the magic string ARRAYS_MAGIC, the length of the header (8 bytes, little endian), the header
+    (JSON with the format version, the metadata and the dtype, shape and offset of every array), and the raw data of
+    the arrays, every one aligned to ARRAYS_ALIGNMENT bytes.
+    The file is written into a temporary file and then replaced atomically, so the processes that have the previous
+    one memory-mapped keep reading it, and no process ever loads it half written.
+    Input: - filename: name of the file.
+           - arrays: dict from name to numpy array.
+           - metadata: dict that can be saved as JSON.
+    No output.
+    '''
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # we compute the offsets of the arrays from the beginning of the data
+    descriptions = {}
+    offset = 0
+    for name, array in arrays.items():
+        descriptions[name] = {'dtype': array.dtype.newbyteorder('<').str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+
+    header = json.dumps({'version': ARRAYS_VERSION, 'metadata': metadata or {}, 'arrays': descriptions}).encode()
+    data_start = -(-(len(ARRAYS_MAGIC) + 8 + len(header)) // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+
+    temporary_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary_filename, 'wb') as file:
+            file.write(ARRAYS_MAGIC)
+            file.write(len(header).to_bytes(8, 'little'))
+            file.write(header)
+            for name, array in arrays.items():
+                file.seek(data_start + descriptions[name]['offset'])
+                file.write(array.astype(descriptions[name]['dtype'], copy=False).tobytes())
+            file.truncate(data_start + offset)
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+
+
+def load_arrays(filename):
+    '''
+    Loads the arrays saved with save_arrays. The file is memory-mapped (read only): the arrays are views of it,
+    so nothing is read until it is needed and all the processes share the same physical pages.
+    Input: name of the file.
+    Output: dict from name to (read-only) numpy array, and dict with the metadata.
+    Raises ValueError if the file is not a file of arrays of this version, or it is truncated.
+    '''
+    with open(filename, 'rb') as file:
+        if file.read(len(ARRAYS_MAGIC)) != ARRAYS_MAGIC:
+            raise ValueError(f"'{filename}' is not a file of arrays")
+        header_length = int.from_bytes(file.read(8), 'little')
+        header = json.loads(file.read(header_length))
+        if not isinstance(header, dict) or header.get('version') != ARRAYS_VERSION:
+            version = header.get('version') if isinstance(header, dict) else None
+            raise ValueError(f"Unknown version {version} of '{filename}'")
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data_start = -(-(len(ARRAYS_MAGIC) + 8 + header_length) // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+    arrays = {}
+    for name, description in header['arrays'].items():
+        dtype = np.dtype(description['dtype'])
+        count = int(np.prod(description['shape'], dtype=np.int64))
+        if count == 0:
+            arrays[name] = np.empty(description['shape'], dtype=dtype)
+        else:
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=data_start + description['offset'])
+            arrays[name] = array.reshape(description['shape'])
+
+    return arrays, header['metadata']
+
+
+class NodeIndex:
+    '''
+    Spatial index (KD-tree) over the nodes of a graph, used to snap points to their nearest node.
+    The coordinates are projected to meters with an equirectangular projection centered in the graph,
+    which is accurate enough at the scale of a city.
+    Attributes:
+           - node_ids: int64 array with the original ID of every node, sorted (same order as CSRGraph),
+             or None for a slim graph.
+    '''
+
+    def __init__(self, node_ids, x, y):
+        self.node_ids = np.ascontiguousarray(node_ids, dtype=np.int64) if node_ids is not None else None
+        self.lat0 = float(np.mean(y)) if len(y) > 0 else 0.0
+        self.tree = cKDTree(self._project(np.asarray(y), np.asarray(x)))
+
+    def _project(self, lat, lon):
+        '''Returns the (n, 2) array of the given coordinates in meters.'''
+        x = EARTH_RADIUS * np.radians(lon) * np.cos(np.radians(self.lat0))
+        y = EARTH_RADIUS * np.radians(lat)
+        return np.column_stack((x, y))
+
+    def nearest(self, lat, lon):
+        '''
+        Returns the positions of the nodes nearest to the given points.
+        Input: lat, lon: arrays (or lists) with the latitudes and longitudes of the points.
+        Output: int array with the position of the nearest node of every point.
+        '''
+        lat = np.asarray(lat, dtype=np.float64).reshape(-1)
+        lon = np.asarray(lon, dtype=np.float64).reshape(-1)
+        _, positions = self.tree.query(self._project(lat, lon))
+        return np.asarray(positions, dtype=np.int64)
+
+
+def nearest_node(csr, point):
+    '''
+    Returns the position of the node of csr nearest to the given point (latitude, longitude).
+    '''
+    return int(nearest_nodes(csr, [point[0]], [point[1]])[0])
+
+
+def nearest_nodes(csr, lat, lon):
+    '''
+    Returns the positions of the nodes of csr nearest to the given points (arrays of latitudes and longitudes).
+    It uses the NodeIndex of csr, which is built the first time it is needed.
+    '''
+    if csr.node_index is None:
+        csr.node_index = NodeIndex(csr.node_ids, csr.x, csr.y)
+    return csr.node_index.nearest(lat, lon)
+
+
+def shortest_path(csr, source, target, weight='itime', method='dijkstra'):
+    '''
+    Returns the shortest path from source to target.
+    Input: - csr (CSRGraph).
+           - source, target: positions of the nodes.
+           - weight: name of the edge array to minimize ('itime' or 'length').
+           - method: algorithm of the search (see search), they all give a path of the same weight.
+    Output: list of positions of the nodes of the path.
+    Raises NoPath if target can not be reached from source.
+    '''
+    return search(csr, source, target, weight, method)[0]
+
+
+def search(csr, source, target, weight='itime', method='dijkstra'):
+    '''
+    Finds the shortest path from source to target with the given method:
+       - 'dijkstra': Dijkstra's algorithm, it settles all the nodes nearer than the target.
+       - 'bidirectional': Dijkstra's algorithm from source and backwards from target at once, until they meet.
+       - 'astar': A*, guided to the target by a lower bound of the weight of the rest of the path: the great circle
+         distance divided by the maximum speed of the edges (see speed_bound).
+       - 'alt': A* with the lower bounds given by the landmarks of csr (see Landmarks), and the one of 'astar'.
+    The lower bounds never overestimate, so all the methods give a shortest path (when there are several paths with
+    the same weight, they can choose different ones).
+    Input: the same as shortest_path.
+    Output: list of positions of the nodes of the path, and number of nodes settled by the search.
+    Raises NoPath if target can not be reached from source.
+    '''
+    weights = getattr(csr, weight)
+    if method == 'bidirectional':
+        pred_edge, succ_edge, meeting, settled = _bidirectional_dijkstra(csr, source, target, weights)
+    else:
+        potential = None
+        if method == 'astar':
+            potential = distance_bounds(csr, target, weight)
+        elif method == 'alt':
+            landmarks = csr.landmarks
+            if landmarks is None or landmarks.weight != weight or landmarks.weights is not weights:
+                raise ValueError("The landmarks of the graph are not computed for its weights (see Landmarks)")
+            potential = np.maximum(landmarks.bounds(target), distance_bounds(csr, target, weight))
+        elif method != 'dijkstra':
+            raise ValueError(f"Unknown method {method}, it must be one of {SEARCH_METHODS}")
+        pred_edge, settled = _dijkstra(csr, source, target, weights, potential)
+        succ_edge, meeting = {target: -1}, target
+
+    if meeting is None or meeting not in pred_edge:
+        raise NoPath(f"No path from {source} to {target}")
+
+    # we follow the predecessors from the meeting node back to the source, and the successors up to the target
+    route = [meeting]
+    edge = pred_edge[meeting]
+    while edge != -1:
+        node = _edge_tail(csr, edge)
+        route.append(node)
+        edge = pred_edge[node]
+    route.reverse()
+    edge = succ_edge[meeting]
+    while edge != -1:
+        node = int(csr.indices[edge])
+        route.append(node)
+        edge = succ_edge[node]
+    return route, settled
+
+
+def speed_bound(csr, weight='itime'):
+    '''
+    Returns the maximum speed of the edges of csr, in meters (of great circle distance between their ends) per unit of
+    the given weight. It is computed the first time and kept in csr.speed_bounds.
+    '''
+    if weight not in csr.speed_bounds:
+        n = csr.number_of_nodes()
+        tails = np.repeat(np.arange(n), np.diff(csr.indptr))
+        distances = great_circle(csr.y[tails], csr.x[tails], csr.y[csr.indices], csr.x[csr.indices])
+        weights = np.asarray(getattr(csr, weight), dtype=np.float64)
+        usable = np.isfinite(weights) & (distances > 0)
+        with np.errstate(divide='ignore'):
+            speeds = distances[usable] / weights[usable]
+        csr.speed_bounds[weight] = float(speeds.max()) if len(speeds) > 0 else float('inf')
+    return csr.speed_bounds[weight]
+
+
+def distance_bounds(csr, target, weight='itime'):
+    '''
+    Returns the lower bounds of the weight of the paths from every node to target: their great circle distance
+    divided by the maximum speed (see speed_bound). They are consistent (the bound of a node is at most the weight of
+    an edge plus the bound of its head), which A* needs to settle every node only once.
+    '''
+    speed = speed_bound(csr, weight)
+    if speed == float('inf'):
+        return np.zeros(csr.number_of_nodes())
+    # the bounds are lowered a little, so the rounding errors never make them overestimate
+    return great_circle(csr.y, csr.x, csr.y[target], csr.x[target]) / speed * (1 - 1e-9)
+
+
+def great_circle(lat1, lon1, lat2, lon2):
+    '''Returns the great circle distances (in meters) between the given points (arrays or numbers, in degrees).'''
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    h = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+class Landmarks:
+    '''
+    Landmarks of the ALT heuristic (A*, landmarks and triangle inequality): a few nodes far from each other, with the
+    weight of the shortest paths from every landmark to every node and from every node to every landmark.
+    By the triangle inequality, the weight of the paths from v to t is at least d(L, t) - d(L, v) and d(v, L) - d(t, L)
+    for every landmark L, which guides the search much better than the great circle distance when the weights are
+    times (the congestions make some streets much slower than their maximum speed).
+    The landmarks are chosen once for a graph, and their distances are computed again for new weights (see refresh).
+    Attributes: nodes (positions of the landmarks), weight (name of the edge array), weights (the array the distances
+    were computed for), from_landmarks and to_landmarks (float64 arrays of shape (landmarks, nodes)).
+    '''
+
+    def __init__(self, csr, nodes, weight='itime'):
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.weight = weight
+        self.weights = getattr(csr, weight)
+        self.from_landmarks, _ = travel_matrices(csr, self.nodes, np.arange(csr.number_of_nodes()), weight, weight)
+        to_landmarks, _ = travel_matrices(csr, np.arange(csr.number_of_nodes()), self.nodes, weight, weight)
+        self.to_landmarks = np.ascontiguousarray(to_landmarks.T)
+
+    @classmethod
+    def build(cls, csr, count=LANDMARKS, weight='itime'):
+        '''
+        Chooses count landmarks of csr far from each other: every new landmark is the node farthest from the ones
+        already chosen (among the nodes they reach), starting from the node farthest from the first node.
+        '''
+        n = csr.number_of_nodes()
+        nodes = []
+        nearest = None
+        start = 0
+        for _ in range(min(count, n)):
+            distances, _ = travel_matrices(csr, [start], np.arange(n), weight, weight)
+            distances = distances[0]
+            nearest = distances if nearest is None else np.minimum(nearest, distances)
+            candidates = np.where(np.isfinite(nearest), nearest, -1.0)
+            candidates[nodes] = -1.0
+            start = int(np.argmax(candidates))
+            if candidates[start] <= 0:
+                break
+            nodes.append(start)
+            if len(nodes) == 1:
+                nearest = None  # the first node is not a landmark, only the start of the selection
+        return cls(csr, nodes, weight)
+
+    def refresh(self, csr):
+        '''Returns the same landmarks with the distances of the weights of the given graph (a weight snapshot).'''
+        return Landmarks(csr, self.nodes, self.weight)
+
+    def bounds(self, target):
+        '''Returns the lower bounds of the weight of the paths from every node to target.'''
+        with np.errstate(invalid='ignore'):
+            bounds = np.maximum(self.from_landmarks[:, target:target + 1] - self.from_landmarks,
+                                self.to_landmarks - self.to_landmarks[:, target:target + 1])
+        # inf - inf (nodes that a landmark does not reach, and the other way) gives no information
+        bounds = np.where(np.isnan(bounds), 0.0, bounds)
+        return np.maximum(bounds.max(axis=0), 0.0) if len(self.nodes) > 0 else np.zeros(self.from_landmarks.shape[1])
+
+
+def route_cost(csr, route, weight):
+    '''
+    Returns the sum of the weight (edge array name) of the edges of the given route (list of node positions).
+    '''
+    weights = getattr(csr, weight)
+    return sum(float(weights[csr.edge_position(route[i], route[i+1])]) for i in range(len(route)-1))
+
+
+def travel_matrices(csr, sources, targets, weight='itime', other='length', chunk_size=MATRIX_CHUNK_SIZE):
+    '''
+    Returns the matrices of the shortest paths from every source to every target: their weight and their
+    other weight (for instance, the itime of the fastest routes and their length).
+    There is one search for every different source (or target, if there are less targets, searching backwards),
+    so a matrix of hundreds x hundreds of nodes costs hundreds of searches, not one for every pair.
+    The searches are done with scipy (in C), chunk_size at a time, and no route is built.
+    Input: - sources, targets: arrays with positions of nodes.
+           - weight: name of the edge array minimized (edges with an infinite weight are not used).
+           - other: name of the edge array summed along the same paths.
+    Output: two float64 arrays of shape (len(sources), len(targets)), inf where there is no path.
+    '''
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    n = csr.number_of_nodes()
+
+    weights = np.asarray(getattr(csr, weight), dtype=np.float64)
+    others = np.asarray(getattr(csr, other), dtype=np.float64)
+    tails = np.repeat(np.arange(n, dtype=np.int64), np.diff(csr.indptr))
+    heads = np.asarray(csr.indices, dtype=np.int64)
+    usable = np.isfinite(weights)
+    graph = csr_matrix((weights[usable], (tails[usable], heads[usable])), shape=(n, n))
+
+    # we search from the smallest set of nodes: forwards from the sources or backwards from the targets
+    backwards = len(np.unique(targets)) < len(np.unique(sources))
+    if backwards:
+        graph = graph.T.tocsr()
+        starts, ends = targets, sources
+    else:
+        starts, ends = sources, targets
+    unique_starts, start_rows = np.unique(starts, return_inverse=True)
+
+    weight_matrix = np.empty((len(unique_starts), len(ends)))
+    other_matrix = np.empty((len(unique_starts), len(ends)))
+    for first in range(0, len(unique_starts), chunk_size):
+        chunk = unique_starts[first:first+chunk_size]
+        dist, pred = dijkstra(graph, indices=chunk, return_predecessors=True)
+
+        # the other weight of every node is the sum along its branch of the tree of shortest paths. We compute it
+        # for all the nodes at once by pointer jumping: every step adds the sum of the next part of the branch and
+        # jumps to its end, so after k steps the sum of 2^k edges is known.
+        nodes = np.broadcast_to(np.arange(n), pred.shape)
+        reached = pred >= 0
+        if backwards:
+            edges = csr.edge_positions(nodes[reached], pred[reached])
+        else:
+            edges = csr.edge_positions(pred[reached], nodes[reached])
+        total = np.zeros(pred.shape)
+        total[reached] = others[edges]
+        jump = np.where(reached, pred, nodes)
+        while True:
+            next_jump = np.take_along_axis(jump, jump, axis=1)
+            total += np.where(jump != nodes, np.take_along_axis(total, jump, axis=1), 0.0)
+            if np.array_equal(next_jump, jump):
+                break
+            jump = next_jump
+        total[np.isinf(dist)] = np.inf
+
+        weight_matrix[first:first+chunk_size] = dist[:, ends]
+        other_matrix[first:first+chunk_size] = total[:, ends]
+
+    weight_matrix, other_matrix = weight_matrix[start_rows], other_matrix[start_rows]
+    if backwards:
+        return weight_matrix.T, other_matrix.T
+    return weight_matrix, other_matrix
+
+
+def _dijkstra(csr, source, target, weights, potential=None):
+    '''
+    Dijkstra's algorithm from source until target is settled (or the whole graph if target is None).
+    If a potential (array with a lower bound of the weight from every node to target) is given, it is A*:
+    the nodes are settled in order of their distance plus their potential.
+    Returns a dict with the edge used to reach every reached node (-1 for the source), and the number of settled nodes.
+    '''
+    # memoryviews give us fast access to the items of the arrays as python numbers without copying them
+    indptr = memoryview(csr.indptr)
+    indices = memoryview(csr.indices)
+    weights = memoryview(weights)
+    potential = memoryview(np.ascontiguousarray(potential, dtype=np.float64)) if potential is not None else None
+
+    dist = {source: 0.0}
+    pred_edge = {source: -1}
+    settled = set()
+    heap = [(potential[source] if potential is not None else 0.0, source)]
+
+    while heap:
+        _, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u == target:
+            break
+
+        d = dist[u]
+        for edge in range(indptr[u], indptr[u+1]):
+            v = indices[edge]
+            new_d = d + weights[edge]
+            if new_d < dist.get(v, float('inf')):
+                dist[v] = new_d
+                pred_edge[v] = edge
+                heapq.heappush(heap, (new_d + potential[v] if potential is not None else new_d, v))
+
+    return pred_edge, len(settled)
+
+
+def _bidirectional_dijkstra(csr, source, target, weights):
+    '''
+    Dijkstra's algorithm from source and, backwards, from target, alternating the searches until the shortest path
+    found through a node reached by both is not longer than the sum of the minimum distances of both heaps.
+    Returns the edge used to reach every node from source, the edge that leaves every node towards target
+    (-1 for source and target), the node where the shortest path meets (None if there is none)
+    and the number of settled nodes.
+    '''
+    reverse_indptr, reverse_tails, reverse_edges = csr.reverse_edges()
+    graphs = [(memoryview(csr.indptr), memoryview(csr.indices), None),
+              (memoryview(reverse_indptr), memoryview(reverse_tails), memoryview(reverse_edges))]
+    weights = memoryview(weights)
+
+    dists = [{source: 0.0}, {target: 0.0}]
+    edges = [{source: -1}, {target: -1}]
+    settled = [set(), set()]
+    heaps = [[(0.0, source)], [(0.0, target)]]
+    best, meeting = (0.0, source) if source == target else (float('inf'), None)
+
+    while heaps[0] and heaps[1] and heaps[0][0][0] + heaps[1][0][0] < best:
+        side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        d, u = heapq.heappop(heaps[side])
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+
+        indptr, heads, positions = graphs[side]
+        dist, other_dist = dists[side], dists[1 - side]
+        for i in range(indptr[u], indptr[u+1]):
+            v = heads[i]
+            edge = positions[i] if positions is not None else i
+            new_d = d + weights[edge]
+            if new_d < dist.get(v, float('inf')):
+                dist[v] = new_d
+                edges[side][v] = edge
+                heapq.heappush(heaps[side], (new_d, v))
+            # a path from source to target through v
+            if v in other_dist and new_d + other_dist[v] < best:
+                best, meeting = new_d + other_dist[v], v
+
+    return edges[0], edges[1], meeting, len(settled[0]) + len(settled[1])
+
+
+def _edge_tail(csr, edge):
+    '''Returns the tail (origin node) of the edge in the given position.'''
+    return int(np.searchsorted(csr.indptr, edge, side='right')) - 1
@@ -0,0 +1,115 @@
+import time
+import random
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Default parameters of the Scheduler (in seconds)
+INTERVAL = 300
+JITTER = 15
+FIRST_BACKOFF = 10
+MAX_BACKOFF = 300
+
+
+class Scheduler:
+    '''
+    Runs a task periodically in a single background thread, so two runs never overlap.
+       - After a successful run it waits interval seconds, plus or minus a random jitter,
+         so the requests to the servers are not always at the same moment.
+       - After a failed run it retries sooner, waiting first_backoff seconds, doubled after every consecutive failure
+         (up to max_backoff). The exception is printed and the scheduler keeps running.
+    Attributes (read only): last_success (time.time() of the end of the last successful run, None if none yet),
+    last_duration (seconds that it took), failures (number of consecutive failed runs) and last_error.
+    '''
+
+    def __init__(self, task, interval=INTERVAL, jitter=JITTER, first_backoff=FIRST_BACKOFF, max_backoff=MAX_BACKOFF,
+                 name='scheduler'):
+        self.task = task
+        self.interval = interval
+        self.jitter = jitter
+        self.first_backoff = first_backoff
+        self.max_backoff = max_backoff
+
+        self.last_success = None
+        self.last_duration = None
+        self.failures = 0
+        self.last_error = None
+
+        self.stopped = threading.Event()
+        self.wake_up = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        '''Starts the background thread, which runs the task immediately.'''
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        '''Stops the scheduler, waiting for the run in course (if any) to finish.'''
+        self.stopped.set()
+        self.wake_up.set()
+        self.thread.join(timeout)
+
+    def status(self):
+        '''Returns a dictionary with the state of the scheduler (see the attributes).'''
+        return {'last_success': self.last_success, 'last_duration': self.last_duration,
+                'failures': self.failures, 'last_error': self.last_error}
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wake_up.clear()
+            start = time.time()
+            try:
+                self.task()
+            except Exception as error:
+                self.failures += 1
+                self.last_error = repr(error)
+                traceback.print_exc()
+                delay = min(self.first_backoff * 2 ** (self.failures - 1), self.max_backoff)
+            else:
+                self.last_success = time.time()
+                self.last_duration = self.last_success - start
+                self.failures = 0
+                self.last_error = None
+                delay = self.interval + random.uniform(-self.jitter, self.jitter)
+
+            self.wake_up.wait(max(delay, 0))
+
+
+class WorkerProcess:
+    '''
+    A single worker process that runs functions, so the heavy work does not hold the GIL of this process.
+    The process is started the first time it is used, and started again if it dies.
+    Its modules and global variables are kept between calls.
+    '''
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def call(self, function, *args):
+        '''
+        Returns the result of function(*args) in the worker process, waiting for it.
+        The function, its arguments and its result must be picklable (the function must be defined in a module).
+        '''
+        with self.lock:
+            if self.executor is None:
+                # a new process (not a fork), so it does not inherit the threads and locks of this one
+                self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            executor = self.executor
+
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            raise
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -0,0 +1,162 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import igo
+import routing
+import metrics
+
+# Number of worker processes (by default, one for every core) and maximum number of routes waiting or in course
+ROUTING_WORKERS = int(os.environ.get('IGO_ROUTING_WORKERS', os.cpu_count() or 1))
+ROUTING_QUEUE_SIZE = int(os.environ.get('IGO_ROUTING_QUEUE_SIZE', 4 * ROUTING_WORKERS))
+
+# Directory of the weight snapshots read by the workers, and number of them that are kept
+SNAPSHOTS_DIRECTORY = 'snapshots'
+KEPT_SNAPSHOTS = 2
+
+# Graph and igraph of every worker process (see _start_worker and _compute_route)
+WORKER_STATE = {'graph': None, 'igraph': None}
+
+
+class PoolBusy(Exception):
+    '''The queue of the RoutingPool is full, the request has to be tried later.'''
+    pass
+
+
+class RoutingPool:
+    '''
+    Pool of worker processes that find and plot shortest paths, so the routes are computed in parallel
+    (with threads they would wait for each other, because of the GIL).
+    Every worker loads the graph of igo.get_graph() (memory-mapped, so they all share its memory), and the weights
+    of every igraph are saved once into a snapshot file (see igo.save_snapshot) that the workers memory-map too.
+    The results are kept in the route cache (see igo.RouteCache), so only new routes are sent to the workers.
+    It can be used from several threads at once.
+    '''
+
+    def __init__(self, workers=ROUTING_WORKERS, queue_size=ROUTING_QUEUE_SIZE, directory=SNAPSHOTS_DIRECTORY,
+                 cache=igo.ROUTE_CACHE):
+        self.directory = directory
+        self.cache = cache
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.snapshots = {}  # version -> filename, from the oldest to the newest
+        self.jobs = {}  # version -> number of routes queued or in course that read its snapshot
+        self.pending = threading.BoundedSemaphore(queue_size)
+
+        # new processes (not forks), so they do not inherit the threads and locks of this one
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_start_worker)
+
+    def publish(self, igraph):
+        '''
+        Saves the weights of the given igraph, so the workers can use it, and returns the name of its snapshot.
+        The oldest snapshots are deleted when no route queued or in course reads them.
+        '''
+        with self.lock:
+            return self._publish(igraph)
+
+    def _publish(self, igraph):
+        '''Prec: lock taken.'''
+        if igraph.version in self.snapshots:
+            return self.snapshots[igraph.version]
+
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, f"igraph-{os.getpid()}-{igraph.version}.snapshot")
+        igo.save_snapshot(igraph, filename)
+        self.snapshots[igraph.version] = filename
+        self._remove_snapshots()
+        return filename
+
+    def _release_snapshot(self, version):
+        '''A route that reads the snapshot of the given version has finished.'''
+        with self.lock:
+            self.jobs[version] -= 1
+            if self.jobs[version] == 0:
+                del self.jobs[version]
+                self._remove_snapshots()
+
+    def _remove_snapshots(self):
+        '''Deletes the snapshots older than the KEPT_SNAPSHOTS newest ones that no route reads. Prec: lock taken.'''
+        for version in list(self.snapshots)[:-KEPT_SNAPSHOTS]:
+            if version in self.jobs:
+                continue
+            try:
+                os.remove(self.snapshots[version])
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # in Windows a file cannot be deleted while a worker still maps it, we try again later
+                continue
+            del self.snapshots[version]
+
+    def submit(self, igraph, origin, destination):
+        '''
+        Finds and plots the shortest path from origin to destination in the given igraph, in a worker process.
+        Input: - igraph (CSRGraph, see routing module), it is published if it was not.
+               - origin and destination, in the format (latitude, longitude).
+        Output: Future, whose result is the same as igo.render_shortest_path: image (bytes), aprox_time and distance.
+        Raises PoolBusy if there are already queue_size routes waiting or in course.
+        '''
+        # Snapping the points is fast, and the cached routes do not need a worker.
+        origin = routing.nearest_node(igraph, origin)
+        destination = routing.nearest_node(igraph, destination)
+        key = (origin, destination, igraph.version)
+
+        future = Future()
+        result = self.cache.get(key) if self.cache is not None else None
+        if result is not None:
+            future.set_result(result[1:])
+            return future
+
+        if not self.pending.acquire(blocking=False):
+            raise PoolBusy(f"There are already {self.queue_size} routes in course")
+        try:
+            with self.lock:
+                filename = self._publish(igraph)
+                self.jobs[igraph.version] = self.jobs.get(igraph.version, 0) + 1
+        except BaseException:
+            self.pending.release()
+            raise
+        try:
+            job = self.executor.submit(metrics.collecting, _compute_route,
+                                       filename, igraph.version, origin, destination)
+        except BaseException:
+            self._release_snapshot(igraph.version)
+            self.pending.release()
+            raise
+
+        def done(job):
+            self._release_snapshot(igraph.version)
+            self.pending.release()
+            if job.exception() is not None:
+                future.set_exception(job.exception())
+                return
+            # the metrics of the worker are added to the ones of this process
+            result, observations = job.result()
+            metrics.merge(observations)
+            if self.cache is not None:
+                self.cache.put(key, result)
+            future.set_result(result[1:])
+
+        job.add_done_callback(done)
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def _start_worker():
+    '''Loads the graph in a new worker process.'''
+    WORKER_STATE['graph'] = igo.get_graph()
+
+
+def _compute_route(filename, version, origin, destination):
+    '''
+    Runs in a worker process: loads the snapshot of the given version if it is not the current one,
+    and returns the result of igo.compute_shortest_path (route, image, aprox_time, distance).
+    '''
+    igraph = WORKER_STATE['igraph']
+    if igraph is None or igraph.version != version:
+        igraph = igo.load_snapshot(WORKER_STATE['graph'], filename)
+        WORKER_STATE['igraph'] = igraph
+    return igo.compute_shortest_path(igraph, origin, destination)
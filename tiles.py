@@ -0,0 +1,244 @@
+import os
+import math
+import hashlib
+import threading
+import argparse
+from urllib.parse import urlsplit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from staticmap import StaticMap
+import metrics
+
+# Tile server (it can be changed with the environment variable IGO_TILE_URL, for instance to use a local one).
+# If it is not set, we use the default server of staticmap.
+TILE_URL_TEMPLATE = os.environ.get('IGO_TILE_URL') or None
+TILE_HEADERS = {'User-Agent': 'iGoDJ/1.0 (+https://github.com/didac-alonso/iGO)'}
+TILE_TIMEOUT = (5, 15)  # (connect, read) in seconds
+
+# Public tile servers, whose usage policies forbid bulk downloads (see prewarm)
+PUBLIC_TILE_HOSTS = ('openstreetmap.org', 'komoot.de')
+
+# Cache sizes, in bytes
+TILES_DIRECTORY = 'tiles'
+MEMORY_CACHE_SIZE = 64 * 2**20
+DISK_CACHE_SIZE = 1024 * 2**20
+
+# Metrics of the tiles (see metrics module)
+TILES_TOTAL = metrics.counter('igo_tiles_total', 'Tiles used by the maps, by where they were found', 'source')
+STAGE_SECONDS = metrics.histogram('igo_stage_seconds', 'Time spent in every stage of iGo (seconds)', 'stage')
+
+# Concurrent downloads of the maps of the bot (shared by all of them, as the public servers ask)
+FETCH_CONNECTIONS = 2
+
+# Zoom levels of the maps we render (see prewarm) and concurrent downloads when prewarming a self-hosted server
+PREWARM_ZOOMS = range(11, 17)
+PREWARM_WORKERS = 16
+
+
+class TileCache:
+    '''
+    Cache of map tiles shared by all the maps. It has two levels:
+       - memory: the most recently used tiles, up to memory_size bytes (LRU).
+       - disk: the tiles saved in the directory, up to disk_size bytes (the least recently used are deleted).
+    The tiles that are not cached are downloaded with a pool of up to connections persistent connections.
+    It can be used from several threads at once.
+    '''
+
+    def __init__(self, directory=TILES_DIRECTORY, memory_size=MEMORY_CACHE_SIZE, disk_size=DISK_CACHE_SIZE,
+                 timeout=TILE_TIMEOUT, headers=TILE_HEADERS, connections=FETCH_CONNECTIONS):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.timeout = timeout
+        self.headers = headers
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # url -> bytes, from the least to the most recently used
+        self.memory_used = 0
+        self.disk = None  # filename -> size, from the least to the most recently used (see _load_disk)
+        self.disk_used = 0
+
+        # staticmap downloads the tiles of a map with several threads, we only let connections of them download at once
+        self.downloads = threading.BoundedSemaphore(connections)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url):
+        '''
+        Returns the status code and the content (bytes) of the tile of the given url.
+        The status code is 200 if the tile was cached.
+        '''
+        filename = os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + '.png')
+
+        with self.lock:
+            if url in self.memory:
+                self.memory.move_to_end(url)
+                TILES_TOTAL.increment('memory')
+                return 200, self.memory[url]
+            self._load_disk()
+            on_disk = filename in self.disk
+            if on_disk:
+                self.disk.move_to_end(filename)
+
+        if on_disk:
+            try:
+                with open(filename, 'rb') as file:
+                    content = file.read()
+                self._add_to_memory(url, content)
+                TILES_TOTAL.increment('disk')
+                return 200, content
+            except OSError:  # it has been deleted meanwhile, we download it
+                pass
+
+        with self.downloads, STAGE_SECONDS.time('tile_download'):
+            response = self.session.get(url, timeout=self.timeout, headers=self.headers)
+        TILES_TOTAL.increment('download')
+        if response.status_code == 200:
+            self._add_to_memory(url, response.content)
+            self._add_to_disk(filename, response.content)
+        return response.status_code, response.content
+
+    def _add_to_memory(self, url, content):
+        with self.lock:
+            if url not in self.memory:
+                self.memory[url] = content
+                self.memory_used += len(content)
+            while self.memory_used > self.memory_size and self.memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_used -= len(evicted)
+
+    def _add_to_disk(self, filename, content):
+        # we write into a temporary file first, so the other threads and processes never read a partial tile
+        # (the processes that share the directory do not share its size, so it can exceed disk_size a bit)
+        temporary_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_filename, 'wb') as file:
+            file.write(content)
+        os.replace(temporary_filename, filename)
+
+        evicted = []
+        with self.lock:
+            if filename not in self.disk:
+                self.disk[filename] = len(content)
+                self.disk_used += len(content)
+            while self.disk_used > self.disk_size and self.disk:
+                evicted_filename, size = self.disk.popitem(last=False)
+                self.disk_used -= size
+                evicted.append(evicted_filename)
+
+        for evicted_filename in evicted:
+            try:
+                os.remove(evicted_filename)
+            except OSError:
+                pass
+
+    def _load_disk(self):
+        '''The first time, it reads the tiles saved in the directory, from the oldest to the newest. Prec: lock taken.'''
+        if self.disk is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.png')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self.disk = OrderedDict((entry.path, entry.stat().st_size) for entry in entries)
+        self.disk_used = sum(self.disk.values())
+
+
+# The cache shared by all the maps of the process
+TILE_CACHE = TileCache()
+
+
+class CachedStaticMap(StaticMap):
+    '''StaticMap (see staticmap module) that gets its tiles from TILE_CACHE.'''
+
+    def __init__(self, width, height, **kwargs):
+        if TILE_URL_TEMPLATE is not None:
+            kwargs.setdefault('url_template', TILE_URL_TEMPLATE)
+        super().__init__(width, height, **kwargs)
+
+    def get(self, url, **kwargs):
+        '''Returns the status code and content (in bytes) of the requested tile url.'''
+        return TILE_CACHE.get(url)
+
+
+def tiles_of_bbox(west, south, east, north, zoom):
+    '''
+    Returns the list of tiles (x, y) of the given zoom that cover the given bounding box (in degrees).
+    '''
+    def tile(lon, lat):
+        n = 2 ** zoom
+        x = int((lon + 180.0) / 360.0 * n)
+        y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    x_min, y_min = tile(west, north)
+    x_max, y_max = tile(east, south)
+    return [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+
+def is_self_hosted(url_template):
+    '''Returns if the given tile server can be used to download tiles in bulk: it is set and it is not a public one.'''
+    if not url_template:
+        return False
+    host = (urlsplit(url_template).hostname or '').lower()
+    return not any(host == public or host.endswith('.' + public) for public in PUBLIC_TILE_HOSTS)
+
+
+def prewarm(west, south, east, north, zooms=PREWARM_ZOOMS, url_template=None, workers=PREWARM_WORKERS):
+    '''
+    Downloads into the directory of TILE_CACHE all the tiles that cover the given bounding box (in degrees)
+    at the given zoom levels.
+    Input: - west, south, east, north: bounding box.
+           - zooms: zoom levels.
+           - url_template of the tile server, TILE_URL_TEMPLATE by default.
+           - workers: number of concurrent downloads.
+    Output: number of tiles that could not be downloaded.
+    Prec: the tile server is self-hosted (see is_self_hosted), the public ones forbid bulk downloads.
+    '''
+    url_template = url_template or TILE_URL_TEMPLATE
+    if not is_self_hosted(url_template):
+        raise ValueError(f"Refusing to prewarm the tiles of {url_template or 'the default server'}: "
+                         "set IGO_TILE_URL to a self-hosted tile server")
+
+    urls = [url_template.format(z=zoom, x=x, y=y)
+            for zoom in zooms for x, y in tiles_of_bbox(west, south, east, north, zoom)]
+    # a cache with its own connections, which shares the directory of TILE_CACHE
+    cache = TileCache(directory=TILE_CACHE.directory, memory_size=0, disk_size=TILE_CACHE.disk_size,
+                      connections=workers)
+
+    def get_status(url):
+        try:
+            return cache.get(url)[0]
+        except requests.RequestException:
+            return None
+
+    with ThreadPoolExecutor(workers) as executor:
+        statuses = list(executor.map(get_status, urls))
+
+    return sum(1 for status in statuses if status != 200)
+
+
+def main():
+    '''Prewarms the tile cache with the bounding box of the graph of igo.PLACE, from a self-hosted tile server.'''
+
+    parser = argparse.ArgumentParser(description='Downloads the map tiles of the graph into the tile cache.')
+    parser.add_argument('--min-zoom', type=int, default=PREWARM_ZOOMS.start)
+    parser.add_argument('--max-zoom', type=int, default=PREWARM_ZOOMS.stop - 1)
+    parser.add_argument('--workers', type=int, default=PREWARM_WORKERS)
+    arguments = parser.parse_args()
+    if not is_self_hosted(TILE_URL_TEMPLATE):
+        parser.error("the tile servers of OpenStreetMap and staticmap forbid bulk downloads, "
+                     "set IGO_TILE_URL to a self-hosted tile server to prewarm the cache")
+
+    import igo
+
+    graph = igo.get_graph()
+    failed = prewarm(float(graph.x.min()), float(graph.y.min()), float(graph.x.max()), float(graph.y.max()),
+                     range(arguments.min_zoom, arguments.max_zoom + 1), workers=arguments.workers)
+    print(f"Tile cache prewarmed ({failed} tiles failed)")
+
+
+if __name__ == "__main__":
+    main()
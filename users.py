@@ -0,0 +1,178 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Store of the locations of the users (see open_user_store): 'memory' for a store of this process only,
+# or the name of a SQLite database shared by all the processes of the bot
+USER_STORE = os.environ.get('IGO_USER_STORE', 'users.sqlite')
+
+# Time (in seconds) a location is valid, and time between the deletions of the expired ones
+LOCATION_TTL = 12 * 3600
+EXPIRE_INTERVAL = 600
+
+# The live locations (sent again every few seconds while the user moves) are written in batches,
+# every FLUSH_INTERVAL seconds or when there are FLUSH_SIZE of them
+FLUSH_INTERVAL = 2.0
+FLUSH_SIZE = 1000
+
+
+class UserStore:
+    '''
+    Locations of the users of the bot (Telegram user ID -> (latitude, longitude)), saved in a SQLite database, so all
+    the processes of the bot (in the same machine) share them and they are kept when the bot is restarted.
+    The locations are kept by user, not by chat: a location sent in a private chat with the bot is also the one
+    used by the commands of that user in a group, and the other way around.
+    The locations expire after ttl seconds. The live locations are kept in memory and written together every
+    flush_interval seconds by a background thread, so the other processes see them with that delay at most.
+    It can be used from several threads at once. Its methods can wait for the database (for instance, while another
+    process writes), so the bot calls them in other threads.
+    '''
+
+    def __init__(self, filename=USER_STORE, ttl=LOCATION_TTL, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE):
+        self.filename = filename
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.lock = threading.Lock()  # of the live locations in memory, it is never held while using the database
+        self.database_lock = threading.Lock()  # of the connection
+        self.connection = None  # it is opened the first time it is used
+        self.pending = {}  # user -> (latitude, longitude, updated) of the live locations not written yet
+        self.writing = {}  # the live locations that are being written
+        self.flusher = None
+        self.expired = 0.0  # last time the expired locations were deleted
+
+    def get_location(self, user):
+        '''Returns the (latitude, longitude) of the given user, or None if there is none or it expired.'''
+        now = time.time()
+        with self.lock:
+            row = self.pending.get(user) or self.writing.get(user)
+        if row is None:
+            with self.database_lock:
+                row = self._connect().execute('SELECT lat, lon, updated FROM locations WHERE user = ?',
+                                              (user,)).fetchone()
+        if row is None or now - row[2] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def set_location(self, user, lat_lon, live=False):
+        '''
+        Saves the (latitude, longitude) of the given user. A live location (an edition of a live location message)
+        is written in the next batch, the others immediately.
+        '''
+        row = (float(lat_lon[0]), float(lat_lon[1]), time.time())
+        if live:
+            with self.lock:
+                self.pending[user] = row
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self._flush_loop, name='user_store_flush', daemon=True)
+                    self.flusher.start()
+                if len(self.pending) < self.flush_size:
+                    return
+            self.flush()
+        else:
+            with self.database_lock:
+                with self.lock:
+                    self.pending.pop(user, None)
+                self._write({user: row})
+
+    def flush(self):
+        '''Writes the pending live locations in a single transaction, and deletes the expired locations now and then.'''
+        with self.database_lock:
+            # the locations are read from writing meanwhile, so get_location does not wait for the database
+            with self.lock:
+                self.writing, self.pending = self.pending, {}
+            try:
+                self._write(self.writing)
+            except sqlite3.Error:
+                # they are written in the next batch, unless the user has sent a newer one meanwhile
+                with self.lock:
+                    self.pending = {**self.writing, **self.pending}
+                raise
+            finally:
+                with self.lock:
+                    self.writing = {}
+
+    def close(self):
+        '''Writes the pending live locations and closes the database.'''
+        if self.connection is not None or self.pending:
+            self.flush()
+        with self.database_lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error:  # for instance, the database was locked for too long: we try again later
+                pass
+
+    def _write(self, rows):
+        '''Writes the given locations (user -> row) in a single transaction. Prec: database_lock taken.'''
+        connection = self._connect()
+        if rows:
+            connection.executemany('INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?)',
+                                   [(user,) + row for user, row in rows.items()])
+
+        now = time.time()
+        if now - self.expired > EXPIRE_INTERVAL:
+            connection.execute('DELETE FROM locations WHERE updated < ?', (now - self.ttl,))
+            self.expired = now
+        connection.commit()
+
+    def _connect(self):
+        '''Opens the database (creating it if needed) the first time. Prec: database_lock taken.'''
+        if self.connection is None:
+            # with WAL, the processes can read while another one writes
+            self.connection = sqlite3.connect(self.filename, timeout=10, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS locations '
+                                    '(user INTEGER PRIMARY KEY, lat REAL, lon REAL, updated REAL)')
+            self.connection.commit()
+        return self.connection
+
+
+class MemoryUserStore:
+    '''
+    Locations of the users kept in a dictionary of this process, with the same methods as UserStore.
+    They are lost when the bot is restarted and other processes do not see them.
+    '''
+
+    def __init__(self, ttl=LOCATION_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.locations = {}  # user -> (latitude, longitude, updated)
+        self.expired = time.time()
+
+    def get_location(self, user):
+        now = time.time()
+        with self.lock:
+            row = self.locations.get(user)
+        if row is None or now - row[2] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def set_location(self, user, lat_lon, live=False):
+        now = time.time()
+        with self.lock:
+            self.locations[user] = (float(lat_lon[0]), float(lat_lon[1]), now)
+            if now - self.expired > EXPIRE_INTERVAL:
+                self.locations = {user: row for user, row in self.locations.items() if now - row[2] <= self.ttl}
+                self.expired = now
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_user_store(name=USER_STORE):
+    '''Returns the store of the locations of the users: MemoryUserStore if name is 'memory', else UserStore.'''
+    if name == 'memory':
+        return MemoryUserStore()
+    return UserStore(name)